@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+# Checks the equal-odds cutoffs found on the density grid by
+# calculate-optimal-parameters.py against the bisection of the
+# log-likelihood ratio used before, on synthetic signal distributions.
+# Some of them have runs of zeros where both densities are clipped. Runs
+# between values of the same sign must be skipped. Where the sign changes
+# across a run, bisection stops at any point in it, and the cutoff is only
+# required to be within the same run.
+#
+#   cutoffcheck.py [--tolerance 1e-6]
+#
+# Exits with status 1 if any cutoff differs by more than the tolerance.
+#
+
+import sys
+import os
+
+TAILSEEKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if TAILSEEKER_DIR not in sys.path:
+    sys.path.insert(0, TAILSEEKER_DIR)
+
+import numpy as np
+
+# Settings from conf/defaults.conf and calculate-optimal-parameters.py.
+CUTOFF_RANGE_LOW = 0.0
+CUTOFF_RANGE_HIGH = [0.4, 0.6]
+KDE_BANDWIDTH = 0.1
+VERY_SMALL_PROBABILITY = 0.001
+NUM_BINS = 200
+
+# (center, spread, spots) of the peaks of the negative and positive
+# signals of each synthetic cycle.
+CASES = {
+    'separated': ([(0.05, 0.04, 5000)], [(0.70, 0.08, 5000)]),
+    'zero-run': ([(0.03, 0.02, 3000), (0.40, 0.03, 2000)], [(0.70, 0.08, 5000)]),
+    'wide-range': ([(0.10, 0.05, 3000), (0.38, 0.03, 3000)], [(0.80, 0.06, 5000)]),
+    'overlapping': ([(0.20, 0.10, 5000)], [(0.35, 0.10, 5000)]),
+}
+
+
+def make_counts(peaks, rng):
+    counts = np.zeros(NUM_BINS)
+    for center, spread, spots in peaks:
+        bins = (np.clip(rng.normal(center, spread, spots), 0, 0.999) * NUM_BINS).astype(int)
+        np.add.at(counts, bins, 1)
+    return counts
+
+
+def grid_cutoffs(logLR, xsamples):
+    from tailseeker.stats import first_sign_changes
+
+    cutoffs = np.full(logLR.shape[0], np.nan)
+    for cutoff_limit_high in CUTOFF_RANGE_HIGH:
+        pending = np.where(np.isnan(cutoffs))[0]
+        cutoffs[pending] = first_sign_changes(logLR[pending], xsamples,
+                                              CUTOFF_RANGE_LOW, cutoff_limit_high)
+    return cutoffs
+
+
+def bisection_cutoff(logLR, xsamples):
+    from scipy import optimize
+
+    logLRfun = lambda x: np.interp(x, xsamples, logLR)
+    for cutoff_limit_high in CUTOFF_RANGE_HIGH:
+        try:
+            r = optimize.bisect(logLRfun, CUTOFF_RANGE_LOW, cutoff_limit_high)
+            if CUTOFF_RANGE_LOW < r < cutoff_limit_high:
+                return r
+        except ValueError:
+            pass
+    return np.nan
+
+
+def zero_run_span(logLR, xsamples, x):
+    """Range between the nonzero grid points around `x`."""
+    nonzero = np.where(logLR != 0)[0]
+    left = nonzero[xsamples[nonzero] < x]
+    right = nonzero[xsamples[nonzero] > x]
+    if len(left) == 0 or len(right) == 0:
+        return None
+    return xsamples[left[-1]], xsamples[right[0]]
+
+
+def main(options):
+    from tailseeker.stats import histogram_kde_2d
+
+    rng = np.random.default_rng(options.seed)
+    xsamples = np.arange(0, 1, 1 / NUM_BINS)
+
+    names = sorted(CASES)
+    negcounts = np.array([make_counts(CASES[name][0], rng) for name in names])
+    poscounts = np.array([make_counts(CASES[name][1], rng) for name in names])
+    posdensity = histogram_kde_2d(poscounts, xsamples, KDE_BANDWIDTH)
+    negdensity = histogram_kde_2d(negcounts, xsamples, KDE_BANDWIDTH)
+    logLR = (np.log(np.maximum(VERY_SMALL_PROBABILITY, posdensity)) -
+             np.log(np.maximum(VERY_SMALL_PROBABILITY, negdensity)))
+
+    failures = 0
+    for name, grid, row in zip(names, grid_cutoffs(logLR, xsamples), logLR):
+        bisected = bisection_cutoff(row, xsamples)
+        zeros = int((row == 0).sum())
+        if np.isnan(grid) or np.isnan(bisected):
+            ok = np.isnan(grid) and np.isnan(bisected)
+        elif np.interp(bisected, xsamples, row) == 0:
+            span = zero_run_span(row, xsamples, bisected)
+            ok = span is not None and span[0] < grid < span[1]
+        else:
+            ok = abs(grid - bisected) <= options.tolerance
+        failures += not ok
+        print('{:14s} {:10.6f} {:10.6f} {:5d}  {}'.format(name, grid, bisected, zeros,
+                                                          'ok' if ok else 'MISMATCH'))
+
+    return 1 if failures else 0
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check the equal-odds cutoffs against '
+                                                 'the bisection of the likelihood ratio.')
+    parser.add_argument('--tolerance', dest='tolerance', metavar='DIFF', type=float,
+                        default=1e-6, help='Largest difference allowed.')
+    parser.add_argument('--seed', dest='seed', metavar='N', type=int, default=0,
+                        help='Seed for the synthetic distributions.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_arguments()))
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+# Generates synthetic inputs for the micro-benchmarks: taginfo, refined
+# taginfo, SAM and FASTQ records of the same set of clusters, a reference
+# genome in FASTA with its index, and BGZF-compressed taginfo chunks. The
+# records are sorted by (tile, cluster) as the workflow writes them.
+#
+# `generate_level2_dataset` writes the inputs of the level-2 scripts
+# instead: a genome with genes in GTF, paired alignments of reads from the
+# 3' ends of the genes, and the taginfo, refined taginfo, duplicates and
+# gene associations of the same clusters.
+#
+
+import random
+import struct
+import math
+import zlib
+import gzip
+import os
+
+BASES = 'ACGT'
+MODIFICATIONS = ['', '', '', 'T', 'TT', 'G', 'C', 'TTT']
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03"
+                  b"\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+TAGINFO_FILE = 'taginfo.txt'
+TAGINFO_GZ_FILE = 'taginfo.txt.gz'
+REFINED_TAGINFO_FILE = 'refined-taginfo.txt'
+SAM_FILE = 'alignments.sam'
+FASTQ_FILE = 'reads.fastq.gz'
+FASTA_FILE = 'genome.fa'
+BGZF_CHUNK_PATTERN = 'taginfo-chunk{:02d}.txt.gz'
+
+LEVEL2_FILES = {
+    'genome': 'genome.fa',
+    'gtf': 'exons.gtf.gz',
+    'sam': 'paired.sam',
+    'taginfo_internal': 'taginfo-internal.txt.gz',
+    'taginfo': 'taginfo.txt.gz',
+    'refined_taginfo': 'refined-taginfo.txt.gz',
+    'duplicates': 'duplicates.txt',
+    'associations': 'associations.txt.gz',
+}
+
+PAFLAG_POLYA_DETECTED = 0x0001
+PAFLAG_HAVE_3P_MODIFICATION = 0x0004
+PAFLAG_LIKELY_HAVE_INTACT_END = 0x2000
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choice(BASES) for i in range(length))
+
+
+def generate_clusters(nclusters, ntiles, seed):
+    rng = random.Random(seed)
+    per_tile = max(1, nclusters // ntiles)
+    clusters = []
+    for tileno in range(ntiles):
+        tile = 'Ax{:04d}'.format(1101 + tileno)
+        numbers = sorted(rng.sample(range(per_tile * 20), per_tile))
+        clusters.extend((tile, n) for n in numbers)
+    return clusters[:nclusters]
+
+
+def write_taginfo(filename, clusters, seed, opener=open):
+    rng = random.Random(seed)
+    with opener(filename, 'wt') as outf:
+        for tile, cluster in clusters:
+            print(tile, cluster, rng.choice([0, 0, 0, 1, 4]), rng.randint(0, 230),
+                  rng.choice(MODIFICATIONS), random_seq(rng, 8), sep='\t', file=outf)
+
+
+def write_refined_taginfo(filename, clusters, seed):
+    rng = random.Random(seed)
+    with open(filename, 'w') as outf:
+        for tile, cluster in clusters:
+            polya = rng.randint(0, 230)
+            print(tile, cluster, rng.choice([0, 0, 8192]), rng.randint(1, 3), polya,
+                  max(0, polya - rng.randint(0, 3)), rng.choice(MODIFICATIONS),
+                  rng.choice(MODIFICATIONS), sep='\t', file=outf)
+
+
+def write_sam(filename, clusters, chromosomes, seed, read_length=51):
+    rng = random.Random(seed)
+    chromnames = sorted(chromosomes)
+    qual = 'I' * read_length
+
+    with open(filename, 'w') as outf:
+        print('@HD\tVN:1.4\tSO:queryname', file=outf)
+        for name in chromnames:
+            print('@SQ\tSN:{}\tLN:{}'.format(name, chromosomes[name]), file=outf)
+
+        for tile, cluster in clusters:
+            qname = '{}:{:08d}:0000'.format(tile, cluster)
+            chrom = rng.choice(chromnames)
+            pos = rng.randint(1, chromosomes[chrom] - 1000)
+            for flag, offset in ((99, 0), (147, rng.randint(100, 500))):
+                clip = rng.choice([0, 0, 2, 5])
+                cigar = ('{}S{}M'.format(clip, read_length - clip) if clip
+                         else '{}M'.format(read_length))
+                print(qname, flag, chrom, pos + offset, 255, cigar, '=',
+                      pos + 400 - offset, 400, random_seq(rng, read_length), qual,
+                      'NH:i:1', sep='\t', file=outf)
+
+
+def write_fastq(filename, clusters, seed, read_length=51):
+    rng = random.Random(seed)
+    qual = 'I' * read_length
+    with gzip.open(filename, 'wt', compresslevel=1) as outf:
+        for tile, cluster in clusters:
+            print('@{}:{:08d}:0000'.format(tile, cluster), random_seq(rng, read_length),
+                  '+', qual, sep='\n', file=outf)
+
+
+def write_fasta(filename, chromosomes, seed, width=60):
+    rng = random.Random(seed)
+    sequences = {name: ''.join(rng.choice(BASES) for i in range(chromosomes[name]))
+                 for name in sorted(chromosomes)}
+    write_fasta_sequences(filename, sequences, width)
+
+
+def write_fasta_sequences(filename, sequences, width=60):
+    with open(filename, 'w') as outf, open(filename + '.fai', 'w') as idxf:
+        for name in sorted(sequences):
+            seq = sequences[name]
+            length = len(seq)
+            header = '>{}\n'.format(name)
+            outf.write(header)
+            print(name, length, outf.tell(), width, width + 1, sep='\t', file=idxf)
+
+            for start in range(0, length, width):
+                outf.write(seq[start:start + width] + '\n')
+
+
+def write_bgzf(filename, data):
+    with open(filename, 'wb') as outf:
+        for start in range(0, len(data), BGZF_BLOCK_SIZE):
+            chunk = data[start:start + BGZF_BLOCK_SIZE]
+            compressor = zlib.compressobj(1, zlib.DEFLATED, -15)
+            deflated = compressor.compress(chunk) + compressor.flush()
+            outf.write(struct.pack('<BBBBIBBHBBHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                                   ord('B'), ord('C'), 2, len(deflated) + 25))
+            outf.write(deflated)
+            outf.write(struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+        outf.write(BGZF_EOF_BLOCK)
+
+
+def generate_dataset(outdir, scale, tiles=8, chunks=8, seed=0):
+    """Write all the inputs for `scale` clusters into `outdir`."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    path = lambda name: os.path.join(outdir, name)
+    clusters = generate_clusters(scale, tiles, seed)
+    chromosomes = {'chr{}'.format(i + 1): max(10000, scale * 20 // (i + 1))
+                   for i in range(4)}
+
+    write_taginfo(path(TAGINFO_FILE), clusters, seed + 1)
+    write_taginfo(path(TAGINFO_GZ_FILE), clusters, seed + 1, opener=gzip.open)
+    write_refined_taginfo(path(REFINED_TAGINFO_FILE), clusters, seed + 2)
+    write_sam(path(SAM_FILE), clusters, chromosomes, seed + 3)
+    write_fastq(path(FASTQ_FILE), clusters, seed + 4)
+    write_fasta(path(FASTA_FILE), chromosomes, seed + 5)
+
+    taginfo = open(path(TAGINFO_FILE), 'rb').read()
+    chunksize = len(taginfo) // chunks + 1
+    for i in range(chunks):
+        write_bgzf(path(BGZF_CHUNK_PATTERN.format(i)),
+                   taginfo[i * chunksize:(i + 1) * chunksize])
+
+    return {'clusters': len(clusters), 'chromosomes': chromosomes, 'chunks': chunks}
+
+
+def reverse_complement(seq, table=str.maketrans('ACGT', 'TGCA')):
+    return seq.translate(table)[::-1]
+
+
+def generate_genes(ngenes, seed):
+    """Lay out genes of one to four exons with random gaps between them
+    on a few chromosomes. Coordinates are 0-based and right-open."""
+    rng = random.Random(seed)
+    nchroms = max(1, min(8, ngenes // 50))
+    genes = []
+    chromosomes = {}
+
+    for chromno in range(nchroms):
+        chrom = 'chr{}'.format(chromno + 1)
+        pos = rng.randint(1000, 5000)
+        for i in range(ngenes // nchroms + (chromno < ngenes % nchroms)):
+            # The exon at the 3' end holds both reads of a pair.
+            strand = rng.choice('+-')
+            nexons = rng.randint(1, 4)
+            lengths = [rng.randint(100, 500) for j in range(nexons - 1)]
+            lengths.append(rng.randint(700, 2500))
+            if strand == '-':
+                lengths.reverse()
+
+            exons = []
+            for length in lengths:
+                if exons:
+                    pos += rng.randint(100, 3000) # intron
+                exons.append((pos, pos + length))
+                pos += length
+            pos += rng.randint(1000, 10000)
+
+            genes.append(('G{:05d}'.format(len(genes) + 1), chrom, strand, exons))
+        chromosomes[chrom] = pos + 1000
+
+    return genes, chromosomes
+
+
+def write_gtf(filename, genes):
+    with gzip.open(filename, 'wt') as outf:
+        for geneid, chrom, strand, exons in genes:
+            attrs = 'gene_id "{0}"; transcript_id "{0}.1";'.format(geneid)
+            for exonno, (start, stop) in enumerate(exons):
+                print(chrom, 'synthetic', 'exon', start + 1, stop, '.', strand, '.',
+                      attrs + ' exon_number "{}";'.format(exonno + 1), sep='\t', file=outf)
+
+
+def generate_tail(rng):
+    """A poly(A) length and 3' modification from a mixture of long tails
+    with a log-normal length distribution and short or degraded tails,
+    which are more frequently uridylated."""
+    if rng.random() < 0.25:
+        polya = rng.choice([0, 0, 0, 1, 2, 3, 4, 5, 6, 7])
+        uridylation = 0.35
+    else:
+        polya = min(230, int(rng.lognormvariate(math.log(60), 0.45)))
+        uridylation = 0.08
+
+    draw = rng.random()
+    if draw < uridylation:
+        base = 'T'
+    elif draw < uridylation + 0.02:
+        base = 'G'
+    elif draw < uridylation + 0.03:
+        base = 'C'
+    else:
+        return polya, ''
+
+    length = 1
+    while length < 10 and rng.random() < 0.4:
+        length += 1
+    return polya, base * length
+
+
+def generate_level2_clusters(clusters, genes, seed):
+    """Assign clusters to genes with Zipf-distributed expression levels
+    and draw their tails. About 3% of clusters come from outside of the
+    genes and have no alignments."""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(len(genes))]
+    rng.shuffle(weights)
+
+    records = []
+    for tile, cluster in clusters:
+        gene = rng.choices(genes, weights)[0] if rng.random() >= 0.03 else None
+        polya, mods = generate_tail(rng)
+
+        pflags = PAFLAG_POLYA_DETECTED if polya > 0 else 0
+        if mods:
+            pflags |= PAFLAG_HAVE_3P_MODIFICATION
+        if polya >= 5 and rng.random() < 0.9:
+            pflags |= PAFLAG_LIKELY_HAVE_INTACT_END
+        clones = 1 if rng.random() < 0.9 else rng.randint(2, 5)
+        records.append((tile, cluster, gene, pflags, polya, mods, clones))
+
+    return records
+
+
+def level2_read_pair(rng, genome, record, read_length):
+    """SAM fields of read 1 and read 2 of a cluster. Read 2 starts from the
+    3' end of a transcript, so short tails and modifications are soft
+    clipped from its alignment. Longer tails leave read 2 unmapped."""
+    tile, cluster, gene, pflags, polya, mods, clones = record
+    tail = 'A' * polya + mods
+    qual = 'I' * read_length
+
+    if gene is None:
+        read1 = random_seq(rng, read_length)
+        read2 = reverse_complement(random_seq(rng, read_length - len(tail)) + tail)
+        read2 = read2[:read_length]
+        return [(77, '*', 0, 0, '*', '*', 0, 0, read1, qual),
+                (141, '*', 0, 0, '*', '*', 0, 0, read2, qual)]
+
+    geneid, chrom, strand, exons = gene
+    seq = genome[chrom]
+    clip = len(tail)
+    matched = read_length - min(clip, read_length)
+    insert = rng.randint(150, 500)
+
+    # `read2` is in the orientation of sequencing, which is reverse
+    # complementary to the RNA.
+    if strand == '+':
+        end = exons[-1][1]
+        r1start = end - insert
+        read1 = (99, chrom, r1start + 1, 255, '{}M'.format(read_length), '=',
+                 end - matched + 1, insert, seq[r1start:r1start + read_length], qual)
+        read2 = reverse_complement(seq[end - matched:end] + tail)[:read_length]
+        cigar = '{}M{}S'.format(matched, clip) if clip else '{}M'.format(matched)
+        r2fields = (147, chrom, end - matched + 1, 255, cigar, '=', r1start + 1, -insert,
+                    reverse_complement(read2), qual)
+    else:
+        start = exons[0][0]
+        r1start = start + insert - read_length
+        read1 = (83, chrom, r1start + 1, 255, '{}M'.format(read_length), '=',
+                 start + 1, -insert, seq[r1start:r1start + read_length], qual)
+        read2 = (reverse_complement(tail) + seq[start:start + matched])[:read_length]
+        cigar = '{}S{}M'.format(clip, matched) if clip else '{}M'.format(matched)
+        r2fields = (163, chrom, start + 1, 255, cigar, '=', r1start + 1, insert,
+                    read2, qual)
+
+    if matched < 25: # too short to be aligned
+        r2fields = (133 | (read1[0] & 0x10) << 1, chrom, read1[2], 0, '*', '=', read1[2], 0,
+                    read2, qual)
+        read1 = (read1[0] & ~0x22 | 0x8,) + read1[1:5] + ('=', read1[2], 0) + read1[8:]
+
+    return [read1, r2fields]
+
+
+def write_level2_sam(filename, records, genome, seed, read_length=51):
+    rng = random.Random(seed)
+    tiles = sorted(set(rec[0] for rec in records))
+
+    with open(filename, 'w') as outf:
+        print('@HD\tVN:1.4\tSO:queryname', file=outf)
+        for name in sorted(genome):
+            print('@SQ\tSN:{}\tLN:{}'.format(name, len(genome[name])), file=outf)
+        for tile in tiles:
+            print('@RG\tID:{}'.format(tile), file=outf)
+
+        for record in records:
+            qname = '{}:{:08d}:0000'.format(record[0], record[1])
+            for fields in level2_read_pair(rng, genome, record, read_length):
+                print(qname, *fields, 'NH:i:1', sep='\t', file=outf)
+
+
+def write_level2_taginfo(outdir, records, seed):
+    rng = random.Random(seed)
+    path = lambda name: os.path.join(outdir, LEVEL2_FILES[name])
+
+    internal = []
+    final = []
+    refined = []
+    for tile, cluster, gene, pflags, polya, mods, clones in records:
+        internal.append('{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                        tile, cluster, pflags, polya, mods, random_seq(rng, 8)))
+        final.append('{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                     tile, cluster, pflags, polya, mods, clones))
+        unaligned_mods = 'A' * polya + mods if polya <= 7 else ''
+        refined.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                       tile, cluster, pflags, clones, polya, polya, mods, unaligned_mods))
+
+    with gzip.open(path('taginfo_internal'), 'wt', compresslevel=1) as outf:
+        outf.write(''.join(internal))
+    write_bgzf(path('taginfo'), ''.join(final).encode())
+    with gzip.open(path('refined_taginfo'), 'wt', compresslevel=1) as outf:
+        outf.write(''.join(refined))
+
+
+def write_duplicates(filename, records, seed):
+    # Every cluster is listed as a representative of its clones, with
+    # some of them merged from a few approximate duplicates.
+    rng = random.Random(seed)
+    with open(filename, 'w') as outf:
+        for tile, cluster, gene, pflags, polya, mods, clones in records:
+            if gene is not None:
+                print(polya, clones, rng.randint(0, 2) if clones > 1 else 0,
+                      '{}:{:08d}:0000'.format(tile, cluster), file=outf)
+
+
+def write_associations(filename, records, genes, seed):
+    rng = random.Random(seed)
+    with gzip.open(filename, 'wt', compresslevel=1) as outf:
+        for tile, cluster, gene, pflags, polya, mods, clones in records:
+            if gene is None:
+                continue
+            elif rng.random() < 0.05:
+                other = rng.choice(genes)
+                for geneid in sorted(set([gene[0], other[0]])):
+                    print(tile, cluster, geneid, 2, sep='\t', file=outf)
+            else:
+                print(tile, cluster, gene[0], 1, sep='\t', file=outf)
+
+
+def generate_level2_dataset(outdir, scale, tiles=8, seed=0):
+    """Write the inputs of the level-2 scripts for `scale` clusters into
+    `outdir`."""
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    path = lambda name: os.path.join(outdir, LEVEL2_FILES[name])
+    clusters = generate_clusters(scale, tiles, seed)
+    genes, chromosomes = generate_genes(min(2000, max(50, scale // 200)), seed + 1)
+
+    rng = random.Random(seed + 2)
+    genome = {name: ''.join(rng.choices(BASES, k=chromosomes[name]))
+              for name in sorted(chromosomes)}
+    write_fasta_sequences(path('genome'), genome)
+    write_gtf(path('gtf'), genes)
+
+    records = generate_level2_clusters(clusters, genes, seed + 3)
+    write_level2_sam(path('sam'), records, genome, seed + 4)
+    write_level2_taginfo(outdir, records, seed + 5)
+    write_duplicates(path('duplicates'), records, seed + 6)
+    write_associations(path('associations'), records, genes, seed + 7)
+
+    return {'clusters': len(records), 'sam_records': len(records) * 2,
+            'genes': len(genes), 'genome_size': sum(chromosomes.values())}
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generates synthetic inputs for '
+                                                 'the micro-benchmarks.')
+    parser.add_argument('outdir', metavar='DIR', type=str,
+                        help='Directory to write the data in.')
+    parser.add_argument('--scale', dest='scale', metavar='N', type=int, default=100000,
+                        help='Number of clusters to generate.')
+    parser.add_argument('--seed', dest='seed', metavar='N', type=int, default=0,
+                        help='Seed for the random number generator.')
+    parser.add_argument('--level2', dest='level2', action='store_true', default=False,
+                        help='Generate the inputs of the level-2 scripts instead.')
+    options = parser.parse_args()
+
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_arguments()
+    if options.level2:
+        generate_level2_dataset(options.outdir, options.scale, seed=options.seed)
+    else:
+        generate_dataset(options.outdir, options.scale, seed=options.seed)
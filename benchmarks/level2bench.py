@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+# End-to-end benchmark of the level-2 scripts on synthetic alignments.
+# Every stage runs as a separate process outside of Snakemake, and its wall
+# time, peak RSS and records per second are measured at several scales.
+#
+#   level2bench.py run [--base-scale N] [--scales 1 10 100] [--output FILE]
+#                      [--work-dir DIR] [STAGE ...]
+#
+# Stages depending on a missing program or on the output of a failed stage
+# are skipped. The exponent in the `scaling` column is the slope of the
+# wall time against the number of records on log scales; values below 1
+# are sub-linear.
+#
+
+import subprocess as sp
+import tempfile
+import math
+import time
+import json
+import sys
+import os
+
+TAILSEEKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(TAILSEEKER_DIR, 'scripts')
+if TAILSEEKER_DIR not in sys.path:
+    sys.path.insert(0, TAILSEEKER_DIR)
+
+import datagen
+
+SAMTOOLS_CMD = os.environ.get('SAMTOOLS_CMD', 'samtools')
+TABIX_CMD = os.environ.get('TABIX_CMD', 'tabix')
+
+# Parameters of the Snakemake scripts taken from conf/defaults.conf and the
+# HiSeq read layout.
+GENE_LEVEL_PARAMS = {
+    'bad_flags': 0x1f80,
+    'max_modcount': 20,
+    'delim_settings': [16, 'GTCAG'],
+    'polyA_assume_intact': 5,
+    'R3': [59, 309, 3],
+}
+CONFIDENCE_INTERVAL_SPAN = 0.95
+
+STAGES = []
+
+
+class StageSkipped(Exception):
+    pass
+
+
+def stage(*programs):
+    """Register a stage which runs with the given external programs. The
+    stage function takes the work directory and the description of the
+    data set, and returns the command line, the files to connect to its
+    standard input and output and the number of records it processes."""
+    def register(func):
+        STAGES.append((func.__name__[len('stage_'):].replace('_', '-'), programs, func))
+        return func
+    return register
+
+
+def require(*filenames):
+    for filename in filenames:
+        if not os.path.exists(filename):
+            raise StageSkipped('{} is not available'.format(os.path.basename(filename)))
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name)]
+
+
+def snakemake_script(name, **spec):
+    """Command line running a script written for the `script:` directive
+    of Snakemake with the given input, output, params and wildcards."""
+    return [sys.executable, os.path.abspath(__file__), 'script',
+            os.path.join(SCRIPTS_DIR, name), json.dumps(spec)]
+
+
+@stage('zcat')
+def stage_add_sam_tags_primary(workdir, dataset):
+    path = lambda name: os.path.join(workdir, name)
+    return {
+        'argv': script('add-sam-tags-primary.py') +
+                [path(datagen.LEVEL2_FILES['taginfo_internal'])],
+        'stdin': path(datagen.LEVEL2_FILES['sam']),
+        'stdout': path('tagged-primary.sam'),
+        'records': dataset['sam_records'],
+    }
+
+
+@stage(SAMTOOLS_CMD, TABIX_CMD)
+def stage_refine_modifications(workdir, dataset):
+    path = lambda name: os.path.join(workdir, name)
+    require(path('tagged-primary.sam'))
+
+    # Not measured: the workflow keeps these as the outputs of other rules.
+    if not os.path.exists(path('paired.bam')):
+        sp.check_call([SAMTOOLS_CMD, 'view', '-b', '-o', path('paired.bam'),
+                       path('tagged-primary.sam')])
+    taginfo = path(datagen.LEVEL2_FILES['taginfo'])
+    if not os.path.exists(taginfo + '.tbi'):
+        sp.check_call([TABIX_CMD, '-0', '-b', '2', '-e', '2', '-s', '1', taginfo])
+
+    return {
+        'argv': script('refine-modifications.py') + [
+                '--parallel', '1', '--taginfo', taginfo,
+                '--alignment', path('paired.bam'),
+                '--reference-seq', path(datagen.LEVEL2_FILES['genome']),
+                '--max-fragment-size', '1000000'],
+        'stdin': None,
+        'stdout': path('refined.txt'),
+        'records': dataset['clusters'],
+    }
+
+
+@stage()
+def stage_add_sam_tags_refined(workdir, dataset):
+    path = lambda name: os.path.join(workdir, name)
+    require(path('tagged-primary.sam'))
+    return {
+        'argv': script('add-sam-tags-refined.py') +
+                [path(datagen.LEVEL2_FILES['refined_taginfo'])],
+        'stdin': path('tagged-primary.sam'),
+        'stdout': path('tagged-refined.sam'),
+        'records': dataset['sam_records'],
+    }
+
+
+@stage(SAMTOOLS_CMD)
+def stage_filter_approximate_duplicates(workdir, dataset):
+    path = lambda name: os.path.join(workdir, name)
+    require(path('tagged-refined.sam'))
+
+    if not os.path.exists(path('tagged-refined.bam')):
+        sp.check_call([SAMTOOLS_CMD, 'view', '-b', '-o', path('tagged-refined.bam'),
+                       path('tagged-refined.sam')])
+
+    return {
+        'argv': script('filter-approximate-duplicates.py') + [
+                '--bam', path('tagged-refined.bam'),
+                '--duplicates', path(datagen.LEVEL2_FILES['duplicates'])],
+        'stdin': None,
+        'stdout': path('filtered.sam'),
+        'records': dataset['sam_records'],
+    }
+
+
+def tagcounts_command(workdir, modtype):
+    path = lambda name: os.path.join(workdir, name)
+    return snakemake_script('make-gene-level-tagcounts.py',
+        input={'taginfo': path(datagen.LEVEL2_FILES['refined_taginfo']),
+               'associations': path(datagen.LEVEL2_FILES['associations'])},
+        output={'canonical': path('tagcounts-{}-canonical.msgpack.xz'.format(modtype)),
+                'noncanonical': path('tagcounts-{}-noncanonical.msgpack.xz'.format(modtype))},
+        params=GENE_LEVEL_PARAMS,
+        wildcards={'modtype': modtype, 'ambigtype': 'single'})
+
+
+@stage()
+def stage_make_gene_level_tagcounts(workdir, dataset):
+    return {
+        'argv': tagcounts_command(workdir, 'U'),
+        'stdin': None,
+        'stdout': None,
+        'records': dataset['clusters'],
+    }
+
+
+@stage()
+def stage_stats_gene_level_tailing(workdir, dataset):
+    path = lambda name: os.path.join(workdir, name)
+    require(path('tagcounts-U-canonical.msgpack.xz'))
+
+    # The other modification types are counted the same way as U.
+    for modtype in 'GC':
+        if not os.path.exists(path('tagcounts-{}-canonical.msgpack.xz'.format(modtype))):
+            if sp.call(tagcounts_command(workdir, modtype), stdout=sp.DEVNULL,
+                       stderr=sp.DEVNULL, env=stage_environment()) != 0:
+                raise StageSkipped('tag counts for {} failed'.format(modtype))
+
+    inputs = {}
+    for modtype in 'UGC':
+        for tailtype, suffix in [('canonical', 'c'), ('noncanonical', 'nc')]:
+            inputs[modtype + suffix] = path('tagcounts-{}-{}.msgpack.xz'.format(
+                                            modtype, tailtype))
+
+    return {
+        'argv': snakemake_script('stats-gene-level-tailing.py', input=inputs,
+                    output=[path('genelevelstats.csv')],
+                    params={'confidence_interval_span': CONFIDENCE_INTERVAL_SPAN}),
+        'stdin': None,
+        'stdout': None,
+        'records': dataset['genes'],
+    }
+
+
+def stage_environment():
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join([TAILSEEKER_DIR] +
+                            ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    return env
+
+
+def run_measured(job, logfile):
+    stdin = open(job['stdin'], 'rb') if job['stdin'] else sp.DEVNULL
+    stdout = open(job['stdout'], 'wb') if job['stdout'] else sp.DEVNULL
+
+    with open(logfile, 'wb') as logf:
+        start = time.perf_counter()
+        proc = sp.Popen(job['argv'], stdin=stdin, stdout=stdout, stderr=logf,
+                        env=stage_environment())
+        _, waitstatus, usage = os.wait4(proc.pid, 0)
+        wall_time = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(waitstatus)
+
+    for f in (stdin, stdout):
+        if f is not sp.DEVNULL:
+            f.close()
+
+    return {
+        'wall_time': wall_time,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'max_rss_mb': usage.ru_maxrss / 1024,
+        'records': job['records'],
+        'records_per_second': job['records'] / wall_time if wall_time > 0 else 0.,
+        'exit_status': proc.returncode,
+    }
+
+
+def log_tail(logfile, lines=3):
+    with open(logfile, errors='replace') as inpf:
+        return ' | '.join(line.strip() for line in inpf.readlines()[-lines:])
+
+
+def run_scale(workdir, clusters, selected):
+    import shutil
+
+    print('Generating data for {} clusters...'.format(clusters), file=sys.stderr)
+    start = time.perf_counter()
+    dataset = datagen.generate_level2_dataset(workdir, clusters)
+    dataset['generation_time'] = time.perf_counter() - start
+
+    results = {}
+    for name, programs, func in STAGES:
+        if name not in selected:
+            continue
+
+        missing = [prog for prog in programs if shutil.which(prog) is None]
+        try:
+            if missing:
+                raise StageSkipped('{} not found'.format(', '.join(missing)))
+            job = func(workdir, dataset)
+        except (StageSkipped, sp.CalledProcessError) as exc:
+            results[name] = {'status': 'skipped', 'reason': str(exc)}
+        else:
+            logfile = os.path.join(workdir, name + '.log')
+            result = run_measured(job, logfile)
+            if result['exit_status'] == 0:
+                result['status'] = 'ok'
+            else:
+                result['status'] = 'failed'
+                result['reason'] = log_tail(logfile)
+                if job['stdout'] and os.path.exists(job['stdout']):
+                    os.unlink(job['stdout']) # not to be taken by the later stages
+            results[name] = result
+
+        print_result(name, clusters, results[name])
+
+    return dataset, results
+
+
+def print_result(name, clusters, result, file=sys.stderr):
+    if result['status'] == 'ok':
+        print('{:32s} {:>9d} {:10.2f} s {:9.1f} MB {:12.1f} rec/s'.format(
+              name, clusters, result['wall_time'], result['max_rss_mb'],
+              result['records_per_second']), file=file)
+    else:
+        print('{:32s} {:>9d} {}: {}'.format(name, clusters, result['status'],
+              result['reason']), file=file)
+
+
+def scaling_exponent(points):
+    """Slope of a least-squares fit of log(wall time) on log(records)."""
+    if len(points) < 2:
+        return None
+
+    xs = [math.log(records) for records, _ in points]
+    ys = [math.log(wall_time) for _, wall_time in points]
+    xmean = sum(xs) / len(xs)
+    ymean = sum(ys) / len(ys)
+    sxx = sum((x - xmean) ** 2 for x in xs)
+    if sxx == 0:
+        return None
+    return sum((x - xmean) * (y - ymean) for x, y in zip(xs, ys)) / sxx
+
+
+def run_benchmarks(options):
+    import tailseeker
+    from microbench import git_revision
+
+    stage_names = [name for name, _, _ in STAGES]
+    unknown = set(options.stages) - set(stage_names)
+    if unknown:
+        raise ValueError('Unknown stages: ' + ', '.join(sorted(unknown)))
+    selected = set(options.stages or stage_names)
+
+    with tempfile.TemporaryDirectory(prefix='tailseq-l2bench-') as tmpdir:
+        basedir = options.workdir or tmpdir
+
+        scales = {}
+        for scale in options.scales:
+            clusters = options.base_scale * scale
+            workdir = os.path.join(basedir, 'scale-{}'.format(scale))
+            dataset, results = run_scale(workdir, clusters, selected)
+            scales[str(scale)] = {'clusters': clusters, 'dataset': dataset,
+                                  'stages': results}
+
+    scaling = {}
+    for name in stage_names:
+        points = [(s['stages'][name]['records'], s['stages'][name]['wall_time'])
+                  for s in scales.values()
+                  if s['stages'].get(name, {}).get('status') == 'ok'
+                     and s['stages'][name]['wall_time'] > 0]
+        exponent = scaling_exponent(points)
+        if exponent is not None:
+            scaling[name] = exponent
+
+    print('\n{:32s} {:>8s}'.format('stage', 'scaling'), file=sys.stderr)
+    for name in stage_names:
+        if name in scaling:
+            print('{:32s} {:8.2f}'.format(name, scaling[name]), file=sys.stderr)
+
+    report = {
+        'tailseeker_version': tailseeker.__version__,
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'base_scale': options.base_scale,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scales': scales,
+        'scaling': scaling,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as outf:
+            json.dump(report, outf, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    failed = [name for s in scales.values() for name, r in s['stages'].items()
+              if r['status'] == 'failed']
+    return 1 if failed else 0
+
+
+class Namedlist(list):
+    """Positional and named access to the items, as in the `snakemake`
+    object given to the scripts by Snakemake."""
+
+    def __init__(self, items):
+        if isinstance(items, dict):
+            list.__init__(self, items.values())
+            for name, value in items.items():
+                setattr(self, name, value)
+        else:
+            list.__init__(self, items)
+
+
+def run_snakemake_script(options):
+    import runpy
+
+    spec = json.loads(options.spec)
+
+    class Snakemake:
+        pass
+
+    snakemake = Snakemake()
+    for name in ['input', 'output', 'params', 'wildcards', 'log']:
+        setattr(snakemake, name, Namedlist(spec.get(name, [])))
+    snakemake.threads = 1
+
+    sys.argv = [options.script]
+    runpy.run_path(options.script, init_globals={'snakemake': snakemake},
+                   run_name='__main__')
+    return 0
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the '
+                                                 'level-2 scripts of tailseeker.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    runparser = subparsers.add_parser('run', help='Run the benchmark.')
+    runparser.add_argument('stages', metavar='STAGE', type=str, nargs='*',
+                           help='Stages to run (default: all of {}).'.format(
+                                ', '.join(name for name, _, _ in STAGES)))
+    runparser.add_argument('--base-scale', dest='base_scale', metavar='N', type=int,
+                           default=10000, help='Number of clusters at the scale of 1.')
+    runparser.add_argument('--scales', dest='scales', metavar='N', type=int, nargs='+',
+                           default=[1, 10, 100], help='Multiples of the base scale '
+                                                      'to measure at.')
+    runparser.add_argument('--work-dir', dest='workdir', metavar='DIR', type=str,
+                           default=None, help='Directory to keep the data and the '
+                                              'outputs in (a temporary directory '
+                                              'by default).')
+    runparser.add_argument('--output', dest='output', metavar='FILE', type=str,
+                           default=None, help='Path to write the results in JSON.')
+
+    scriptparser = subparsers.add_parser('script', help='Run a script for the '
+                                         'script directive of Snakemake (internal).')
+    scriptparser.add_argument('script', metavar='SCRIPT', type=str)
+    scriptparser.add_argument('spec', metavar='JSON', type=str)
+    options = parser.parse_args()
+
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_arguments()
+    if options.command == 'run':
+        sys.exit(run_benchmarks(options))
+    else:
+        sys.exit(run_snakemake_script(options))
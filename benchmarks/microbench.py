@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+# Micro-benchmarks of the record-level code in tailseeker.fileutils,
+# tailseeker.parsers and tailseeker.sequtils on synthetic data.
+#
+#   microbench.py run [--scale N] [--output results.json] [BENCHMARK ...]
+#   microbench.py compare baseline.json results.json [--threshold 0.1]
+#
+# `compare` exits with status 1 if any benchmark got slower than the
+# baseline by more than the threshold.
+#
+
+import subprocess as sp
+import tempfile
+import random
+import time
+import json
+import sys
+import os
+
+TAILSEEKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if TAILSEEKER_DIR not in sys.path:
+    sys.path.insert(0, TAILSEEKER_DIR)
+
+import datagen
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append((func.__name__[len('bench_'):], func))
+    return func
+
+
+# Each benchmark takes the data directory and returns a function to be
+# timed. The function returns the number of items processed.
+
+@benchmark
+def bench_parse_taginfo(datadir):
+    from tailseeker.parsers import parse_taginfo_internal
+
+    def run():
+        n = 0
+        for row in parse_taginfo_internal(open(os.path.join(datadir, datagen.TAGINFO_FILE), 'rb')):
+            n += row.polyA >= 0
+        return n
+    return run
+
+
+@benchmark
+def bench_parse_refined_taginfo(datadir):
+    from tailseeker.parsers import parse_refined_taginfo
+
+    def run():
+        n = 0
+        for row in parse_refined_taginfo(open(os.path.join(datadir,
+                                                           datagen.REFINED_TAGINFO_FILE), 'rb')):
+            n += row.clones > 0
+        return n
+    return run
+
+
+@benchmark
+def bench_parse_sam(datadir):
+    from tailseeker.parsers import parse_sam
+
+    def run():
+        n = 0
+        for row in parse_sam(open(os.path.join(datadir, datagen.SAM_FILE), 'rb')):
+            n += 1
+        return n
+    return run
+
+
+@benchmark
+def bench_multijoin(datadir):
+    from tailseeker.parsers import parse_sam, parse_taginfo_internal
+    from tailseeker.fileutils import MultiJoinIterator, ParsedLineComment
+
+    def samkey(row):
+        if isinstance(row, ParsedLineComment):
+            return b'', 0
+        qtokens = row.qname.split(b':', 2)
+        return (qtokens[0], int(qtokens[1]))
+    taginfokey = lambda x: (x.tile, x.cluster)
+
+    def run():
+        samit = parse_sam(open(os.path.join(datadir, datagen.SAM_FILE), 'rb'))
+        taginfoit = parse_taginfo_internal(open(os.path.join(datadir,
+                                                             datagen.TAGINFO_FILE), 'rb'))
+        n = 0
+        for key, samrows, taginforows in MultiJoinIterator([samit, taginfoit],
+                                                           [samkey, taginfokey]):
+            n += len(list(samrows)) > 0 and len(list(taginforows)) > 0
+        return n
+    return run
+
+
+@benchmark
+def bench_parse_fastq(datadir):
+    from tailseeker.parsers import parse_fastq
+
+    def run():
+        n = 0
+        for name, seq, qual in parse_fastq(os.path.join(datadir, datagen.FASTQ_FILE)):
+            n += 1
+        return n
+    return run
+
+
+@benchmark
+def bench_open_gzip_buffered(datadir):
+    from tailseeker.fileutils import open_gzip_buffered
+
+    def run():
+        n = 0
+        for line in open_gzip_buffered(os.path.join(datadir, datagen.TAGINFO_GZ_FILE)):
+            n += 1
+        return n
+    return run
+
+
+@benchmark
+def bench_merge_bgzf_files(datadir):
+    from tailseeker.fileutils import merge_bgzf_files
+
+    inputs = sorted(os.path.join(datadir, f) for f in os.listdir(datadir)
+                    if f.startswith('taginfo-chunk'))
+
+    def run():
+        with tempfile.TemporaryDirectory(dir=datadir) as tmpdir:
+            output = os.path.join(tmpdir, 'merged.txt.gz')
+            merge_bgzf_files(output, inputs)
+            return os.path.getsize(output) >> 10 # in kilobytes
+    return run
+
+
+@benchmark
+def bench_fasta_get(datadir):
+    from tailseeker.sequtils import GiantFASTAFile
+
+    fastafile = os.path.join(datadir, datagen.FASTA_FILE)
+    index = GiantFASTAFile(fastafile).index
+    rng = random.Random(0)
+    queries = []
+    for i in range(50000):
+        chrom = rng.choice(sorted(index))
+        start = rng.randint(0, index[chrom][0] - 100)
+        queries.append((chrom, start, start + rng.randint(2, 60), rng.choice('+-')))
+
+    def run():
+        genome = GiantFASTAFile(fastafile)
+        for chrom, start, stop, strand in queries:
+            genome.get(chrom, start, stop, strand)
+        return len(queries)
+    return run
+
+
+@benchmark
+def bench_reverse_complement_bytes(datadir):
+    from tailseeker.parsers import parse_sam
+    from tailseeker.sequtils import reverse_complement_bytes
+
+    seqs = [row.seq for row in parse_sam(open(os.path.join(datadir, datagen.SAM_FILE), 'rb'))
+            if not row.line.startswith(b'@')]
+
+    def run():
+        for seq in seqs:
+            reverse_complement_bytes(seq)
+        return len(seqs)
+    return run
+
+
+def time_benchmark(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        items = func()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'seconds': min(timings),
+        'mean_seconds': sum(timings) / len(timings),
+        'items': items,
+        'items_per_second': items / min(timings) if min(timings) > 0 else 0.,
+    }
+
+
+def git_revision():
+    try:
+        return sp.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=TAILSEEKER_DIR,
+                               stderr=sp.DEVNULL).decode().strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def run_benchmarks(options):
+    import tailseeker
+
+    selected = [(name, func) for name, func in BENCHMARKS
+                if not options.benchmarks or name in options.benchmarks]
+    unknown = set(options.benchmarks) - set(name for name, _ in BENCHMARKS)
+    if unknown:
+        raise ValueError('Unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    with tempfile.TemporaryDirectory(prefix='tailseq-bench-') as tmpdir:
+        datadir = options.datadir or tmpdir
+        if not os.path.exists(os.path.join(datadir, datagen.FASTA_FILE)):
+            print('Generating data for {} clusters...'.format(options.scale), file=sys.stderr)
+            datagen.generate_dataset(datadir, options.scale)
+
+        results = {}
+        for name, func in selected:
+            results[name] = time_benchmark(func(datadir), options.repeat)
+            print('{:28s} {:10.4f} s {:14.1f} items/s'.format(
+                  name, results[name]['seconds'], results[name]['items_per_second']),
+                  file=sys.stderr)
+
+    report = {
+        'tailseeker_version': tailseeker.__version__,
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'scale': options.scale,
+        'repeat': options.repeat,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmarks': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as outf:
+            json.dump(report, outf, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    return 0
+
+
+def compare_results(options):
+    baseline = json.load(open(options.baseline))
+    current = json.load(open(options.current))
+
+    if baseline.get('scale') != current.get('scale'):
+        print('WARNING: The results were measured at different scales '
+              '({} and {}).'.format(baseline.get('scale'), current.get('scale')),
+              file=sys.stderr)
+
+    regressions = 0
+    print('{:28s} {:>10s} {:>10s} {:>8s}  {}'.format('benchmark', 'baseline',
+                                                     'current', 'ratio', 'status'))
+    for name in sorted(set(baseline['benchmarks']) | set(current['benchmarks'])):
+        if name not in baseline['benchmarks'] or name not in current['benchmarks']:
+            print('{:28s} missing in one of the results.'.format(name))
+            continue
+
+        before = baseline['benchmarks'][name]['seconds']
+        after = current['benchmarks'][name]['seconds']
+        ratio = after / before if before > 0 else float('inf')
+
+        if ratio > 1 + options.threshold:
+            status = 'REGRESSION'
+            regressions += 1
+        elif ratio < 1 / (1 + options.threshold):
+            status = 'faster'
+        else:
+            status = 'ok'
+
+        print('{:28s} {:10.4f} {:10.4f} {:8.3f}  {}'.format(name, before, after, ratio, status))
+
+    return 1 if regressions else 0
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the record '
+                                                 'processing code of tailseeker.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    runparser = subparsers.add_parser('run', help='Run the benchmarks.')
+    runparser.add_argument('benchmarks', metavar='BENCHMARK', type=str, nargs='*',
+                           help='Benchmarks to run (default: all of {}).'.format(
+                                ', '.join(name for name, _ in BENCHMARKS)))
+    runparser.add_argument('--scale', dest='scale', metavar='N', type=int, default=100000,
+                           help='Number of clusters in the synthetic data.')
+    runparser.add_argument('--repeat', dest='repeat', metavar='N', type=int, default=3,
+                           help='Number of runs to take the fastest of.')
+    runparser.add_argument('--data-dir', dest='datadir', metavar='DIR', type=str,
+                           default=None, help='Directory with data from datagen.py '
+                                              '(generated to a temporary directory if '
+                                              'not given or empty).')
+    runparser.add_argument('--output', dest='output', metavar='FILE', type=str,
+                           default=None, help='Path to write the results in JSON.')
+
+    cmpparser = subparsers.add_parser('compare', help='Compare results to a baseline.')
+    cmpparser.add_argument('baseline', metavar='BASELINE', type=str,
+                           help='Results saved from a baseline run.')
+    cmpparser.add_argument('current', metavar='CURRENT', type=str,
+                           help='Results to check.')
+    cmpparser.add_argument('--threshold', dest='threshold', metavar='FRACTION',
+                           type=float, default=0.1,
+                           help='Slowdown to regard as a regression.')
+    options = parser.parse_args()
+
+    return options
+
+
+if __name__ == '__main__':
+    options = parse_arguments()
+    if options.command == 'run':
+        sys.exit(run_benchmarks(options))
+    else:
+        sys.exit(compare_results(options))
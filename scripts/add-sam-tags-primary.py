@@ -25,6 +25,7 @@
 
 from tailseeker.parsers import parse_sam, parse_taginfo_internal, parse_taginfo
 from tailseeker.fileutils import MultiJoinIterator, ParsedLineComment
+from tailseeker import instrument
 import subprocess as sp
 import sys
 import gzip
@@ -36,9 +37,14 @@ def process(taginfo_files):
     taginfo_input = taginfo_read_proc.stdout
     sam_input = os.fdopen(sys.stdin.fileno(), 'rb')
 
+    stage = instrument.stage('add-tags')
+    joined = stage.counter('joined')
+
     # parsing iterators
-    samit = parse_sam(sam_input)
-    taginfoit = parse_taginfo_internal(taginfo_input)
+    samit = instrument.counted(parse_sam(sam_input), stage.counter('sam_records'),
+                               stage.counter('bytes_read'))
+    taginfoit = instrument.counted(parse_taginfo_internal(taginfo_input),
+                                   stage.counter('taginfo_records'))
 
     # key functions for joiner
     def parse_readid_from_sam(samrow):
@@ -49,7 +55,8 @@ def process(taginfo_files):
     taginfokey = lambda x: (x.tile, x.cluster)
 
     joined_it = MultiJoinIterator([samit, taginfoit], [parse_readid_from_sam, taginfokey])
-    output = os.fdopen(sys.stdout.fileno(), 'wb')
+    output = instrument.counting_writer(os.fdopen(sys.stdout.fileno(), 'wb'),
+                                        stage.counter('bytes_written'))
     tagformat = '\tRG:Z:{}\tZA:i:{}\tZS:Z:_{}\tZM:Z:{}\n'
 
     for (tile, cluster), samrows, taginforows in joined_it:
@@ -63,6 +70,7 @@ def process(taginfo_files):
             continue
 
         taginfo = taginforows[0]
+        joined.add()
 
         tags_formatted = tagformat.format(tile.decode(), taginfo.polyA,
                                           taginfo.mods.decode(), taginfo.umi.decode())
@@ -73,6 +81,9 @@ def process(taginfo_files):
 
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     taginfo_files = sys.argv[1:]
     process(taginfo_files)
 
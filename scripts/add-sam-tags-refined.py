@@ -25,6 +25,7 @@
 
 from tailseeker.parsers import parse_sam, parse_refined_taginfo
 from tailseeker.fileutils import MultiJoinIterator, ParsedLineComment
+from tailseeker import instrument
 import subprocess as sp
 import sys
 import gzip
@@ -35,9 +36,14 @@ def process(taginfo_file):
     taginfo_input = gzip.open(taginfo_file, 'rb')
     sam_input = os.fdopen(sys.stdin.fileno(), 'rb')
 
+    stage = instrument.stage('add-tags')
+    joined = stage.counter('joined')
+
     # parsing iterators
-    samit = parse_sam(sam_input)
-    taginfoit = parse_refined_taginfo(taginfo_input)
+    samit = instrument.counted(parse_sam(sam_input), stage.counter('sam_records'),
+                               stage.counter('bytes_read'))
+    taginfoit = instrument.counted(parse_refined_taginfo(taginfo_input),
+                                   stage.counter('taginfo_records'))
 
     # key functions for joiner
     def parse_readid_from_sam(samrow):
@@ -48,7 +54,8 @@ def process(taginfo_file):
     taginfokey = lambda x: (x.tile, x.cluster)
 
     joined_it = MultiJoinIterator([samit, taginfoit], [parse_readid_from_sam, taginfokey])
-    output = os.fdopen(sys.stdout.fileno(), 'wb')
+    output = instrument.counting_writer(os.fdopen(sys.stdout.fileno(), 'wb'),
+                                        stage.counter('bytes_written'))
     tagformat = '\tZF:i:{}\tZD:i:{}\tZa:i:{}\tZs:Z:_{}\n'
 
     for (tile, cluster), samrows, taginforows in joined_it:
@@ -62,6 +69,8 @@ def process(taginfo_file):
             continue
 
         taginfo = taginforows[0]
+        joined.add()
+
         tags_formatted = tagformat.format(taginfo.pflags, taginfo.clones,
                                           taginfo.unaligned_polyA,
                                           taginfo.unaligned_mods.decode())
@@ -72,6 +81,9 @@ def process(taginfo_file):
 
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     taginfo = sys.argv[1]
     process(taginfo)
 
@@ -39,6 +39,9 @@ def parse_arguments():
 
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     from tailseeker.fileutils import merge_bgzf_files
 
     options = parse_arguments()
@@ -24,58 +24,114 @@
 #
 
 from tailseeker.powersnake import *
-from tailseeker.stats import gaussian_kde
-from scipy import optimize
+from tailseeker.stats import histogram_kde_2d, first_sign_changes
+from tailseeker.signals import load_sigdists
 from concurrent import futures
 import sys
 import numpy as np
-import struct
-import gzip
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python 3.7 and earlier
+    shared_memory = None
 
 NUM_CLOSEST_CYCLES_INTERPOLATION    = 3
 NUM_CLOSEST_CYCLES_EXTRAPOLATION    = 5
+SIGNAL_TYPES                        = ['pos', 'neg']
+
+def load_all_signal_dists(tileids):
+    # All distributions are held in a single shared memory block shaped as
+    # (tiles, pos/neg, cycles, bins) so that the worker processes can read
+    # them without having them pickled for each job. Without
+    # multiprocessing.shared_memory, it is an ordinary array and the counts
+    # of each tile are sent to the workers with the jobs.
+    tileindex = {tileid: i for i, tileid in enumerate(tileids)}
+    shm = sigdists = None
+
+    if len(input) == 0:
+        raise ValueError('No signal distributions are given.')
+
+    try:
+        for f in input:
+            tilename = f.rsplit('_', 1)[1].split('.', 1)[0]
+            signaltype = f.rsplit('/', 1)[1].split('_', 1)[0]
+            counts = load_sigdists(f).astype(np.uint64)
+
+            if sigdists is None:
+                shape = (len(tileids), len(SIGNAL_TYPES)) + counts.shape
+                if shared_memory is None:
+                    sigdists = np.zeros(shape, dtype=counts.dtype)
+                else:
+                    shm = shared_memory.SharedMemory(create=True,
+                                size=int(np.prod(shape)) * counts.dtype.itemsize)
+                    sigdists = np.ndarray(shape, dtype=counts.dtype, buffer=shm.buf)
+                    sigdists.fill(0)
+
+            sigdists[tileindex[tilename], SIGNAL_TYPES.index(signaltype)] = counts
+    except BaseException:
+        # The block would be left in /dev/shm after this process exits.
+        if shm is not None:
+            del sigdists
+            shm.close()
+            shm.unlink()
+        raise
+
+    return shm, sigdists, tileindex
+
+shared_sigdists = None
+
+def attach_shared_signal_dists(shmname, shape, dtype):
+    global shared_sigdists, shared_sigdists_shm
+
+    shared_sigdists_shm = shared_memory.SharedMemory(name=shmname)
+    shared_sigdists = np.ndarray(shape, dtype=dtype, buffer=shared_sigdists_shm.buf)
+
+def find_shared_tile_eqodds_points(tileidx, xsamples):
+    return find_tile_eqodds_points(shared_sigdists[tileidx], xsamples)
+
+def find_tile_eqodds_points(counts, xsamples):
+    poscounts = counts[SIGNAL_TYPES.index('pos')]
+    negcounts = counts[SIGNAL_TYPES.index('neg')]
+
+    cutoffs = np.full(poscounts.shape[0], np.nan)
+    for cycle, cutoff in find_all_eqodds_point(poscounts, negcounts, xsamples).items():
+        if cutoff is not None:
+            cutoffs[cycle] = cutoff
+    return cutoffs
+
+def find_eqodds_points(logLR, xsamples):
+    # Finds the first sign change of the log-likelihood ratio of each row
+    # within the search range. The range is extended to the next upper limit
+    # for the rows that were not bracketed by the previous ones. Zero runs,
+    # where both densities are clipped, are not taken as crossings.
+    cutoffs = np.full(logLR.shape[0], np.nan)
 
-def load_sig_dists(filename):
-    inpf = gzip.open(filename, 'rb')
-    elemsize, cycles, bins = struct.unpack('<III', inpf.read(12))
-    assert elemsize == 4
-
-    counts = np.fromstring(inpf.read(), np.uint32).reshape((cycles, bins))
-    spots_per_cycle = counts.sum(axis=1)
-    return counts.astype(np.uint64), spots_per_cycle.astype(np.uint64)
-
-def load_all_signal_dists():
-    sigdists = {}
-    spotcounts = {}
-    for f in input:
-        tilename = f.rsplit('_', 1)[1].split('.', 1)[0]
-        signaltype = f.rsplit('/', 1)[1].split('_', 1)[0]
-        sigdists[tilename, signaltype], spotcounts[tilename, signaltype] = \
-            load_sig_dists(f)
-    return sigdists
-
-def find_eqodds_point(poscounts, negcounts, xsamples):
-    poskde = gaussian_kde(xsamples, weights=poscounts, bw_method=KDE_BANDWIDTH)
-    negkde = gaussian_kde(xsamples, weights=negcounts, bw_method=KDE_BANDWIDTH)
+    for cutoff_limit_high in CUTOFF_RANGE_HIGH:
+        pending = np.where(np.isnan(cutoffs))[0]
+        if len(pending) == 0:
+            break
 
-    logLRfun = lambda x: np.log(max(VERY_SMALL_PROBABILITY, poskde(x)) /
-                                max(VERY_SMALL_PROBABILITY, negkde(x)))
+        cutoffs[pending] = first_sign_changes(logLR[pending], xsamples,
+                                              CUTOFF_RANGE_LOW, cutoff_limit_high)
 
-    for cutoff_limit_high in CUTOFF_RANGE_HIGH:
-        try:
-            r = optimize.bisect(logLRfun, CUTOFF_RANGE_LOW, cutoff_limit_high)
-            if CUTOFF_RANGE_LOW < r < cutoff_limit_high:
-                return r
-        except ValueError:
-            pass
-    return
+    return cutoffs
 
 def find_all_eqodds_point(poscounts, negcounts, xsamples):
     cycles_to_try = np.where((poscounts.sum(axis=1) >= MIN_SPOTS_FOR_DIST) &
-                             (negcounts.sum(axis=1) >= MIN_SPOTS_FOR_DIST))[0].tolist()
+                             (negcounts.sum(axis=1) >= MIN_SPOTS_FOR_DIST))[0]
+    if len(cycles_to_try) == 0:
+        return {}
+
+    # Densities for all cycles as (cycles x bins) matrices.
+    posdensity = histogram_kde_2d(poscounts[cycles_to_try], xsamples, KDE_BANDWIDTH)
+    negdensity = histogram_kde_2d(negcounts[cycles_to_try], xsamples, KDE_BANDWIDTH)
+    logLR = (np.log(np.maximum(VERY_SMALL_PROBABILITY, posdensity)) -
+             np.log(np.maximum(VERY_SMALL_PROBABILITY, negdensity)))
+
+    cutoffs = find_eqodds_points(logLR, xsamples)
     return {
-        cycle: find_eqodds_point(poscounts[cycle], negcounts[cycle], xsamples)
-        for cycle in cycles_to_try}
+        cycle: (None if np.isnan(cutoff) else float(cutoff))
+        for cycle, cutoff in zip(cycles_to_try.tolist(), cutoffs)}
 
 def infer_missing_cutoffs(cutoffs, allcycles):
     available_cycles = np.array([cycle for cycle, value in cutoffs.items()
@@ -134,10 +190,13 @@ def get_report_marks(direct, inferred):
             r.append('x')
     return ''.join(r)
 
-def calculate_optimal_cutoffs(sigdists, tiles):
+def calculate_optimal_cutoffs(executor, sigdists, tileindex, tiles):
+    tileids = sorted(tile['id'] for tile in tiles)
+    tileidxs = [tileindex[tileid] for tileid in tileids]
+
     # Sum the counts from all tiles
-    postotal = np.array([sigdists[tile['id'], 'pos'] for tile in tiles]).sum(axis=0)
-    negtotal = np.array([sigdists[tile['id'], 'neg'] for tile in tiles]).sum(axis=0)
+    postotal = sigdists[tileidxs, SIGNAL_TYPES.index('pos')].sum(axis=0)
+    negtotal = sigdists[tileidxs, SIGNAL_TYPES.index('neg')].sum(axis=0)
 
     xsamples = np.arange(0, 1, 1 / postotal.shape[1])
 
@@ -146,13 +205,16 @@ def calculate_optimal_cutoffs(sigdists, tiles):
     runwide_cutoffs = find_all_eqodds_point(postotal, negtotal, xsamples)
 
     tile_cutoffs = {}
-    with futures.ProcessPoolExecutor(NUM_THREADS) as executor:
-        for tile in sorted(tiles, key=lambda x: x['id']):
-            poscounts = sigdists[tile['id'], 'pos']
-            negcounts = sigdists[tile['id'], 'neg']
-            job = executor.submit(find_all_eqodds_point, poscounts, negcounts, xsamples)
-            job.add_done_callback(lambda f, tileid=tile['id']:
-                                    tile_cutoffs.__setitem__(tileid, f.result()))
+    if shared_memory is not None:
+        jobs = [executor.submit(find_shared_tile_eqodds_points, tileidx, xsamples)
+                for tileidx in tileidxs]
+    else:
+        jobs = [executor.submit(find_tile_eqodds_points, sigdists[tileidx], xsamples)
+                for tileidx in tileidxs]
+    for tileid, job in zip(tileids, jobs):
+        cutoffs = job.result()
+        tile_cutoffs[tileid] = {cycle: cutoffs[cycle]
+                                for cycle in np.where(~np.isnan(cutoffs))[0].tolist()}
 
     runwide_cutoffs_inferred = infer_missing_cutoffs(runwide_cutoffs, all_cycles)
     cutoff_reports = {runid: get_report_marks(runwide_cutoffs, runwide_cutoffs_inferred)}
@@ -186,19 +248,34 @@ def write_outputs(cutoffs, bases):
             print(tile, basismarks, sep='\t', file=outf)
 
 def main():
-    sigdists = load_all_signal_dists()
-
     tilelist = {}
     for tileinfo in params.tileinfo.values():
         tilelist.setdefault(tileinfo['source'], [])
         tilelist[tileinfo['source']].append(tileinfo)
 
+    shm, sigdists, tileindex = load_all_signal_dists(sorted(params.tileinfo))
+
     cutoffs, bases = {}, {}
 
-    for source, tiles in tilelist.items():
-        tile_cutoffs, tile_bases = calculate_optimal_cutoffs(sigdists, tiles)
-        cutoffs.update(tile_cutoffs)
-        bases.update(tile_bases)
+    try:
+        if shm is not None:
+            executor = futures.ProcessPoolExecutor(NUM_THREADS,
+                            initializer=attach_shared_signal_dists,
+                            initargs=(shm.name, sigdists.shape, sigdists.dtype))
+        else:
+            executor = futures.ProcessPoolExecutor(NUM_THREADS)
+
+        with executor:
+            for source, tiles in tilelist.items():
+                tile_cutoffs, tile_bases = calculate_optimal_cutoffs(
+                        executor, sigdists, tileindex, tiles)
+                cutoffs.update(tile_cutoffs)
+                bases.update(tile_bases)
+    finally:
+        del sigdists
+        if shm is not None:
+            shm.close()
+            shm.unlink()
 
     write_outputs(cutoffs, bases)
 
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+#
+# Importing a tailseeker module must stay cheap, as a new interpreter is
+# started for almost every job. Heavy dependencies are to be imported
+# inside the functions that use them. This script imports each module in
+# a fresh interpreter and fails when it loads more modules than the budget
+# recorded below. The import time is compared with the startup time of a
+# bare interpreter (`python -c pass`) on the same machine, and only warned
+# about as it varies with the load of the host. Run it after touching
+# module-level imports, and update the budget only for a deliberate reason.
+#
+
+import subprocess as sp
+import json
+import time
+import sys
+import os
+
+# module: (number of newly loaded modules, import time in units of the
+#          startup time of a bare interpreter)
+IMPORT_BUDGETS = {
+    'tailseeker.accounting':        (10, 1.0),
+    'tailseeker.configurations':    (50, 6.0),
+    'tailseeker.fileutils':         (55, 6.0),
+    'tailseeker.instrument':        (10, 1.5),
+    'tailseeker.parallel':          (35, 3.0),
+    'tailseeker.parsers':           (55, 5.0),
+    'tailseeker.plotutils':         (190, 20.0),
+    'tailseeker.powersnake':        (35, 3.0),
+    'tailseeker.profiler':          (5, 0.7),
+    'tailseeker.scriptserver':      (20, 2.0),
+    'tailseeker.sequencers':        (5, 0.7),
+    'tailseeker.sequtils':          (5, 1.0),
+    'tailseeker.signals':           (210, 25.0),
+    'tailseeker.stats':             (200, 24.0),
+}
+
+MEASURE_CODE = """\
+import sys, time, json
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([len(set(sys.modules) - before), elapsed * 1000]))
+"""
+
+TAILSEEKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_startup(python, repeat):
+    """Fastest startup time of a bare interpreter in milliseconds."""
+    results = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        sp.check_call([python, '-c', 'pass'])
+        results.append(time.perf_counter() - start)
+
+    return min(results) * 1000
+
+
+def measure_import(python, module, repeat):
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [TAILSEEKER_DIR] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    results = []
+    for i in range(repeat):
+        output = sp.check_output([python, '-c', MEASURE_CODE.format(module=module)],
+                                 env=env, stderr=sp.STDOUT)
+        results.append(json.loads(output.decode().splitlines()[-1]))
+
+    return max(r[0] for r in results), min(r[1] for r in results)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Checks the import-time costs '
+                                                 'of the tailseeker modules.')
+    parser.add_argument('modules', metavar='MODULE', type=str, nargs='*',
+                        help='Modules to check (default: all with a budget).')
+    parser.add_argument('--python', dest='python', metavar='PATH', type=str,
+                        default=sys.executable,
+                        help='Python interpreter to measure with.')
+    parser.add_argument('--repeat', dest='repeat', metavar='N', type=int, default=5,
+                        help='Number of imports to take the fastest of.')
+    options = parser.parse_args()
+
+    return options
+
+
+def main(options):
+    modules = options.modules or sorted(IMPORT_BUDGETS)
+    failures = 0
+
+    baseline = measure_startup(options.python, options.repeat)
+    print('Startup time of the interpreter: {:.1f} msec'.format(baseline))
+    print('{:28s} {:>16s} {:>20s}  {}'.format('module', 'modules/budget',
+                                             'msec/budget', 'status'))
+    for module in modules:
+        if module not in IMPORT_BUDGETS:
+            print('{:28s} no budget recorded.'.format(module))
+            failures += 1
+            continue
+
+        max_modules, max_startups = IMPORT_BUDGETS[module]
+        max_msec = max_startups * baseline
+        try:
+            nmodules, msec = measure_import(options.python, module, options.repeat)
+        except sp.CalledProcessError as exc:
+            print('{:28s} failed to import:\n{}'.format(module, exc.output.decode()))
+            failures += 1
+            continue
+
+        over = nmodules > max_modules
+        slow = msec > max_msec
+        failures += over
+        print('{:28s} {:>7d}/{:<8d} {:>9.1f}/{:<10.1f}  {}'.format(
+              module, nmodules, max_modules, msec, max_msec,
+              'OVER BUDGET' if over else 'WARNING: slow' if slow else 'ok'))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_arguments()))
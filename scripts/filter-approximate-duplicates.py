@@ -23,6 +23,7 @@
 
 from tailseeker.fileutils import ParsedLineComment
 from tailseeker.parsers import parse_sam
+from tailseeker import instrument
 import subprocess as sp
 from collections import deque
 import numpy as np
@@ -50,18 +51,25 @@ def load_duplicates(duplicates_file):
 
 def main(options):
     samproc = sp.Popen([SAMTOOLS_CMD, 'view', '-h', options.bam], stdout=sp.PIPE)
-    duplicates = load_duplicates(options.duplicates_file)
-    output = os.fdopen(sys.stdout.fileno(), 'wb')
+    stage = instrument.stage('filter')
+    with stage.timer('load_duplicates'):
+        duplicates = load_duplicates(options.duplicates_file)
+    merged = stage.counter('merged')
+    retagged = stage.counter('retagged')
+    output = instrument.counting_writer(os.fdopen(sys.stdout.fileno(), 'wb'),
+                                        stage.counter('bytes_written'))
 
     tags_being_processed = [b'ZA', b'Za', b'ZD']
 
-    for row in parse_sam(samproc.stdout):
+    for row in instrument.counted(parse_sam(samproc.stdout), stage.counter('sam_records'),
+                                  stage.counter('bytes_read')):
         if isinstance(row, ParsedLineComment) or row.flag & F_UNMAPPED:
             output.write(row.line)
             # pass unmapped reads and header lines through
             continue
         elif row.qname not in duplicates:
             # skip merged reads
+            merged.add()
             continue
 
         dupinfo = duplicates[row.qname]
@@ -70,6 +78,7 @@ def main(options):
             output.write(row.line)
             continue
 
+        retagged.add()
         samfields = row.line[:-1].split(b'\t')
         samfields = [f for f in samfields if f[:2] not in tags_being_processed]
         samfields.append(b'ZA:i:' + str(dupinfo[0]).encode())
@@ -91,6 +100,9 @@ def parse_arguments():
 
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     options = parse_arguments()
     main(options)
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+# Writes the reads listed in a file of read IDs from the R5 and R3 FASTQ
+# files of a sample in a single pass. The mates are in the same order in
+# both files. The R3 file may be left out to filter the R5 reads only.
+#
+
+from tailseeker.fileutils import open_gzip_pipe, PipedWriter, BGZIP_CMD
+from tailseeker import instrument
+from itertools import islice
+from contextlib import ExitStack
+import numpy as np
+
+BATCH_SIZE = 65536
+
+
+def load_read_ids(filename):
+    """Packs the IDs in `tile:cluster` form into a sorted array of 64-bit
+    keys with the tile numbered in the upper half. Only the first word of
+    each line is taken as in the FASTQ headers of STAR."""
+    tiles = {}
+    keys = []
+    for line in open(filename, 'rb'):
+        words = line.split()
+        if not words:
+            continue
+        tile, cluster = words[0].split(b':', 2)[:2]
+        tileno = tiles.setdefault(tile, len(tiles))
+        keys.append((tileno << 32) | int(cluster))
+
+    keys = np.array(keys, dtype=np.int64)
+    keys.sort()
+    return tiles, keys
+
+
+def read_key(name, tiles):
+    tile, cluster = name[1:].split(None, 1)[0].split(b':', 2)[:2]
+    tileno = tiles.get(tile)
+    if tileno is None:
+        return -1
+    return (tileno << 32) | int(cluster)
+
+
+def read_batches(fastq, size):
+    while True:
+        lines = list(islice(fastq, size * 4))
+        if not lines:
+            break
+        elif len(lines) % 4 != 0:
+            raise ValueError('Truncated FASTQ entry at the end.')
+        yield lines
+
+
+def open_output(filename, options, nfiles):
+    # Uncompressed outputs are for the named pipes read by the aligner.
+    if options.uncompressed:
+        return open(filename, 'wb')
+
+    bgzip_args = [BGZIP_CMD, '-@', str(max(1, options.threads // nfiles)), '-c']
+    return PipedWriter(bgzip_args, filename)
+
+
+def main(options):
+    stage = instrument.stage('filter')
+    with stage.timer('load_ids'):
+        tiles, survivors = load_read_ids(options.read_ids)
+    reads_in = stage.counter('reads_in')
+    reads_out = stage.counter('reads_out')
+
+    paired = options.fastq3 is not None
+    fastq5 = open_gzip_pipe(options.fastq5)
+    if paired:
+        batches3 = read_batches(open_gzip_pipe(options.fastq3), BATCH_SIZE)
+
+    with ExitStack() as outputs:
+        nfiles = 2 if paired else 1
+        output5 = outputs.enter_context(open_output(options.output5, options, nfiles))
+        if paired:
+            output3 = outputs.enter_context(open_output(options.output3, options, nfiles))
+
+        for lines5 in read_batches(fastq5, BATCH_SIZE):
+            if paired:
+                lines3 = next(batches3, [])
+                if len(lines3) != len(lines5) or lines3[::4] != lines5[::4]:
+                    raise ValueError('The reads in {} and {} are not in the same '
+                                     'order.'.format(options.fastq5, options.fastq3))
+
+            keys = np.array([read_key(name, tiles) for name in lines5[::4]],
+                            dtype=np.int64)
+            if len(survivors) > 0:
+                found = survivors[np.minimum(np.searchsorted(survivors, keys),
+                                             len(survivors) - 1)] == keys
+            else:
+                found = np.zeros(len(keys), dtype=bool)
+
+            selected = np.flatnonzero(found)
+            output5.write(b''.join(b''.join(lines5[i * 4:i * 4 + 4]) for i in selected))
+            if paired:
+                output3.write(b''.join(b''.join(lines3[i * 4:i * 4 + 4]) for i in selected))
+
+            reads_in.add(len(keys))
+            reads_out.add(len(selected))
+
+        if paired and next(batches3, None) is not None:
+            raise ValueError('{} has more reads than {}.'.format(options.fastq3,
+                                                                 options.fastq5))
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=
+                            'Filter paired FASTQ files by a list of read IDs')
+    parser.add_argument('--read-ids', dest='read_ids', type=str, required=True,
+                        help='Path to a list of read IDs to keep')
+    parser.add_argument('--fastq5', dest='fastq5', type=str, required=True,
+                        help='Path to the R5 FASTQ file')
+    parser.add_argument('--fastq3', dest='fastq3', type=str,
+                        help='Path to the R3 FASTQ file')
+    parser.add_argument('--output5', dest='output5', type=str, required=True,
+                        help='Path to write the filtered R5 FASTQ file')
+    parser.add_argument('--output3', dest='output3', type=str,
+                        help='Path to write the filtered R3 FASTQ file')
+    parser.add_argument('--threads', dest='threads', type=int, default=2,
+                        help='Number of threads shared by the compressors of the '
+                             'two outputs')
+    parser.add_argument('--uncompressed', dest='uncompressed', action='store_true',
+                        default=False, help='Write the outputs without compression')
+
+    options = parser.parse_args()
+    if (options.fastq3 is None) != (options.output3 is None):
+        parser.error('--fastq3 and --output3 must be given together.')
+
+    return options
+
+
+if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
+    options = parse_arguments()
+    main(options)
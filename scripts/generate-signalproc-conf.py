@@ -24,6 +24,7 @@
 #
 
 from tailseeker.powersnake import *
+from tailseeker.fileutils import intermediate_compression_level
 import os
 import os.path
 
@@ -69,14 +70,23 @@ threep-length = {cv[threep_length]}
 
 
 def generate_options_section(outf):
+    preview = params.conf['preview']
+    maximum_clusters = preview['clusters_per_tile'] if preview['enabled'] else 0
+    compression_level = intermediate_compression_level(
+                            params.conf['performance']['intermediate_compression'])
+
     print("""\
 [options]
 keep-no-delimiter = {of[keep_no_delimiter]:d}
 keep-low-quality-balancer = {of[keep_low_quality_balancer]:d}
 threads = {threads}
+maximum-clusters = {maximum_clusters}
+compression-level = {compression_level}
 read-buffer-size = {pf[maximum_buffer_size]}
 """.format(of=params.conf['output_filtering'], pf=params.conf['performance'],
-           threads=threads), file=outf)
+           threads=threads, maximum_clusters=maximum_clusters,
+           compression_level=-1 if compression_level is None else compression_level),
+      file=outf)
 
 
 def generate_output_section(outf):
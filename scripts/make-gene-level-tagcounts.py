@@ -21,21 +21,27 @@
 # THE SOFTWARE.
 #
 
-from tailseeker import tabledefs
+from tailseeker import tabledefs, instrument
 import pandas as pd
 import numpy as np
 import re
 import lzma
 
 sm = snakemake
+stage = instrument.stage('tagcounts')
 
 print("Loading required tables...")
-assoctbl = pd.read_table(sm.input.associations, **tabledefs.associations)
-taginfotbl = pd.read_table(sm.input.taginfo, **tabledefs.refined_taginfo)
+with stage.timer('load'):
+    assoctbl = pd.read_table(sm.input.associations, **tabledefs.associations)
+    taginfotbl = pd.read_table(sm.input.taginfo, **tabledefs.refined_taginfo)
+stage.counter('association_records').add(len(assoctbl))
+stage.counter('taginfo_records').add(len(taginfotbl))
 
 print("Joining tables...")
-tbl = pd.merge(assoctbl, taginfotbl, how='inner', left_on=['tile', 'cluster'],
-               right_on=['tile', 'cluster'])
+with stage.timer('join'):
+    tbl = pd.merge(assoctbl, taginfotbl, how='inner', left_on=['tile', 'cluster'],
+                   right_on=['tile', 'cluster'])
+stage.counter('joined').add(len(tbl))
 
 min_preamble_length = sm.params.delim_settings[0] - 1 + len(sm.params.delim_settings[1]) - 1
 max_polya = sm.params.R3[1] - sm.params.R3[0] + 1 - min_preamble_length
@@ -65,10 +71,15 @@ if sm.wildcards.ambigtype == 'single':
 filtered_tbl = tbl[(tbl['pflags'] & sm.params.bad_flags) == 0]
 del tbl
 
+genes_counted = stage.counter('genes')
+tags_counted = stage.counter('tags')
+
 def write_tagcounts(output, tbl, polya_axis, modcount_axis):
     counts_dfs = {}
     groups = tbl.groupby('gene')
     for i, (geneid, tags) in enumerate(groups):
+        genes_counted.add()
+        tags_counted.add(len(tags))
         if i % 100 == 0:
             print(" - Processing genes... ({0}/{1})     \r".format(i, len(groups)), end='')
         tagcounts = tags.groupby(['polyA', mod_of_interest]).agg('count').reset_index()
@@ -79,8 +90,9 @@ def write_tagcounts(output, tbl, polya_axis, modcount_axis):
         counts_dfs[geneid] = countsgrid
 
     print("\n - Writing to a file.")
-    counts_dfs = pd.Panel(counts_dfs)
-    counts_dfs.to_msgpack(lzma.open(output, 'wb'))
+    with stage.timer('write'):
+        counts_dfs = pd.Panel(counts_dfs)
+        counts_dfs.to_msgpack(lzma.open(output, 'wb'))
 
 
 # Intact poly(A) tails
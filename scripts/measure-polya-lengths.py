@@ -26,46 +26,99 @@
 from tailseeker.powersnake import *
 from snakemake.shell import shell
 from snakemake.utils import format
-from tailseeker.fileutils import TemporaryDirectory
+from tailseeker.fileutils import TemporaryDirectory, intermediate_bgzip_options
+from tailseeker.signals import load_sigdists, write_sigdists
 import numpy as np
-import struct
-import gzip
+import shutil
+import sys
+import os
 
 BINDIR = params.BINDIR
 BGZIP_CMD = params.BGZIP_CMD
 CONF = params.CONF
+BGZIP_OPT = intermediate_bgzip_options(CONF['performance']['intermediate_compression'])
 
-def load_sig_dists(filename):
-    inpf = gzip.open(filename, 'rb')
-    elemsize, cycles, bins = struct.unpack('<III', inpf.read(12))
-    assert elemsize == 4
+def load_score_cutoffs(filename):
+    cutoffs = {}
+    for line in open(filename):
+        fields = line.rstrip('\t\r\n').split('\t')
+        cutoffs[fields[0]] = np.array(fields[1:], dtype=np.float64)
+    return cutoffs
 
-    counts = np.fromstring(inpf.read(), np.uint32).reshape((cycles, bins))
-    return counts.astype(np.uint64)
+def score_cutoffs_converged(current, previous, tolerance):
+    if set(current) != set(previous):
+        return False
 
-def write_sig_dists(counts, filename):
-    with gzip.open(filename, 'wb') as outf:
-        outf.write(struct.pack('<III', 4, counts.shape[0], counts.shape[1]))
-        outf.write(counts.astype(np.uint32).tostring())
+    for tile, cutoffs in current.items():
+        prevcutoffs = previous[tile]
+        if (cutoffs.shape != prevcutoffs.shape or
+                not np.array_equal(np.isnan(cutoffs), np.isnan(prevcutoffs))):
+            return False
 
-counts_aggr = None
+        determined = ~np.isnan(cutoffs)
+        if np.any(np.abs(cutoffs[determined] - prevcutoffs[determined]) > tolerance):
+            return False
 
-for signals, taginfo, out in zip(input.signals, input.taginfo,
-                                 output.taginfo):
+    return True
+
+def promote_file(source, destination):
+    if os.path.exists(destination):
+        os.unlink(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def promote_previous_round():
+    for prevtaginfo, out in zip(input.prev_taginfo, output.taginfo):
+        promote_file(prevtaginfo, out)
+    promote_file(input.prev_sigdists[0], output.sigdists)
+
+def run_polya_ruler_on_sample(signals, taginfo, out, sigdists):
     cmd = format('{BINDIR}/tailseq-polya-ruler {wildcards.tile} {signals} \
         {input.score_cutoffs} {CONF[polyA_finder][signal_analysis_trigger]} \
         {CONF[polyA_ruler][downhill_extension_weight]} \
         {taginfo} {CONF[polyA_seeder][dist_sampling_bins]} \
         {CONF[polyA_ruler][signal_resampling_gap]} \
-        {output.sigdists} | {BGZIP_CMD} -c > {out}', wildcards=wildcards,
+        {sigdists} | {BGZIP_CMD} {BGZIP_OPT} -c > {out}', wildcards=wildcards,
         input=input, output=output)
     shell(cmd)
 
-    counts_new = load_sig_dists(output.sigdists)
-    if counts_aggr is None:
-        counts_aggr = counts_new
-    else:
-        counts_aggr += counts_new
+    return load_sigdists(sigdists).astype(np.uint64)
+
+def run_polya_ruler():
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Each ruler writes its own partial distributions, which are summed up
+    # in memory and written out only once.
+    with TemporaryDirectory() as tmpdir, \
+            ThreadPoolExecutor(max(1, min(threads, len(output.taginfo)))) as executor:
+        jobs = []
+        for i, (signals, taginfo, out) in enumerate(zip(input.signals, input.taginfo,
+                                                        output.taginfo)):
+            partial = os.path.join(tmpdir, '{}.sigdists'.format(i))
+            jobs.append(executor.submit(run_polya_ruler_on_sample, signals,
+                                        taginfo, out, partial))
+
+        counts_aggr = None
+        for job in jobs:
+            counts_new = job.result()
+            if counts_aggr is None:
+                counts_aggr = counts_new
+            else:
+                counts_aggr += counts_new
+
+    write_sigdists(counts_aggr, output.sigdists)
 
-write_sig_dists(counts_aggr, output.sigdists)
 
+# The cutoffs used in this round barely differ from those used in the
+# previous round. Re-measuring would reproduce the previous outputs.
+if input.prev_score_cutoffs and score_cutoffs_converged(
+        load_score_cutoffs(input.score_cutoffs),
+        load_score_cutoffs(input.prev_score_cutoffs[0]),
+        CONF['polyA_ruler']['signal_resampling_tolerance']):
+    print('Score cutoffs have converged. Reusing the outputs from the previous '
+          'round for tile {}.'.format(wildcards.tile), file=sys.stderr)
+    promote_previous_round()
+else:
+    run_polya_ruler()
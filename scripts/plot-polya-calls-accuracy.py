@@ -23,7 +23,7 @@
 # - Hyeshik Chang <hyeshik@snu.ac.kr>
 #
 
-from tailseeker.plotutils import colormap_lch
+from tailseeker.plotutils import colormap_lch, add_figure_label
 from tailseeker import stats
 from functools import partial
 import pandas as pd
@@ -46,28 +46,35 @@ def load_stats(options, controlsamples):
     dists = (patbl.cumsum(axis=0) / patbl.sum(axis=0))[[c for c, s in controlsamples]]
     dists.index = xtransform(np.array(dists.index))
 
-    for sample, explength in controlsamples:
-        polyadist = patbl[sample]
-        polyadist_clipped = patbl[sample].iloc[1:].copy()
-        polyadist_clipped.iloc[0] += polyadist.iloc[0]
+    samples = [sample for sample, explength in controlsamples]
+    explengths = [explength for sample, explength in controlsamples]
 
+    polyadists = patbl[samples]
+    polyadists_clipped = polyadists.iloc[1:].copy()
+    polyadists_clipped.iloc[0] += polyadists.iloc[0]
+
+    descstats = stats.weighted_stats_2d(polyadists, centers=explengths)
+    descstats.loc['geomean'] = stats.weighted_geomean_2d(polyadists_clipped)
+
+    for sample in samples:
+        s = descstats[sample]
         res_stats[sample] = {
-            '10thpct': stats.weighted_quantile(polyadist, 0.1),
-            '1Q': stats.weighted_quantile(polyadist, 0.25),
-            'median': stats.weighted_median(polyadist),
-            '3Q': stats.weighted_quantile(polyadist, 0.75),
-            '90thpct': stats.weighted_quantile(polyadist, 0.9),
-            'arimean': stats.weighted_mean(polyadist),
-            'geomean': stats.weighted_geomean(polyadist_clipped),
-            'mode': stats.weighted_mode(polyadist),
-            'rmse': stats.weighted_rmse(polyadist, explength),
-            'mae': stats.weighted_mae(polyadist, explength),
+            '10thpct': s[0.1],
+            '1Q': s[0.25],
+            'median': s[0.5],
+            '3Q': s[0.75],
+            '90thpct': s[0.9],
+            'arimean': s['mean'],
+            'geomean': s['geomean'],
+            'mode': s['mode'],
+            'rmse': s['rmse'],
+            'mae': s['mae'],
         }
 
     return dists, res_stats
 
 
-def plot_dists(outpath, dists, controlsamples):
+def plot_dists(outpath, dists, controlsamples, label=None):
     from matplotlib import style
 
     style.use('ggplot')
@@ -96,6 +103,7 @@ def plot_dists(outpath, dists, controlsamples):
     ax.set_xticklabels(xticks_disp)
 
     plt.setp(ax.get_xgridlines() + ax.get_ygridlines(), color='#e0e0e0')
+    add_figure_label(fig, label)
 
     plt.tight_layout()
 
@@ -139,6 +147,8 @@ def parse_arguments():
                         default=None, help='Path to a PDF file')
     parser.add_argument('--output-stats', dest='output_stats', metavar='FILE', type=str,
                         default=None, help='Path to a CSV file')
+    parser.add_argument('--label', dest='label', metavar='TEXT', type=str,
+                        default=None, help='Note to print at the corner of the plot')
 
     options = parser.parse_args()
 
@@ -151,6 +161,9 @@ def parse_arguments():
 
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     import pickle
 
     options, controlsamples = parse_arguments()
@@ -158,7 +171,7 @@ if __name__ == '__main__':
     dists, stats = load_stats(options, controlsamples)
 
     if options.output_plot is not None:
-        plot_dists(options.output_plot, dists, controlsamples)
+        plot_dists(options.output_plot, dists, controlsamples, options.label)
 
     if options.output_stats is not None:
         write_descriptive_stats(options.output_stats, stats, controlsamples)
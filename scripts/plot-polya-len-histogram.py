@@ -24,7 +24,7 @@
 #
 
 from tailseeker.stats import gaussian_kde
-from tailseeker.plotutils import apply_dropped_spine, colormap_lch
+from tailseeker.plotutils import apply_dropped_spine, colormap_lch, add_figure_label
 import pandas as pd
 import numpy as np
 
@@ -35,6 +35,7 @@ MINIMUM_POLYA_LEN = snakemake.params.minimum_polya_length
 KDE_BANDWIDTH = snakemake.params.kde_bandwidth
 XSCALE_TRANSFORM_FACTOR = snakemake.params.x_transform_factor
 EXCLUDE_SAMPLES = snakemake.params.exclude
+FIGURE_LABEL = getattr(snakemake.params, 'label', None)
 
 xticks = pd.Series([5] + list(np.arange(10, 100, 10)) + list(np.arange(100, 500, 25)))
 
@@ -52,7 +53,8 @@ xticks = xticks[(xticks >= polyacounts.index[0]) & (xticks <= polyacounts.index[
 for (name, columns), color in zip(polyacounts.items(),
                                   colormap_lch(polyacounts.shape[1])):
     kde = gaussian_kde(columns.index ** XSCALE_TRANSFORM_FACTOR,
-                       bw_method=KDE_BANDWIDTH, weights=columns.tolist())
+                       bw_method=KDE_BANDWIDTH, weights=columns.tolist(),
+                       method='binned')
     ax.plot(xpositions, kde(xpositions) * 100, c=color, label=name)
 
 apply_dropped_spine(ax, xgrid=True)
@@ -63,6 +65,8 @@ ax.set_xticks(xticks ** XSCALE_TRANSFORM_FACTOR)
 ax.set_xticklabels(xticks)
 ax.legend(fontsize=10, loc='best')
 
+add_figure_label(fig, FIGURE_LABEL)
+
 plt.subplots_adjust(bottom=.22, right=.95)
 
 plt.savefig(snakemake.output[0])
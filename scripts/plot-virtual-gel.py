@@ -24,6 +24,7 @@
 #
 
 from tailseeker.stats import gaussian_kde
+from tailseeker.plotutils import add_figure_label
 from itertools import chain
 import pandas as pd
 import numpy as np
@@ -124,7 +125,7 @@ def plot(tagcounts, controlsamples, expsamples, min_polya_len,
         name: gaussian_kde(
                 list(size2phys(np.array(cnts.index))),
                 weights=list(cnts),
-                bw_method=kde_bandwidth)(vpositions)
+                bw_method=kde_bandwidth, method='binned')(vpositions)
         for name, cnts in tagcounts_pa.items()}, index=vpositions)
 
     # Construct the image and plot it.
@@ -173,6 +174,7 @@ def run(options, controlsamples, expsamples):
     fig = plot(tagcounts, controlsamples, expsamples, options.min_polya_len,
                options.normalize_by_total_tags, options.merge_controls,
                options.kde_bandwidth, options.width, options.height)
+    add_figure_label(fig, options.label)
 
     plt.savefig(options.output_plot, dpi=200)
 
@@ -196,6 +198,8 @@ def parse_arguments():
                         default=6., help='Height of the full image (in inches)')
     parser.add_argument('--output-plot', dest='output_plot', metavar='FILE', type=str,
                         required=True, help='Output path of the resulting gel image')
+    parser.add_argument('--label', dest='label', metavar='TEXT', type=str,
+                        default=None, help='Note to print at the corner of the image')
     parser.add_argument('--by-total-tag-counts', dest='normalize_by_total_tags',
                         action='store_true', default=False,
                         help='Normalize tag counts by total (default: by poly(A)+ tags)')
@@ -217,6 +221,9 @@ def parse_arguments():
 
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     import pickle
 
     options, controlsamples, expsamples = parse_arguments()
@@ -27,9 +27,11 @@ from tailseeker.parsers import parse_sam, parse_taginfo, parse_fastq
 from tailseeker.fileutils import MultiJoinIterator, TemporaryDirectory
 from tailseeker.sequtils import reverse_complement_bytes, GiantFASTAFile
 from tailseeker.parallel import open_tabix_parallel
+from tailseeker import instrument
 from concurrent import futures
 from scipy.stats import binom_test
 import subprocess as sp
+import json
 import sys
 import os
 import re
@@ -198,9 +200,15 @@ def process_tile(options, tile, taginfo_input, output):
     # open the reference database
     refgenome = GiantFASTAFile(options.refseq_fasta)
 
+    stage = instrument.stage('refine:' + tile)
+    joined = stage.counter('joined')
+    reevaluation = stage.timer('reevaluation')
+
     # parsing iterators
-    samit = parse_sam(readerproc.stdout)
-    taginfoit = parse_taginfo(taginfo_input())
+    samit = instrument.counted(parse_sam(readerproc.stdout), stage.counter('sam_records'),
+                               stage.counter('bytes_read'))
+    taginfoit = instrument.counted(parse_taginfo(taginfo_input()),
+                                   stage.counter('taginfo_records'))
 
     # key functions for joiner
     def parse_readid_from_sam(samrow):
@@ -216,16 +224,18 @@ def process_tile(options, tile, taginfo_input, output):
     required_A = calculate_required_A_in_polyA(options.reev_cprob, 0.95, 100)
     rescue_threshold = options.rescue_threshold
 
-    outfile = open(output, 'w')
+    outfile = instrument.counting_writer(open(output, 'w'), stage.counter('bytes_written'))
 
     for (tile, cluster), samrows, taginforows in joined_it:
         samrows = list(samrows)
         if len(samrows) == 0:
             continue # may filtered out by the contaminant filter.
 
-        taginfo, cigar, nontmplmods, rflags = reevaluate_terminal_additions(
-                samrows, taginforows, refgenome, options.fragsize,
-                options.termaln_check)
+        joined.add()
+        with reevaluation:
+            taginfo, cigar, nontmplmods, rflags = reevaluate_terminal_additions(
+                    samrows, taginforows, refgenome, options.fragsize,
+                    options.termaln_check)
 
         if taginfo.polyA > polya_noreev_threshold:
             polyA_len = taginfo.polyA
@@ -256,25 +266,120 @@ def process_tile(options, tile, taginfo_input, output):
               taginfo.polyA, reev_mods['A'], taginfo.mods.decode(),
               nontmplmods, sep='\t', file=outfile)
 
+    outfile.close()
+    instrument.flush()
+
     return output
 
 
+class TileCheckpoints(object):
+    """Outputs of finished tiles kept in a directory to resume an interrupted
+    run. A tile is recorded in the manifest only after its output is moved
+    to the final name. The records are discarded when the inputs or the
+    options differ from those of the run that wrote them."""
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, checkpoint_dir, signature):
+        self.dir = checkpoint_dir
+        self.signature = signature
+        self.tiles = {}
+
+        os.makedirs(self.dir, exist_ok=True)
+        try:
+            manifest = json.load(open(os.path.join(self.dir, self.MANIFEST)))
+        except (OSError, ValueError):
+            manifest = None
+
+        if manifest is not None and manifest.get('signature') == signature:
+            self.tiles = {tile: size for tile, size in manifest['tiles'].items()
+                          if self.is_intact(tile, size)}
+
+    def path(self, tile):
+        return os.path.join(self.dir, tile + '.txt')
+
+    def partial_path(self, tile):
+        return os.path.join(self.dir, tile + '.partial')
+
+    def is_intact(self, tile, size):
+        try:
+            return os.path.getsize(self.path(tile)) == size
+        except OSError:
+            return False
+
+    def is_done(self, tile):
+        return tile in self.tiles
+
+    def commit(self, tile, partial):
+        with open(partial, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(partial, self.path(tile))
+        self.tiles[tile] = os.path.getsize(self.path(tile))
+        self.write_manifest()
+        return self.path(tile)
+
+    def write_manifest(self):
+        tmpfile = os.path.join(self.dir, self.MANIFEST + '.tmp')
+        with open(tmpfile, 'w') as outf:
+            json.dump({'signature': self.signature, 'tiles': self.tiles}, outf)
+            outf.flush()
+            os.fsync(outf.fileno())
+        os.replace(tmpfile, os.path.join(self.dir, self.MANIFEST))
+
+
+def checkpoint_signature(options):
+    inputs = []
+    for filename in [options.taginfo, options.aln, options.refseq_fasta]:
+        st = os.stat(filename)
+        inputs.append([os.path.abspath(filename), st.st_size, st.st_mtime_ns])
+
+    return {
+        'inputs': inputs,
+        'options': [options.fragsize, options.termaln_check, options.maxpolyareev,
+                    options.reev_cprob, options.rescue_threshold],
+    }
+
+
 def process(options):
     taginfo_inputs = open_tabix_parallel(options.taginfo, named=True)
 
+    if options.checkpoint_dir:
+        checkpoints = TileCheckpoints(options.checkpoint_dir, checkpoint_signature(options))
+        if checkpoints.tiles:
+            print('Resuming with {} finished tiles from {}.'.format(
+                  len(checkpoints.tiles), options.checkpoint_dir), file=sys.stderr)
+    else:
+        checkpoints = None
+
     with futures.ProcessPoolExecutor(options.parallel) as executor, \
             TemporaryDirectory(asobj=True) as workdir:
         jobs = []
 
         for tile, taginfo_open in sorted(taginfo_inputs.items()):
-            joboutput = os.path.join(workdir.path, tile)
+            if checkpoints is None:
+                joboutput = os.path.join(workdir.path, tile)
+            elif checkpoints.is_done(tile):
+                continue
+            else:
+                joboutput = checkpoints.partial_path(tile)
+
             job = executor.submit(process_tile, options, tile, taginfo_open, joboutput)
-            jobs.append(job)
+            jobs.append((tile, job))
 
-        for j in jobs:
-            joboutput = j.result()
-            sp.check_call(['cat', joboutput], stdout=sys.stdout)
-            os.unlink(joboutput)
+        if checkpoints is None:
+            for tile, j in jobs:
+                joboutput = j.result()
+                sp.check_call(['cat', joboutput], stdout=sys.stdout)
+                os.unlink(joboutput)
+        else:
+            # Record the tiles as soon as they finish, and write them out in
+            # the order of tiles at the end.
+            tiles = {job: tile for tile, job in jobs}
+            for j in futures.as_completed(tiles):
+                checkpoints.commit(tiles[j], j.result())
+
+            for tile in sorted(taginfo_inputs):
+                sp.check_call(['cat', checkpoints.path(tile)], stdout=sys.stdout)
 
 
 def parse_arguments():
@@ -310,10 +415,17 @@ def parse_arguments():
                         help='Length of A-stretches at the 3\'-end that enforces A length '
                              'measurement even though the untemplated tailing as whole is '
                              'contaminanted by other type of tails.')
+    parser.add_argument('--checkpoint-dir', dest='checkpoint_dir', metavar='DIR',
+                        type=str, default=None,
+                        help='Directory to keep the outputs of finished tiles in, '
+                             'to resume from when run again after an interruption.')
     options = parser.parse_args()
 
     return options
 
 if __name__ == '__main__':
+    from tailseeker import profiler
+    profiler.start_profiler()
+
     options = parse_arguments()
     process(options)
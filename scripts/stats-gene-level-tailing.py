@@ -27,7 +27,7 @@ import pandas as pd
 import numpy as np
 import lzma
 from scipy.stats import t as stats_t
-from tailseeker.stats import weighted_median
+from tailseeker.stats import weighted_median_2d
 from operator import itemgetter
 
 
@@ -89,7 +89,7 @@ class TailGroupSummarizer:
             'polyA_tag_count': polyA_tag_count,
             'polyA_mean_ci_lo': mean_pa_packed.apply(itemgetter(2)),
             'polyA_mean_ci_hi': mean_pa_packed.apply(itemgetter(3)),
-            'polyA_median': cnt_by_pa.apply(weighted_median),
+            'polyA_median': weighted_median_2d(cnt_by_pa),
             'nonpolyA_tag_count': nonpolyA_tag_count,
             'noncanonical_tag_count': noncanonical_tag_count,
             'total_tag_count': polyA_tag_count + nonpolyA_tag_count + noncanonical_tag_count,
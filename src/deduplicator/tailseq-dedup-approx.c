@@ -782,9 +782,10 @@ get_bam_umi_length(samFile *samf, bam_hdr_t *header)
     if (aln == NULL)
         return -1;
 
-    if (sam_read1(samf, header, aln) < 0) {
+    r = sam_read1(samf, header, aln);
+    if (r < 0) {
         bam_destroy1(aln);
-        return -1;
+        return (r == -1 ? -2 : -1); /* -2 for a file without alignments */
     }
 
     umiseq_aux = bam_aux_get(aln, "ZM");
@@ -895,7 +896,16 @@ load_sam_targets_count(struct taskpool *pool)
     }
 
     pool->umi_length = get_bam_umi_length(samf, header);
-    if (pool->umi_length < 0) {
+    if (pool->umi_length == -2) {
+        /* Nothing to do with an empty shard of alignments. */
+        pool->tid_max = -1;
+        pool->target_lengths = NULL;
+        hts_idx_destroy(bamidx);
+        bam_hdr_destroy(header);
+        sam_close(samf);
+        return 0;
+    }
+    else if (pool->umi_length < 0) {
         fprintf(stderr, "ERROR: Can't verify the length of UMI from from %s.\n",
                 pool->bam_filename);
         return -1;
@@ -935,6 +945,9 @@ main(int argc, char *argv[])
     if (load_sam_targets_count(&tasks) < 0)
         return 101;
 
+    if (tasks.tid_max < 0)
+        return 0;
+
     {
         pthread_t threads[nthreads];
         int i;
@@ -24,6 +24,22 @@
  * - Hyeshik Chang <hyeshik@snu.ac.kr>
  */
 
+/*
+ * Perfect duplicates are the tags sharing the same UMI. Tile taginfo files
+ * are already sorted by cluster number, so they are read one after another
+ * in the (tile, cluster) order, with only one of them open at a time, and
+ * every tag gets a sequence number in that order. The duplicate groups are
+ * collected in a hash table keyed on UMI, which holds only the tags with
+ * the best priority in each group. When the table grows
+ * beyond the memory limit, it is spilled into partitions of the UMI hash
+ * space on disk, and the remaining tags are partitioned likewise. Each
+ * partition is then deduplicated in memory.
+ *
+ * The representatives of the groups are recorded with their sequence
+ * numbers, and the input files are read once again to write them out in
+ * the original order. No global sorting of the tags is needed.
+ */
+
 #include <stdio.h>
 #include <stdlib.h>
 #include <errno.h>
@@ -31,16 +47,24 @@
 #include <inttypes.h>
 #include <math.h>
 #include <assert.h>
+#include <unistd.h>
+#include <getopt.h>
+#include <zlib.h>
 #include <htslib/bgzf.h>
 #include "../sigproc-flags.h"
 #include "../utils.h"
 
-#define DEFAULT_BUFFER_SIZE     2048
 #define MAX_TILENAME_LEN        63
 #define MAX_MODIFICATION_LEN    50
 #define MAX_UMI_LEN             50
 #define MAX_LINE_LEN            511
-#define BUFFER_EXPANSION_FACTOR 1.5
+#define MAX_TILES               65535
+#define DEFAULT_MEMORY_LIMIT    ((size_t)2 << 30)
+#define DEFAULT_PARTITIONS      64
+#define INITIAL_TABLE_SIZE      (1 << 16)
+#define INITIAL_GROUP_CAPACITY  2
+#define TABLE_MAX_LOAD          0.7
+#define NO_GROUP                UINT64_MAX
 
 struct TagInfo {
     char line[MAX_LINE_LEN+1];
@@ -57,31 +81,86 @@ struct TagInfo {
     size_t umi_len;
 };
 
-struct TagInfoQueue { /* a circular queue */
-    struct TagInfo *el;
+struct TagInfoSource {
+    gzFile fp;
+    const char *filename;
+    int lineno;
+    struct TagInfo current;
+};
 
-    ssize_t size;
-    ssize_t front;
-    ssize_t rear;
+struct TagInfoReader {  /* reads the tile files one after another */
+    char **filenames;   /* in the order of their first tags */
+    int nfiles;
+    int next_file;
+    struct TagInfoSource source;
+    char last_tilename[MAX_TILENAME_LEN+1];
+    int last_clusterno;
+    uint64_t next_seq;
+};
 
+struct DupMember {
+    uint64_t seq;
+    int32_t clusterno;
+    int16_t polyA_len;
+    uint16_t tile;
+};
+
+struct DupGroup {
+    uint64_t id;
     int num_duplicates;
     int highest_priority;
+    int nmembers;
+    int capacity;
+    struct DupMember *members;
+    char umi[];
+};
 
-    BGZF *traceout;
-    uint64_t next_group;
+struct SpilledTag {
+    uint64_t seq;
+    uint64_t group_id;
+    int32_t clusterno;
+    int32_t extra_duplicates;
+    int32_t priority;
+    int16_t polyA_len;
+    uint16_t tile;
+    char umi[MAX_UMI_LEN+1];
 };
 
+struct Representative {
+    uint64_t seq;
+    int32_t num_duplicates;
+    int32_t polyA_len;
+};
+
+struct RepresentativeSource {
+    FILE *fp;
+    struct Representative current;
+};
+
+struct Deduplicator {
+    struct DupGroup **slots;
+    size_t table_size;
+    size_t table_count;
+    size_t memory_used;
+    size_t memory_limit;
 
-#define tqueue_length(q)    (((q)->front + (q)->size - (q)->rear) % (q)->size)
-#define tqueue_head(q)      ((q)->el[(q)->front])
-#define tqueue_tail(q)      ((q)->el[(q)->rear])
-#define tqueue_next(q, eln) ((eln + 1) % (q)->size)
-#define tqueue_inc(q)       do { (q)->front = tqueue_next((q), (q)->front); } while(0)
-#define tqueue_dec(q)       do { (q)->rear = tqueue_next((q), (q)->rear); } while(0)
-#define tqueue_isempty(q)   ((q)->front == (q)->rear)
-#define tqueue_isfull(q)    (tqueue_length(q) == (q)->size - 1)
-#define tqueue_foreach(q, v) for ((v) = (q)->rear; (v) != (q)->front; (v) = tqueue_next((q), (v)))
-#define tqueue_empty(q)     do { (q)->rear = (q)->front; } while(0)
+    char *tilenames[MAX_TILES];
+    int ntiles;
+    int last_tile;
+
+    const char *tmpdir;
+    int npartitions;
+    FILE **partitions;      /* NULL unless the table has been spilled */
+
+    struct Representative *reps;
+    size_t nreps;
+    size_t reps_size;
+    FILE **repfiles;
+    int nrepfiles;
+
+    BGZF *traceout;
+    uint64_t next_group;
+};
 
 
 static inline int
@@ -104,115 +183,6 @@ calculate_tag_prority(int flags)
 #undef NOTSET
 }
 
-static struct TagInfoQueue *
-tqueue_new(ssize_t size)
-{
-    struct TagInfoQueue *queue;
-
-    queue = malloc(sizeof(struct TagInfoQueue));
-    if (queue == NULL)
-        return NULL;
-
-    queue->el = calloc(size, sizeof(struct TagInfo));
-    if (queue->el == NULL) {
-        free(queue);
-        return NULL;
-    }
-
-    queue->size = size;
-    queue->front = 0;
-    queue->rear = 0;
-    queue->num_duplicates = 0;
-    queue->highest_priority = -1;
-    queue->traceout = NULL;
-    queue->next_group = 0;
-
-    return queue;
-}
-
-static void
-tqueue_free(struct TagInfoQueue *queue)
-{
-    free(queue->el);
-    if (queue->traceout != NULL)
-        bgzf_close(queue->traceout);
-    free(queue);
-}
-
-static int
-tqueue_expand(struct TagInfoQueue *queue, float factor)
-{
-    ssize_t newsize, wptr, rptr;
-    struct TagInfo *newel;
-
-    newsize = (ssize_t)(queue->size * factor);
-    newel = calloc(newsize, sizeof(struct TagInfo));
-    if (newel == NULL)
-        return -1;
-
-    wptr = 0;
-    tqueue_foreach(queue, rptr)
-        memcpy(&newel[wptr++], &queue->el[rptr], sizeof(struct TagInfo));
-
-    assert(wptr == tqueue_length(queue));
-
-    free(queue->el);
-    queue->el = newel;
-    queue->size = newsize;
-    queue->rear = 0;
-    queue->front = wptr;
-
-    return 0;
-}
-
-static int
-tqueue_append(struct TagInfoQueue *queue)
-{
-    /* The new entry to be appended is passed as located at the front pointer. */
-    struct TagInfo *current;
-    int tagprio;
-
-    current = &tqueue_head(queue);
-    tagprio = calculate_tag_prority(current->flags);
-
-    if (tqueue_isempty(queue) || tagprio > queue->highest_priority) {
-        if (queue->traceout != NULL) {
-            /* print out the suboptimal tags */
-            ssize_t ptr;
-            tqueue_foreach(queue, ptr) {
-                struct TagInfo *taginfo=&queue->el[ptr];
-                bgzf_printf(queue->traceout, "%s\t%d\t%" PRIu64 "\t-3\n",
-                            taginfo->tilename, taginfo->clusterno,
-                            queue->next_group);
-            }
-        }
-        tqueue_empty(queue);
-        tqueue_inc(queue);
-        queue->highest_priority = tagprio;
-        queue->num_duplicates++;
-        return 0;
-    }
-
-    if (tqueue_isfull(queue) &&
-            tqueue_expand(queue, BUFFER_EXPANSION_FACTOR) < 0)
-        return -1;
-
-    queue->num_duplicates++;
-    if (tagprio >= queue->highest_priority) {
-        tqueue_inc(queue);
-        queue->highest_priority = tagprio;
-    }
-    else if (queue->traceout != NULL) { /* print out the suboptimal tag */
-        /* the elements may have re-allocated for the expansion. */
-        current = &tqueue_head(queue);
-        bgzf_printf(queue->traceout, "%s\t%d\t%" PRIu64 "\t-3\n",
-                    current->tilename, current->clusterno,
-                    queue->next_group);
-    }
-
-    return 0;
-}
-
 static inline int
 parse_line(struct TagInfo *taginfo)
 {
@@ -224,25 +194,27 @@ parse_line(struct TagInfo *taginfo)
     if (pos == NULL)
         return -1;
     length = (size_t)(pos - taginfo->line);
+    if (length > MAX_TILENAME_LEN)
+        return -1;
     memcpy(taginfo->tilename, taginfo->line, length);
     taginfo->tilename[length] = '\0';
 
     /* Locate cluster number and parse it */
     start = pos + 1;
     taginfo->clusterno = strtoul(start, &pos, 10);
-    if (pos == NULL)
+    if (pos == start)
         return -1;
 
     /* Locate flags and parse it */
     start = pos + 1;
     taginfo->flags = strtol(start, &pos, 10);
-    if (pos == NULL)
+    if (pos == start)
         return -1;
 
     /* Locate poly(A) length and parse it */
     start = pos + 1;
     taginfo->polyA_len = strtol(start, &pos, 10);
-    if (pos == NULL)
+    if (pos == start)
         return -1;
 
     /* Locate 3' end modification sequence and copy */
@@ -251,20 +223,21 @@ parse_line(struct TagInfo *taginfo)
     if (pos == NULL)
         return -1;
     length = (size_t)(pos - start);
+    if (length > MAX_MODIFICATION_LEN)
+        return -1;
     if (length > 0)
         memcpy(taginfo->modifications, start, length);
     taginfo->modifications[length] = '\0';
     taginfo->modification_len = length;
 
-    /* Trim the UMI from the input buffer as we'll append a new column to the lines. */
-    *pos = '\0';
-
     /* Locate UMI sequence and copy */
     start = pos + 1;
     pos = strchr(start, '\n');
     if (pos == NULL)
         return -1;
     length = (size_t)(pos - start);
+    if (length > MAX_UMI_LEN)
+        return -1;
     if (length > 0)
         memcpy(taginfo->umi, start, length);
     taginfo->umi[length] = '\0';
@@ -274,143 +247,911 @@ parse_line(struct TagInfo *taginfo)
 }
 
 
+/* Sequential reading of the input files. The tiles are disjoint between
+ * the files, so the files are read one at a time in the order of their
+ * first tags instead of keeping all of them open. */
+
 static int
-process_tag_duplicates(struct TagInfoQueue *queue)
+source_advance(struct TagInfoSource *src)
 {
-    ssize_t ptr, length;
+    int errnum;
 
-    length = tqueue_length(queue);
-    if (length == 0)
+    if (gzgets(src->fp, src->current.line, sizeof(src->current.line)) == NULL) {
+        gzerror(src->fp, &errnum);
+        if (errnum != Z_OK && errnum != Z_STREAM_END) {
+            fprintf(stderr, "ERROR: Failed to read %s.\n", src->filename);
+            return -1;
+        }
         return 0;
+    }
 
-    if (length == 1) {
-        printf("%s\t%d\n", tqueue_tail(queue).line, queue->num_duplicates);
-        if (queue->traceout != NULL) {
-            struct TagInfo *taginfo=&tqueue_tail(queue);
-            bgzf_printf(queue->traceout, "%s\t%d\t%" PRIu64 "\t%d\n", taginfo->tilename,
-                        taginfo->clusterno, queue->next_group++, taginfo->polyA_len);
+    src->lineno++;
+    if (parse_line(&src->current) < 0) {
+        fprintf(stderr, "ERROR: Could not parse line %d of %s: %s",
+                src->lineno, src->filename, src->current.line);
+        return -1;
+    }
+
+    return 1;
+}
+
+static int
+source_open(struct TagInfoSource *src, const char *filename)
+{
+    src->filename = filename;
+    src->lineno = 0;
+    src->fp = gzopen(filename, "rb");
+    if (src->fp == NULL) {
+        fprintf(stderr, "ERROR: Cannot open %s.\n", filename);
+        return -1;
+    }
+
+    return 0;
+}
+
+static void
+source_close(struct TagInfoSource *src)
+{
+    if (src->fp != NULL) {
+        gzclose(src->fp);
+        src->fp = NULL;
+    }
+}
+
+static inline int
+compare_tags(const char *tilename_a, int clusterno_a,
+             const char *tilename_b, int clusterno_b)
+{
+    int r;
+
+    r = strcmp(tilename_a, tilename_b);
+    if (r != 0)
+        return r;
+    if (clusterno_a != clusterno_b)
+        return clusterno_a < clusterno_b ? -1 : 1;
+    return 0;
+}
+
+struct FirstTag {
+    char *filename;
+    char tilename[MAX_TILENAME_LEN+1];
+    int clusterno;
+};
+
+static int
+compare_first_tags(const void *a, const void *b)
+{
+    const struct FirstTag *ta=a, *tb=b;
+
+    return compare_tags(ta->tilename, ta->clusterno, tb->tilename, tb->clusterno);
+}
+
+static void
+reader_close(struct TagInfoReader *reader)
+{
+    source_close(&reader->source);
+    free(reader->filenames);
+    free(reader);
+}
+
+static struct TagInfoReader *
+reader_open(char **filenames, int nfiles)
+{
+    struct TagInfoReader *reader;
+    struct FirstTag *firsts;
+    int i, r, nfirsts=0;
+
+    reader = calloc(1, sizeof(struct TagInfoReader));
+    if (reader == NULL)
+        return NULL;
+
+    reader->filenames = calloc(nfiles, sizeof(char *));
+    firsts = calloc(nfiles, sizeof(struct FirstTag));
+    if (reader->filenames == NULL || firsts == NULL) {
+        perror("reader_open");
+        free(firsts);
+        reader_close(reader);
+        return NULL;
+    }
+
+    /* Peek at the first tag of each file to order them. Empty files are
+     * left out. */
+    for (i = 0; i < nfiles; i++) {
+        if (source_open(&reader->source, filenames[i]) < 0)
+            break;
+
+        r = source_advance(&reader->source);
+        source_close(&reader->source);
+        if (r < 0)
+            break;
+        else if (r > 0) {
+            firsts[nfirsts].filename = filenames[i];
+            strcpy(firsts[nfirsts].tilename, reader->source.current.tilename);
+            firsts[nfirsts].clusterno = reader->source.current.clusterno;
+            nfirsts++;
         }
     }
-    else {
-        int polyA_len_sum, nearest_ptr;
-        float mean_polyA_len, nearest_dist;
 
-        /* Calculate the arithmetic mean of poly(A) lengths of duplicates. */
-        polyA_len_sum = 0;
-        tqueue_foreach(queue, ptr) {
-            polyA_len_sum += queue->el[ptr].polyA_len;
+    if (i < nfiles) {
+        free(firsts);
+        reader_close(reader);
+        return NULL;
+    }
+
+    qsort(firsts, nfirsts, sizeof(struct FirstTag), compare_first_tags);
+    for (i = 0; i < nfirsts; i++)
+        reader->filenames[i] = firsts[i].filename;
+    reader->nfiles = nfirsts;
+    free(firsts);
+
+    return reader;
+}
+
+/* Returns the next tag in the (tile, cluster) order. The tag stays valid
+ * until the next call. */
+static int
+reader_next(struct TagInfoReader *reader, struct TagInfo **taginfo,
+            uint64_t *seq)
+{
+    struct TagInfoSource *src=&reader->source;
+    int r;
+
+    for (;;) {
+        if (src->fp != NULL) {
+            r = source_advance(src);
+            if (r < 0)
+                return -1;
+            else if (r > 0)
+                break;
+
+            /* The last tag is kept in the buffer at the end of a file. */
+            strcpy(reader->last_tilename, src->current.tilename);
+            reader->last_clusterno = src->current.clusterno;
+            source_close(src);
         }
-        mean_polyA_len = (float)polyA_len_sum / length;
-
-        /* Find the tag instance that is nearest to the mean. */
-        nearest_ptr = queue->rear;
-        nearest_dist = fabsf(queue->el[queue->rear].polyA_len - mean_polyA_len);
-        for (ptr = tqueue_next(queue, queue->rear);
-                ptr != queue->front; ptr = tqueue_next(queue, ptr)) {
-            float dist=fabsf(queue->el[ptr].polyA_len - mean_polyA_len);
-            if (dist < nearest_dist) {
-                nearest_ptr = ptr;
-                nearest_dist = dist;
-            }
+
+        if (reader->next_file >= reader->nfiles)
+            return 0;
+
+        if (source_open(src, reader->filenames[reader->next_file++]) < 0)
+            return -1;
+    }
+
+    if (src->lineno == 1 && reader->next_file > 1 &&
+            compare_tags(reader->last_tilename, reader->last_clusterno,
+                         src->current.tilename, src->current.clusterno) >= 0) {
+        fprintf(stderr, "ERROR: %s shares tiles with another input file.\n",
+                src->filename);
+        return -1;
+    }
+
+    *taginfo = &src->current;
+    *seq = reader->next_seq++;
+
+    return 1;
+}
+
+
+/* Scratch files and sorted representatives */
+
+static FILE *
+open_scratch_file(const char *tmpdir)
+{
+    char *path;
+    FILE *fp;
+    int fd;
+
+    path = malloc(strlen(tmpdir) + 32);
+    if (path == NULL)
+        return NULL;
+
+    sprintf(path, "%s/tailseq-dedup-XXXXXX", tmpdir);
+    fd = mkstemp(path);
+    if (fd < 0) {
+        perror(path);
+        free(path);
+        return NULL;
+    }
+
+    unlink(path);
+    free(path);
+
+    fp = fdopen(fd, "w+b");
+    if (fp == NULL) {
+        perror("fdopen");
+        close(fd);
+    }
+
+    return fp;
+}
+
+static int
+compare_representatives(const void *a, const void *b)
+{
+    const struct Representative *ra=a, *rb=b;
+
+    if (ra->seq == rb->seq)
+        return 0;
+    return ra->seq < rb->seq ? -1 : 1;
+}
+
+static int
+add_representative(struct Deduplicator *dd, uint64_t seq, int num_duplicates,
+                   int polyA_len)
+{
+    struct Representative *rep;
+
+    if (dd->nreps >= dd->reps_size) {
+        size_t newsize=(dd->reps_size > 0 ? dd->reps_size * 2 : 65536);
+        struct Representative *newreps;
+
+        newreps = realloc(dd->reps, sizeof(struct Representative) * newsize);
+        if (newreps == NULL)
+            return -1;
+
+        dd->reps = newreps;
+        dd->reps_size = newsize;
+    }
+
+    rep = &dd->reps[dd->nreps++];
+    rep->seq = seq;
+    rep->num_duplicates = num_duplicates;
+    rep->polyA_len = polyA_len;
+
+    return 0;
+}
+
+/* Sorts the representatives collected so far and moves them to a new
+ * scratch file to be merged at the output stage. */
+static int
+flush_representatives(struct Deduplicator *dd)
+{
+    FILE **newfiles, *fp;
+
+    qsort(dd->reps, dd->nreps, sizeof(struct Representative),
+          compare_representatives);
+
+    newfiles = realloc(dd->repfiles, sizeof(FILE *) * (dd->nrepfiles + 1));
+    if (newfiles == NULL)
+        return -1;
+    dd->repfiles = newfiles;
+
+    fp = open_scratch_file(dd->tmpdir);
+    if (fp == NULL)
+        return -1;
+    dd->repfiles[dd->nrepfiles++] = fp;
+
+    if (dd->nreps > 0 &&
+            fwrite(dd->reps, sizeof(struct Representative), dd->nreps, fp) != dd->nreps) {
+        perror("flush_representatives");
+        return -1;
+    }
+
+    if (fflush(fp) != 0 || fseek(fp, 0, SEEK_SET) != 0) {
+        perror("flush_representatives");
+        return -1;
+    }
+
+    dd->nreps = 0;
+
+    return 0;
+}
+
+
+/* Hash table of the duplicate groups */
+
+static inline uint64_t
+hash_umi(const char *umi)
+{
+    uint64_t h=14695981039346656037ULL; /* FNV-1a */
+
+    for (; *umi != '\0'; umi++) {
+        h ^= (unsigned char)*umi;
+        h *= 1099511628211ULL;
+    }
+
+    return h;
+}
+
+static int
+table_resize(struct Deduplicator *dd, size_t newsize)
+{
+    struct DupGroup **newslots;
+    size_t i, mask=newsize - 1;
+
+    newslots = calloc(newsize, sizeof(struct DupGroup *));
+    if (newslots == NULL)
+        return -1;
+
+    for (i = 0; i < dd->table_size; i++)
+        if (dd->slots[i] != NULL) {
+            size_t pos=hash_umi(dd->slots[i]->umi) & mask;
+            while (newslots[pos] != NULL)
+                pos = (pos + 1) & mask;
+            newslots[pos] = dd->slots[i];
         }
 
-        /* Output the representative tag with the mean poly(A) length. */
-        {
-            struct TagInfo *rep;
-            int final_polyA;
-
-            rep = &queue->el[nearest_ptr];
-            final_polyA = rep->polyA_len >= 0 ? (int)roundf(mean_polyA_len) : -1;
-            printf("%s\t%d\t%d\t%d\t%s\t%d\n",
-                rep->tilename, rep->clusterno, rep->flags, final_polyA,
-                rep->modifications, queue->num_duplicates);
-
-            /* Output poly(A) length calls for accuracy assessments of clones */
-            if (queue->traceout != NULL) {
-                tqueue_foreach(queue, ptr) {
-                    struct TagInfo *taginfo=&queue->el[ptr];
-                    bgzf_printf(queue->traceout, "%s\t%d\t%" PRIu64 "\t%d\n",
-                                taginfo->tilename, taginfo->clusterno,
-                                queue->next_group,
-                                ptr == nearest_ptr ? final_polyA : -2);
-                }
-                queue->next_group++;
-            }
+    free(dd->slots);
+    dd->memory_used += (newsize - dd->table_size) * sizeof(struct DupGroup *);
+    dd->slots = newslots;
+    dd->table_size = newsize;
+
+    return 0;
+}
+
+static struct DupGroup *
+table_get_group(struct Deduplicator *dd, const char *umi, uint64_t group_id)
+{
+    struct DupGroup *group;
+    size_t pos, mask, umilen;
+
+    if (dd->table_count + 1 > dd->table_size * TABLE_MAX_LOAD &&
+            table_resize(dd, dd->table_size * 2) < 0)
+        return NULL;
+
+    mask = dd->table_size - 1;
+    for (pos = hash_umi(umi) & mask; dd->slots[pos] != NULL;
+            pos = (pos + 1) & mask)
+        if (strcmp(dd->slots[pos]->umi, umi) == 0)
+            return dd->slots[pos];
+
+    umilen = strlen(umi);
+    group = malloc(sizeof(struct DupGroup) + umilen + 1);
+    if (group == NULL)
+        return NULL;
+
+    group->members = malloc(sizeof(struct DupMember) * INITIAL_GROUP_CAPACITY);
+    if (group->members == NULL) {
+        free(group);
+        return NULL;
+    }
+
+    group->id = (group_id != NO_GROUP ? group_id : dd->next_group++);
+    group->num_duplicates = 0;
+    group->highest_priority = -1;
+    group->nmembers = 0;
+    group->capacity = INITIAL_GROUP_CAPACITY;
+    memcpy(group->umi, umi, umilen + 1);
+
+    dd->slots[pos] = group;
+    dd->table_count++;
+    dd->memory_used += sizeof(struct DupGroup) + umilen + 1 +
+                       sizeof(struct DupMember) * INITIAL_GROUP_CAPACITY;
+
+    return group;
+}
+
+static void
+free_group(struct Deduplicator *dd, struct DupGroup *group)
+{
+    dd->memory_used -= sizeof(struct DupGroup) + strlen(group->umi) + 1 +
+                       sizeof(struct DupMember) * group->capacity;
+    free(group->members);
+    free(group);
+}
+
+static int
+add_tag(struct Deduplicator *dd, const char *umi, uint64_t seq, int tile,
+        int clusterno, int polyA_len, int priority, uint64_t group_id,
+        int extra_duplicates)
+{
+    struct DupGroup *group;
+    struct DupMember *member;
+
+    group = table_get_group(dd, umi, group_id);
+    if (group == NULL)
+        return -1;
+
+    group->num_duplicates += 1 + extra_duplicates;
+
+    if (group->nmembers == 0 || priority > group->highest_priority) {
+        if (dd->traceout != NULL) {
+            /* print out the suboptimal tags */
+            int i;
+            for (i = 0; i < group->nmembers; i++)
+                bgzf_printf(dd->traceout, "%s\t%d\t%" PRIu64 "\t-3\n",
+                            dd->tilenames[group->members[i].tile],
+                            group->members[i].clusterno, group->id);
         }
+        group->nmembers = 0;
+        group->highest_priority = priority;
+    }
+    else if (priority < group->highest_priority) {
+        if (dd->traceout != NULL) /* print out the suboptimal tag */
+            bgzf_printf(dd->traceout, "%s\t%d\t%" PRIu64 "\t-3\n",
+                        dd->tilenames[tile], clusterno, group->id);
+        return 0;
     }
 
-    tqueue_empty(queue);
+    if (group->nmembers >= group->capacity) {
+        int newcapacity=group->capacity * 2;
+        struct DupMember *newmembers;
+
+        newmembers = realloc(group->members, sizeof(struct DupMember) * newcapacity);
+        if (newmembers == NULL)
+            return -1;
+
+        dd->memory_used += sizeof(struct DupMember) * (newcapacity - group->capacity);
+        group->members = newmembers;
+        group->capacity = newcapacity;
+    }
+
+    member = &group->members[group->nmembers++];
+    member->seq = seq;
+    member->clusterno = clusterno;
+    member->polyA_len = polyA_len;
+    member->tile = tile;
 
     return 0;
 }
 
+static int
+resolve_group(struct Deduplicator *dd, struct DupGroup *group)
+{
+    int i, polyA_len_sum, nearest, final_polyA;
+    float mean_polyA_len, nearest_dist;
+
+    /* Calculate the arithmetic mean of poly(A) lengths of duplicates. */
+    polyA_len_sum = 0;
+    for (i = 0; i < group->nmembers; i++)
+        polyA_len_sum += group->members[i].polyA_len;
+    mean_polyA_len = (float)polyA_len_sum / group->nmembers;
+
+    /* Find the tag instance that is nearest to the mean. */
+    nearest = 0;
+    nearest_dist = fabsf(group->members[0].polyA_len - mean_polyA_len);
+    for (i = 1; i < group->nmembers; i++) {
+        float dist=fabsf(group->members[i].polyA_len - mean_polyA_len);
+        if (dist < nearest_dist) {
+            nearest = i;
+            nearest_dist = dist;
+        }
+    }
 
-int
-main(int argc, char *argv[])
+    final_polyA = group->members[nearest].polyA_len >= 0 ?
+                  (int)roundf(mean_polyA_len) : -1;
+
+    /* Output poly(A) length calls for accuracy assessments of clones */
+    if (dd->traceout != NULL)
+        for (i = 0; i < group->nmembers; i++)
+            bgzf_printf(dd->traceout, "%s\t%d\t%" PRIu64 "\t%d\n",
+                        dd->tilenames[group->members[i].tile],
+                        group->members[i].clusterno, group->id,
+                        i == nearest ? final_polyA : -2);
+
+    return add_representative(dd, group->members[nearest].seq,
+                              group->num_duplicates, final_polyA);
+}
+
+static int
+resolve_all_groups(struct Deduplicator *dd)
 {
-    struct TagInfoQueue *queue;
-    int lineno;
+    size_t i;
+
+    for (i = 0; i < dd->table_size; i++)
+        if (dd->slots[i] != NULL) {
+            if (resolve_group(dd, dd->slots[i]) < 0)
+                return -1;
+            free_group(dd, dd->slots[i]);
+            dd->slots[i] = NULL;
+        }
 
-    queue = tqueue_new(DEFAULT_BUFFER_SIZE);
-    if (queue == NULL) {
-        perror("tqueue_new");
-        goto onError;
+    dd->table_count = 0;
+
+    return flush_representatives(dd);
+}
+
+
+/* Spilling to the disk */
+
+static inline int
+partition_of(struct Deduplicator *dd, const char *umi)
+{
+    return (int)((hash_umi(umi) >> 32) % dd->npartitions);
+}
+
+static int
+write_spilled_tag(struct Deduplicator *dd, const char *umi, uint64_t seq,
+                  int tile, int clusterno, int polyA_len, int priority,
+                  uint64_t group_id, int extra_duplicates)
+{
+    struct SpilledTag tag;
+
+    memset(&tag, 0, sizeof(tag));
+    tag.seq = seq;
+    tag.group_id = group_id;
+    tag.clusterno = clusterno;
+    tag.extra_duplicates = extra_duplicates;
+    tag.priority = priority;
+    tag.polyA_len = polyA_len;
+    tag.tile = tile;
+    strcpy(tag.umi, umi);
+
+    if (fwrite(&tag, sizeof(tag), 1, dd->partitions[partition_of(dd, umi)]) != 1) {
+        perror("write_spilled_tag");
+        return -1;
     }
 
-    if (argc >= 2) {
-        queue->traceout = bgzf_open(argv[1], "w");
-        if (queue->traceout == NULL) {
-            fprintf(stderr, "ERROR: Cannot open %s.", argv[1]);
-            goto onError;
+    return 0;
+}
+
+/* Moves all groups in the table to the partitions. Only the best tags in
+ * each group are kept, and the first of them carries the number of the
+ * other duplicates. */
+static int
+spill_table(struct Deduplicator *dd)
+{
+    size_t i;
+    int j;
+
+    fprintf(stderr, "Memory limit reached. Spilling duplicate groups into "
+                    "%d partitions.\n", dd->npartitions);
+
+    dd->partitions = calloc(dd->npartitions, sizeof(FILE *));
+    if (dd->partitions == NULL)
+        return -1;
+
+    for (j = 0; j < dd->npartitions; j++) {
+        dd->partitions[j] = open_scratch_file(dd->tmpdir);
+        if (dd->partitions[j] == NULL)
+            return -1;
+    }
+
+    for (i = 0; i < dd->table_size; i++) {
+        struct DupGroup *group=dd->slots[i];
+
+        if (group == NULL)
+            continue;
+
+        for (j = 0; j < group->nmembers; j++) {
+            struct DupMember *member=&group->members[j];
+
+            if (write_spilled_tag(dd, group->umi, member->seq, member->tile,
+                    member->clusterno, member->polyA_len, group->highest_priority,
+                    group->id, j == 0 ? group->num_duplicates - group->nmembers : 0) < 0)
+                return -1;
         }
+
+        free_group(dd, group);
+        dd->slots[i] = NULL;
+    }
+
+    dd->table_count = 0;
+
+    return 0;
+}
+
+/* Each partition is assumed to fit in memory; use more partitions with
+ * the -p option otherwise. */
+static int
+process_partitions(struct Deduplicator *dd)
+{
+    struct SpilledTag tag;
+    int i;
+
+    for (i = 0; i < dd->npartitions; i++) {
+        FILE *fp=dd->partitions[i];
+
+        if (fflush(fp) != 0 || fseek(fp, 0, SEEK_SET) != 0) {
+            perror("process_partitions");
+            return -1;
+        }
+
+        while (fread(&tag, sizeof(tag), 1, fp) == 1)
+            if (add_tag(dd, tag.umi, tag.seq, tag.tile, tag.clusterno,
+                        tag.polyA_len, tag.priority, tag.group_id,
+                        tag.extra_duplicates) < 0)
+                return -1;
+
+        if (ferror(fp)) {
+            perror("process_partitions");
+            return -1;
+        }
+
+        fclose(fp);
+        dd->partitions[i] = NULL;
+
+        if (resolve_all_groups(dd) < 0)
+            return -1;
+    }
+
+    return 0;
+}
+
+
+/* Main stages */
+
+static int
+tile_index(struct Deduplicator *dd, const char *tilename)
+{
+    int i;
+
+    if (dd->last_tile >= 0 && strcmp(dd->tilenames[dd->last_tile], tilename) == 0)
+        return dd->last_tile;
+
+    for (i = 0; i < dd->ntiles; i++)
+        if (strcmp(dd->tilenames[i], tilename) == 0)
+            return (dd->last_tile = i);
+
+    if (dd->ntiles >= MAX_TILES) {
+        fprintf(stderr, "ERROR: Too many tiles. Adjust MAX_TILES in " __FILE__ ".\n");
+        return -1;
     }
 
-    for (lineno = 0;
-         fgets(tqueue_head(queue).line, MAX_LINE_LEN, stdin) != NULL;
-         lineno++) {
-        struct TagInfo *current;
+    dd->tilenames[dd->ntiles] = strdup(tilename);
+    if (dd->tilenames[dd->ntiles] == NULL)
+        return -1;
 
-        current = &tqueue_head(queue);
+    return (dd->last_tile = dd->ntiles++);
+}
 
-        if (parse_line(current) < 0) {
-            fprintf(stderr, "Could not parse line %d: %s", lineno, current->line);
+static int
+collect_duplicates(struct Deduplicator *dd, char **inputs, int ninputs)
+{
+    struct TagInfoReader *reader;
+    struct TagInfo *taginfo;
+    uint64_t seq;
+    int r, tile=0, priority;
+
+    reader = reader_open(inputs, ninputs);
+    if (reader == NULL)
+        return -1;
+
+    while ((r = reader_next(reader, &taginfo, &seq)) > 0) {
+        tile = tile_index(dd, taginfo->tilename);
+        if (tile < 0)
             break;
+
+        priority = calculate_tag_prority(taginfo->flags);
+
+        if (dd->partitions != NULL)
+            r = write_spilled_tag(dd, taginfo->umi, seq, tile, taginfo->clusterno,
+                                  taginfo->polyA_len, priority, NO_GROUP, 0);
+        else {
+            r = add_tag(dd, taginfo->umi, seq, tile, taginfo->clusterno,
+                        taginfo->polyA_len, priority, NO_GROUP, 0);
+            if (r == 0 && dd->memory_used > dd->memory_limit)
+                r = spill_table(dd);
         }
 
-        if (!tqueue_isempty(queue) &&
-                strcmp(current->umi, tqueue_tail(queue).umi) != 0) {
-            if (process_tag_duplicates(queue) < 0) {
-                perror("process_tag_duplicates");
-                goto onError;
-            }
+        if (r < 0)
+            break;
+    }
+
+    reader_close(reader);
+
+    if (r < 0 || tile < 0)
+        return -1;
+
+    if (dd->partitions != NULL)
+        return process_partitions(dd);
+    else
+        return resolve_all_groups(dd);
+}
+
+static int
+representative_advance(struct RepresentativeSource *src)
+{
+    if (fread(&src->current, sizeof(struct Representative), 1, src->fp) == 1)
+        return 1;
+    else if (ferror(src->fp)) {
+        perror("representative_advance");
+        return -1;
+    }
+    else
+        return 0;
+}
+
+/* Returns the source with the smallest sequence number, or NULL. */
+static struct RepresentativeSource *
+representative_peek(struct RepresentativeSource *sources, int nsources)
+{
+    struct RepresentativeSource *best=NULL;
+    int i;
+
+    /* The sources are few; a linear scan is cheaper than maintaining a heap. */
+    for (i = 0; i < nsources; i++)
+        if (sources[i].fp != NULL &&
+                (best == NULL || sources[i].current.seq < best->current.seq))
+            best = &sources[i];
 
-            queue->num_duplicates = 0;
-            queue->highest_priority = -1;
+    return best;
+}
+
+static int
+write_representatives(struct Deduplicator *dd, char **inputs, int ninputs)
+{
+    struct RepresentativeSource *sources, *next;
+    struct TagInfoReader *reader;
+    struct TagInfo *taginfo;
+    uint64_t seq;
+    int i, r=0;
+
+    sources = calloc(dd->nrepfiles, sizeof(struct RepresentativeSource));
+    if (sources == NULL)
+        return -1;
+
+    for (i = 0; i < dd->nrepfiles; i++) {
+        sources[i].fp = dd->repfiles[i];
+        r = representative_advance(&sources[i]);
+        if (r < 0) {
+            free(sources);
+            return -1;
         }
+        else if (r == 0)
+            sources[i].fp = NULL;
+    }
+
+    reader = reader_open(inputs, ninputs);
+    if (reader == NULL) {
+        free(sources);
+        return -1;
+    }
+
+    next = representative_peek(sources, dd->nrepfiles);
+
+    while (next != NULL && (r = reader_next(reader, &taginfo, &seq)) > 0) {
+        if (seq != next->current.seq)
+            continue;
 
-        if (tqueue_append(queue) < 0) {
-            perror("tqueue_append");
+        printf("%s\t%d\t%d\t%d\t%s\t%d\n", taginfo->tilename, taginfo->clusterno,
+               taginfo->flags, next->current.polyA_len, taginfo->modifications,
+               next->current.num_duplicates);
+
+        r = representative_advance(next);
+        if (r < 0)
+            break;
+        else if (r == 0)
+            next->fp = NULL;
+
+        next = representative_peek(sources, dd->nrepfiles);
+    }
+
+    reader_close(reader);
+    free(sources);
+
+    if (r < 0)
+        return -1;
+
+    if (next != NULL) {
+        fprintf(stderr, "ERROR: Input files changed during deduplication.\n");
+        return -1;
+    }
+
+    return 0;
+}
+
+static void
+free_deduplicator(struct Deduplicator *dd)
+{
+    int i;
+
+    if (dd->slots != NULL) {
+        size_t j;
+        for (j = 0; j < dd->table_size; j++)
+            if (dd->slots[j] != NULL)
+                free_group(dd, dd->slots[j]);
+        free(dd->slots);
+    }
+
+    if (dd->partitions != NULL) {
+        for (i = 0; i < dd->npartitions; i++)
+            if (dd->partitions[i] != NULL)
+                fclose(dd->partitions[i]);
+        free(dd->partitions);
+    }
+
+    for (i = 0; i < dd->nrepfiles; i++)
+        fclose(dd->repfiles[i]);
+    free(dd->repfiles);
+    free(dd->reps);
+
+    for (i = 0; i < dd->ntiles; i++)
+        free(dd->tilenames[i]);
+
+    if (dd->traceout != NULL)
+        bgzf_close(dd->traceout);
+
+    free(dd);
+}
+
+
+static void
+usage(const char *prog)
+{
+    printf("\
+tailseq-dedup-perfect 3.1\
+\n - Eliminate PCR duplicates sharing the same UMI from taginfo files\
+\n\
+\nUsage: %s [-m memory_limit] [-p partitions] [-T tmpdir] \\\
+\n           {trace_output.gz} {taginfo.gz} [taginfo.gz ...]\
+\n\
+\n  -m  bytes of duplicate groups to hold in memory before spilling (default: %zu)\
+\n  -p  number of partitions to spill into (default: %d)\
+\n  -T  directory for the scratch files (default: $TAILSEQ_SCRATCH_DIR or .)\
+\n\
+\nEach input file must be sorted by cluster number, and the files must not\
+\nshare any tile. The deduplicated tags are written to the standard output\
+\nin the order of tile and cluster number.\
+\n\
+\nMail bug reports and suggestions to Hyeshik Chang <hyeshik@snu.ac.kr>.\n\n",
+           prog, DEFAULT_MEMORY_LIMIT, DEFAULT_PARTITIONS);
+}
+
+
+int
+main(int argc, char *argv[])
+{
+    struct Deduplicator *dd;
+    int c;
+
+    dd = calloc(1, sizeof(struct Deduplicator));
+    if (dd == NULL) {
+        perror("main");
+        return -1;
+    }
+
+    dd->memory_limit = DEFAULT_MEMORY_LIMIT;
+    dd->npartitions = DEFAULT_PARTITIONS;
+    dd->tmpdir = getenv("TAILSEQ_SCRATCH_DIR");
+    if (dd->tmpdir == NULL)
+        dd->tmpdir = ".";
+    dd->last_tile = -1;
+
+    while ((c = getopt(argc, argv, "m:p:T:h")) != -1)
+        switch (c) {
+        case 'm':
+            dd->memory_limit = strtoull(optarg, NULL, 10);
+            break;
+        case 'p':
+            dd->npartitions = atoi(optarg);
+            if (dd->npartitions < 1) {
+                fprintf(stderr, "ERROR: Invalid number of partitions: %s\n", optarg);
+                goto onError;
+            }
+            break;
+        case 'T':
+            dd->tmpdir = optarg;
+            break;
+        default:
+            usage(argv[0]);
             goto onError;
         }
+
+    if (argc - optind < 2) {
+        usage(argv[0]);
+        goto onError;
+    }
+
+    dd->traceout = bgzf_open(argv[optind], "w");
+    if (dd->traceout == NULL) {
+        fprintf(stderr, "ERROR: Cannot open %s.", argv[optind]);
+        goto onError;
     }
 
-    if (process_tag_duplicates(queue) < 0) {
-        perror("process_tag_duplicates");
+    dd->table_size = INITIAL_TABLE_SIZE;
+    dd->slots = calloc(dd->table_size, sizeof(struct DupGroup *));
+    if (dd->slots == NULL) {
+        perror("main");
         goto onError;
     }
+    dd->memory_used = dd->table_size * sizeof(struct DupGroup *);
+
+    if (collect_duplicates(dd, argv + optind + 1, argc - optind - 1) < 0 ||
+            write_representatives(dd, argv + optind + 1, argc - optind - 1) < 0)
+        goto onError;
 
-    tqueue_free(queue);
+    free_deduplicator(dd);
 
-    if (ferror(stdin)) {
-        perror("fgets");
+    if (fflush(stdout) != 0) {
+        perror("fflush");
         return -1;
     }
 
     return 0;
 
   onError:
-    if (queue != NULL)
-        tqueue_free(queue);
+    free_deduplicator(dd);
 
     return -1;
 }
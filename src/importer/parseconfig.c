@@ -114,6 +114,15 @@ feed_options_entry(struct TailseekerConfig *cfg,
     }
     else if (MATCH("threads"))
         cfg->threads = atoi(value);
+    else if (MATCH("compression-level")) {
+        cfg->compression_level = atoi(value);
+        if (cfg->compression_level < -1 || cfg->compression_level > 9) {
+            fprintf(stderr, "\"%s\" must be between -1 and 9.\n", name);
+            return -1;
+        }
+    }
+    else if (MATCH("maximum-clusters"))
+        cfg->maximum_clusters = (uint32_t)strtoul(value, NULL, 10);
     else if (MATCH("read-buffer-size"))
         cfg->read_buffer_size = (size_t)atoll(value);
     else {
@@ -490,6 +499,8 @@ set_default_configuration(struct TailseekerConfig *cfg)
     cfg->keep_no_delimiter = 0;
     cfg->keep_low_quality_balancer = 0;
     cfg->threads = 1;
+    cfg->maximum_clusters = 0; /* no limit */
+    cfg->compression_level = -1; /* default of htslib */
     cfg->index_length = 6;
 
     cfg->read_buffer_size = 536870912; /* 500 MiB */
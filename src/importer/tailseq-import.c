@@ -39,6 +39,14 @@ static int
 open_writers(struct TailseekerConfig *cfg)
 {
     struct SampleInfo *sample;
+    char writemode[4];
+
+    /* Level 0 writes uncompressed BGZF blocks, which are still readable as
+     * gzip unlike the "u" mode of htslib. */
+    if (cfg->compression_level >= 0)
+        snprintf(writemode, sizeof(writemode), "w%d", cfg->compression_level);
+    else
+        strcpy(writemode, "w");
 
     for (sample = cfg->samples; sample != NULL; sample = sample->next) {
         char *filename;
@@ -52,7 +60,7 @@ open_writers(struct TailseekerConfig *cfg)
         if (filename == NULL)
             return -1;
 
-        sample->stream_seqqual = bgzf_open(filename, "w");
+        sample->stream_seqqual = bgzf_open(filename, writemode);
         if (sample->stream_seqqual == NULL) {
             perror("open_writers");
             fprintf(stderr, "Failed to write to %s\n", filename);
@@ -65,7 +73,7 @@ open_writers(struct TailseekerConfig *cfg)
         if (cfg->taginfo_output != NULL) {
             filename = replace_placeholder(cfg->taginfo_output,
                                            "{name}", sample->name);
-            sample->stream_taginfo = bgzf_open(filename, "w");
+            sample->stream_taginfo = bgzf_open(filename, writemode);
             if (sample->stream_taginfo == NULL) {
                 perror("open_writers");
                 fprintf(stderr, "Failed to write to %s\n", filename);
@@ -80,7 +88,7 @@ open_writers(struct TailseekerConfig *cfg)
         if (filename == NULL)
             return -1;
 
-        sample->stream_signal = bgzf_open(filename, "w");
+        sample->stream_signal = bgzf_open(filename, writemode);
         if (sample->stream_signal == NULL) {
             perror("open_writers");
             fprintf(stderr, "Failed to write to %s\n", filename);
@@ -270,16 +278,16 @@ write_signal_samples_dists(const char *filename_format, const char *type,
                            const cluster_count_t *counts,
                            int total_cycles, int sampling_bins)
 {
-    uint32_t header_elements[3];
+    struct SigDistsHeader header;
     char *filename;
-    BGZF *fp;
+    FILE *fp;
     int r;
 
     filename = replace_placeholder(filename_format, "{posneg}", type);
     if (filename == NULL)
         return -1;
 
-    fp = bgzf_open(filename, "w");
+    fp = fopen(filename, "wb");
     if (fp == NULL) {
         fprintf(stderr, "Cannot open %s to write.\n", filename);
         free(filename);
@@ -287,14 +295,17 @@ write_signal_samples_dists(const char *filename_format, const char *type,
     }
     free(filename);
 
-    header_elements[0] = sizeof(cluster_count_t);
-    header_elements[1] = total_cycles;
-    header_elements[2] = sampling_bins;
+    memcpy(header.magic, SIGDISTS_MAGIC, sizeof(header.magic));
+    header.version = SIGDISTS_FORMAT_VERSION;
+    header.elemsize = sizeof(cluster_count_t);
+    header.cycles = total_cycles;
+    header.bins = sampling_bins;
 
-    r = (bgzf_write(fp, header_elements, sizeof(header_elements)) < 0 ||
-         bgzf_write(fp, counts, sizeof(cluster_count_t) *
-                    total_cycles * sampling_bins) < 0) ? -1 : 0;
-    bgzf_close(fp);
+    r = (fwrite(&header, sizeof(header), 1, fp) != 1 ||
+         fwrite(counts, sizeof(cluster_count_t) * sampling_bins,
+                total_cycles, fp) != (size_t)total_cycles) ? -1 : 0;
+    if (fclose(fp) != 0)
+        r = -1;
 
     return r;
 }
@@ -573,7 +584,7 @@ process(struct TailseekerConfig *cfg)
     struct CIFData **intensities;
     struct BCLData **basecalls;
     uint32_t clusters_to_go, blockno, nclusters, totalblocks;
-    int cycleno, clusters_to_read, blocksize;
+    int cycleno, clusters_to_read, blocksize, truncated = 0;
     char msgprefix[BUFSIZ];
 
     blocksize = cfg->read_buffer_entry_count;
@@ -608,6 +619,12 @@ process(struct TailseekerConfig *cfg)
         return -1;
 
     clusters_to_go = nclusters = cifreader[0]->nclusters;
+    if (cfg->maximum_clusters > 0 && nclusters > cfg->maximum_clusters) {
+        printf("%sLimiting to the first %u of %u clusters.\n", msgprefix,
+               cfg->maximum_clusters, nclusters);
+        clusters_to_go = nclusters = cfg->maximum_clusters;
+        truncated = 1;
+    }
     totalblocks = nclusters / blocksize + ((nclusters % blocksize > 0) ? 1 : 0);
     printf("%sProcessing %u clusters.\n", msgprefix, nclusters);
 
@@ -645,7 +662,9 @@ process(struct TailseekerConfig *cfg)
 
     close_bcl_readers(bclreader, cfg->total_cycles);
     close_cif_readers(cifreader, cfg->threep_length);
-    if (close_alternative_calls_bundle(cfg->altcalls, 1) < 0)
+    /* The alternative calls cover all clusters, and are left unread after
+     * the limit. */
+    if (close_alternative_calls_bundle(cfg->altcalls, !truncated) < 0)
         goto onError;
 
     close_writers(cfg->samples);
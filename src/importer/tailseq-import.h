@@ -234,6 +234,8 @@ struct TailseekerConfig {
     int keep_no_delimiter;
     int keep_low_quality_balancer;
     int threads;
+    uint32_t maximum_clusters;
+    int compression_level;
     size_t read_buffer_size;
     int read_buffer_entry_count;
 
@@ -176,24 +176,27 @@ write_signal_samples_dists(const char *filename,
                            const cluster_count_t *counts,
                            int total_cycles, int sampling_bins)
 {
-    uint32_t header_elements[3];
-    gzFile fp;
+    struct SigDistsHeader header;
+    FILE *fp;
     int r;
 
-    fp = gzopen(filename, "wb");
+    fp = fopen(filename, "wb");
     if (fp == NULL) {
         fprintf(stderr, "Cannot open %s to write.\n", filename);
         return -1; 
     }   
 
-    header_elements[0] = sizeof(cluster_count_t);
-    header_elements[1] = total_cycles;
-    header_elements[2] = sampling_bins;
-
-    r = (gzwrite(fp, header_elements, sizeof(header_elements)) < 0 ||
-         gzwrite(fp, counts, sizeof(cluster_count_t) *
-                    total_cycles * sampling_bins) < 0) ? -1 : 0;
-    gzclose(fp);
+    memcpy(header.magic, SIGDISTS_MAGIC, sizeof(header.magic));
+    header.version = SIGDISTS_FORMAT_VERSION;
+    header.elemsize = sizeof(cluster_count_t);
+    header.cycles = total_cycles;
+    header.bins = sampling_bins;
+
+    r = (fwrite(&header, sizeof(header), 1, fp) != 1 ||
+         fwrite(counts, sizeof(cluster_count_t) * sampling_bins,
+                total_cycles, fp) != (size_t)total_cycles) ? -1 : 0;
+    if (fclose(fp) != 0)
+        r = -1;
 
     return r;
 }
@@ -46,4 +46,16 @@ typedef uint32_t unpacked_score_t;
 /* A storage type that are wide enough to count clusters in any tile */
 typedef uint32_t cluster_count_t;
 
+/* Signal distribution (.sigdists) files consist of this header followed by
+ * an uncompressed cycles x bins array of cluster_count_t. */
+#define SIGDISTS_MAGIC                  "TSSIGDST"
+#define SIGDISTS_FORMAT_VERSION         1
+struct SigDistsHeader {
+    char magic[8];
+    uint32_t version;
+    uint32_t elemsize;
+    uint32_t cycles;
+    uint32_t bins;
+};
+
 #endif
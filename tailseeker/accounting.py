@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+"""
+Resource accounting of the shell commands run by the workflow.
+
+When enabled, the shell prefix replaces the shell of every job with
+`python -m tailseeker.accounting run ...`, which runs the same command in
+a new shell, waits for it and appends a record of its wall time, CPU
+time, peak RSS and block I/O to a job record file. The commands are
+labelled with the rule and wildcards of their jobs by `label_command`.
+`summarize_usage` collects the records into per-job and per-rule tables.
+"""
+
+__all__ = [
+    'shell_prefix', 'label_command', 'report_external_usage',
+    'summarize_usage', 'RECORD_FIELDS',
+]
+
+import os
+import sys
+import re
+import time
+
+WRAPPED_ENVVAR = 'TAILSEEKER_ACCOUNTED'
+EXTERNAL_USAGE_ENVVAR = 'TAILSEEKER_EXTERNAL_USAGE'
+JOB_LABEL_ENVVAR = 'TAILSEEKER_JOB'
+
+JOB_LABEL_PATTERN = re.compile(r"export TAILSEEKER_JOB='([^']*)';")
+LABEL_WILDCARDS = ['sample', 'tile']
+
+RECORD_FIELDS = [
+    'rule', 'sample', 'tile', 'wildcards', 'start_time', 'wall_time',
+    'user_time', 'system_time', 'max_rss_mb', 'read_mb', 'write_mb',
+    'exit_status',
+]
+
+SUMMARY_FIELDS = [
+    'rule', 'jobs', 'failed_jobs', 'wall_time', 'max_wall_time', 'cpu_time',
+    'cpu_utilization', 'max_rss_mb', 'read_mb', 'write_mb',
+]
+
+BLOCK_SIZE = 512 # unit of ru_inblock and ru_oublock
+
+
+def shell_prefix(python_cmd, records_file):
+    """Shell code that runs the rest of the command under the accounting
+    wrapper. It must come first in the shell prefix."""
+    return ('if [ -z "${wrapped}" ]; then export {wrapped}=1; '
+            'exec {python} -m tailseeker.accounting run {records} -- '
+            '"$BASH" -c "$BASH_EXECUTION_STRING"; fi; unset {wrapped}; ').format(
+            wrapped=WRAPPED_ENVVAR, python=python_cmd, records=records_file)
+
+
+def label_command(command, rule, wildcards):
+    """Prepend an assignment to a shell command which names the job for
+    the accounting wrapper and for the programs run by the command."""
+    from urllib.parse import urlencode
+
+    label = [('rule', rule)] + [(k, str(v)) for k, v in wildcards]
+    return "export {}='{}'; {}".format(JOB_LABEL_ENVVAR, urlencode(label), command)
+
+
+def parse_label(script):
+    match = JOB_LABEL_PATTERN.search(script)
+    if match is None:
+        return {}
+    return decode_label(match.group(1))
+
+
+def decode_label(label):
+    from urllib.parse import parse_qsl
+    return dict(parse_qsl(label, keep_blank_values=True))
+
+
+def current_job_label():
+    """Rule and wildcards of the job running this process, or an empty
+    dict when run outside of a labelled job."""
+    return decode_label(os.environ.get(JOB_LABEL_ENVVAR, ''))
+
+
+def report_external_usage(usage):
+    """Add the resource usage of work done outside of the process tree of a
+    job, such as a script run in the script server, to the record of the
+    job. `usage` is a tuple of user and system CPU time, peak RSS in
+    kilobytes and the numbers of blocks read and written."""
+    if EXTERNAL_USAGE_ENVVAR not in os.environ:
+        return
+
+    with open(os.environ[EXTERNAL_USAGE_ENVVAR], 'a') as outf:
+        print(*usage, file=outf)
+
+
+def read_external_usage(filename):
+    usages = []
+    if os.path.exists(filename):
+        for line in open(filename):
+            utime, stime, maxrss, inblock, oublock = line.split()
+            usages.append((float(utime), float(stime), int(maxrss),
+                           int(inblock), int(oublock)))
+    return usages
+
+
+def format_record(label, start_time, wall_time, usages, status):
+    utime = sum(u[0] for u in usages)
+    stime = sum(u[1] for u in usages)
+    maxrss = max(u[2] for u in usages) # in kilobytes
+    inblock = sum(u[3] for u in usages)
+    oublock = sum(u[4] for u in usages)
+
+    wildcards = sorted((k, v) for k, v in label.items()
+                       if k != 'rule' and k not in LABEL_WILDCARDS)
+    values = [
+        label.get('rule', ''), label.get('sample', ''), label.get('tile', ''),
+        ','.join('{}={}'.format(k, v) for k, v in wildcards),
+        '{:.3f}'.format(start_time), '{:.3f}'.format(wall_time),
+        '{:.3f}'.format(utime), '{:.3f}'.format(stime),
+        '{:.1f}'.format(maxrss / 1024),
+        '{:.1f}'.format(inblock * BLOCK_SIZE / 1048576),
+        '{:.1f}'.format(oublock * BLOCK_SIZE / 1048576),
+        str(status),
+    ]
+    return '\t'.join(v.replace('\t', ' ') for v in values) + '\n'
+
+
+def append_record(records_file, record):
+    # A single write to a file opened for appending does not interleave
+    # with the records from the other jobs.
+    fd = os.open(records_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, record.encode())
+    finally:
+        os.close(fd)
+
+
+def run_accounted(records_file, argv):
+    import subprocess as sp
+    import tempfile
+    import signal
+
+    label = parse_label(argv[-1])
+
+    with tempfile.NamedTemporaryFile(prefix='tailseq-usage-') as usagefile:
+        env = os.environ.copy()
+        env[EXTERNAL_USAGE_ENVVAR] = usagefile.name
+
+        start_time = time.time()
+        proc = sp.Popen(argv, env=env)
+
+        # Snakemake terminates the jobs by signalling this process, which
+        # replaced the original shell.
+        def forward_signal(signum, frame):
+            proc.send_signal(signum)
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, forward_signal)
+
+        while True:
+            try:
+                _, waitstatus, usage = os.wait4(proc.pid, 0)
+                break
+            except InterruptedError:
+                pass
+
+        wall_time = time.time() - start_time
+        if os.WIFSIGNALED(waitstatus):
+            status = -os.WTERMSIG(waitstatus)
+        else:
+            status = os.WEXITSTATUS(waitstatus)
+        proc.returncode = status
+
+        usages = [(usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                   usage.ru_inblock, usage.ru_oublock)]
+        usages.extend(read_external_usage(usagefile.name))
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(records_file)), exist_ok=True)
+        append_record(records_file, format_record(label, start_time, wall_time,
+                                                  usages, status))
+    except OSError as exc:
+        print('WARNING: Failed to write the resource usage to {}: {}'.format(
+              records_file, exc), file=sys.stderr)
+
+    return status if status >= 0 else 128 - status
+
+
+def load_records(records_file):
+    import csv
+
+    records = []
+    with open(records_file) as inpf:
+        for row in csv.reader(inpf, delimiter='\t'):
+            if len(row) != len(RECORD_FIELDS):
+                continue # truncated by an interrupted run
+            records.append(dict(zip(RECORD_FIELDS, row)))
+    return records
+
+
+def summarize_usage(records_file, summary_output, jobs_output=None):
+    """Write a per-rule summary of the job records, sorted by the total wall
+    time, and optionally all the records as a table."""
+    import csv
+    from collections import OrderedDict
+
+    records = load_records(records_file)
+
+    if jobs_output is not None:
+        with open(jobs_output, 'w') as outf:
+            writer = csv.DictWriter(outf, RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(sorted(records, key=lambda r: float(r['start_time'])))
+
+    rules = OrderedDict()
+    for rec in records:
+        summary = rules.setdefault(rec['rule'] or '(unlabelled)', {
+            'jobs': 0, 'failed_jobs': 0, 'wall_time': 0., 'max_wall_time': 0.,
+            'cpu_time': 0., 'max_rss_mb': 0., 'read_mb': 0., 'write_mb': 0.})
+
+        wall_time = float(rec['wall_time'])
+        summary['jobs'] += 1
+        summary['failed_jobs'] += int(rec['exit_status'] != '0')
+        summary['wall_time'] += wall_time
+        summary['max_wall_time'] = max(summary['max_wall_time'], wall_time)
+        summary['cpu_time'] += float(rec['user_time']) + float(rec['system_time'])
+        summary['max_rss_mb'] = max(summary['max_rss_mb'], float(rec['max_rss_mb']))
+        summary['read_mb'] += float(rec['read_mb'])
+        summary['write_mb'] += float(rec['write_mb'])
+
+    with open(summary_output, 'w') as outf:
+        writer = csv.writer(outf)
+        writer.writerow(SUMMARY_FIELDS)
+
+        for rule, s in sorted(rules.items(), key=lambda r: -r[1]['wall_time']):
+            utilization = s['cpu_time'] / s['wall_time'] if s['wall_time'] > 0 else 0.
+            writer.writerow([
+                rule, s['jobs'], s['failed_jobs'],
+                '{:.1f}'.format(s['wall_time']), '{:.1f}'.format(s['max_wall_time']),
+                '{:.1f}'.format(s['cpu_time']), '{:.2f}'.format(utilization),
+                '{:.1f}'.format(s['max_rss_mb']), '{:.1f}'.format(s['read_mb']),
+                '{:.1f}'.format(s['write_mb'])])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 5 and sys.argv[1] == 'run' and sys.argv[3] == '--':
+        sys.exit(run_accounted(sys.argv[2], sys.argv[4:]))
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == 'summarize':
+        summarize_usage(*sys.argv[2:])
+    else:
+        print('Usage: {0} run records.tsv -- command [args ...]\n'
+              '       {0} summarize records.tsv summary.csv [jobs.csv]'.format(
+              sys.argv[0]), file=sys.stderr)
+        sys.exit(2)
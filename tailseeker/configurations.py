@@ -25,19 +25,112 @@ import yaml
 import os
 import glob
 
+try:
+    from yaml import CSafeLoader as YAMLLoader
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader
+
+CONFIG_CACHE_FILE = '.tailseeker-conf.cache'
+CONFIG_CACHE_VERSION = 1
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YAMLLoader)
+
+
+def fingerprint_files(filenames):
+    import hashlib
+
+    hasher = hashlib.sha1()
+    for filename in filenames:
+        hasher.update(filename.encode() + b'\0')
+        try:
+            st = os.stat(filename)
+            contents = open(filename, 'rb').read()
+        except FileNotFoundError:
+            hasher.update(b'missing\0')
+            continue
+
+        hasher.update('{}:{}\0'.format(st.st_mtime_ns, st.st_size).encode())
+        hasher.update(hashlib.sha1(contents).digest())
+
+    return hasher.hexdigest()
+
 
 class Configurations:
 
     PATH_CONF_FILE = 'conf/paths.conf'
 
-    def __init__(self, tailseeker_dir, settings_file):
+    def __init__(self, tailseeker_dir, settings_file, cache_file=None):
         self.tailseeker_dir = tailseeker_dir
-        self.confdata = self.load_config(settings_file)
-        self.confdata = self.expand_sample_settings(self.confdata)
-        self.paths = self.load_paths()
+        self.source_files = []
+
+        if cache_file is None or not self.load_cache(cache_file, settings_file):
+            self.confdata = self.load_config(settings_file)
+            self.confdata = self.expand_sample_settings(self.confdata)
+            self.paths = self.load_paths()
+
+            if cache_file is not None:
+                self.save_cache(cache_file)
+
+    def load_cache(self, cache_file, settings_file):
+        # The cache is valid only if all files that were read to build it
+        # are unchanged, starting from the same settings file.
+        import pickle
+        import tailseeker
+
+        try:
+            with open(cache_file, 'rb') as cachef:
+                cached = pickle.load(cachef)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+        try:
+            if (cached['version'] != (CONFIG_CACHE_VERSION, tailseeker.__version__) or
+                    cached['source_files'][0] != self.source_name(settings_file) or
+                    cached['fingerprint'] != fingerprint_files(cached['source_files'])):
+                return False
+        except (KeyError, IndexError, TypeError):
+            return False
+
+        self.confdata = cached['confdata']
+        self.paths = cached['paths']
+        self.source_files = cached['source_files']
+
+        return True
+
+    def save_cache(self, cache_file):
+        import pickle
+        import tailseeker
+
+        if None in self.source_files:
+            return # settings were not read from a file
+
+        cached = {
+            'version': (CONFIG_CACHE_VERSION, tailseeker.__version__),
+            'source_files': self.source_files,
+            'fingerprint': fingerprint_files(self.source_files),
+            'confdata': self.confdata,
+            'paths': self.paths,
+        }
+
+        tmpfile = '{}.{}'.format(cache_file, os.getpid())
+        try:
+            with open(tmpfile, 'wb') as cachef:
+                pickle.dump(cached, cachef, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cache_file)
+        except OSError:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+    @staticmethod
+    def source_name(stream):
+        name = getattr(stream, 'name', None)
+        return os.path.abspath(name) if isinstance(name, str) else None
 
     def load_config(self, settings_file):
-        usersettings = yaml.load(settings_file)
+        self.source_files.append(self.source_name(settings_file))
+        usersettings = load_yaml(settings_file)
         if 'include' in usersettings:
             confdict = {}
 
@@ -106,7 +199,8 @@ class Configurations:
 
     def load_paths(self):
         pathconf = os.path.join(self.tailseeker_dir, self.PATH_CONF_FILE)
-        pathsettings = yaml.load(open(pathconf)) if os.path.exists(pathconf) else {}
+        self.source_files.append(os.path.abspath(pathconf))
+        pathsettings = load_yaml(open(pathconf)) if os.path.exists(pathconf) else {}
         if 'paths' in self.confdata:
             pathsettings.update(self.confdata['paths'])
 
@@ -143,7 +237,7 @@ def scan_selectable_confs(tailseeker_dir):
     conffiles = glob.glob(os.path.join(tailseeker_dir, 'conf', '*.conf'))
 
     for conffilename in conffiles:
-        confdata = yaml.load(open(conffilename))
+        confdata = load_yaml(open(conffilename))
         if 'name' in confdata:
             yield (confdata['name'], conffilename)
 
@@ -42,12 +42,25 @@ __all__ = [
     'LineParser', 'ParsedLine', 'ParsedLineComment', 'TemporaryDirectory',
     'ParallelMatchingFilter', 'ParallelMatchingReader',
     'open_gzip_pipe', 'open_gzip_buffered', 'MultiJoinIterator',
-    'open_bgzip_writer', 'merge_bgzf_files',
+    'open_bgzip_writer', 'merge_bgzf_files', 'PipedWriter',
+    'get_intermediate_codec', 'intermediate_compression_level',
+    'intermediate_bgzip_options', 'intermediate_bam_options',
 ]
 
 BASH_CMD = os.environ.get('BASH_CMD', '/bin/bash')
 BGZIP_CMD = os.environ.get('BGZIP_CMD', 'bgzip')
 
+# Compression of the intermediate files in scratch/, which are removed soon
+# after they are written. It is applied through the command-line options of
+# the programs writing them, which keep their gzip, BGZF or BAM containers.
+# `standard` keeps the defaults of the programs.
+INTERMEDIATE_CODECS = {
+    # name: deflate level
+    'standard': None,
+    'bgzf1': 1,
+    'none': 0,
+}
+
 
 BGZF_EOF_BLOCK = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03"
                   b"\x00\x00\x00\x00\x00\x00\x00\x00\x00")
@@ -380,6 +393,57 @@ def open_bgzip_writer(filename, mode='b'):
     )
 
 
+class PipedWriter(object):
+    """Writes to a file through a compressor running in a subprocess."""
+
+    def __init__(self, args, filename, mode='b'):
+        self.output = open(filename, 'wb')
+        self.proc = sp.Popen(args, stdin=sp.PIPE, stdout=self.output)
+        self.stream = io.TextIOWrapper(self.proc.stdin) if 't' in mode else self.proc.stdin
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def close(self):
+        self.stream.close()
+        retcode = self.proc.wait()
+        self.output.close()
+        if retcode != 0:
+            raise sp.CalledProcessError(retcode, self.proc.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def get_intermediate_codec(codec):
+    if codec not in INTERMEDIATE_CODECS:
+        raise ValueError("Unknown compression for intermediate files: {}".format(codec))
+    return codec
+
+
+def intermediate_compression_level(codec):
+    """Deflate level for intermediate files, or None for the default of the
+    program writing them."""
+    return INTERMEDIATE_CODECS[get_intermediate_codec(codec)]
+
+
+def intermediate_bgzip_options(codec):
+    level = intermediate_compression_level(codec)
+    return '' if level is None else '-l {}'.format(level)
+
+
+def intermediate_bam_options(codec):
+    """Options for `samtools view -b` and `samtools sort` writing BAM files
+    in scratch."""
+    level = intermediate_compression_level(codec)
+    if level is None:
+        return '', ''
+    return ('-u' if level == 0 else '-{}'.format(level)), '-l {}'.format(level)
+
+
 if __name__ == '__main__':
     for a, b in ParallelMatchingReader(open('t2ctemp.bed'), open('new-t2c-genome.bed'), 3, 3):
         print(list(a or ''), list(b or ''))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+"""
+Throughput counters for the long-running scripts.
+
+A script declares its stages and the counters and timers in them:
+
+    join = instrument.stage('join')
+    joined = join.counter('clusters')
+    samit = instrument.counted(parse_sam(inpf), join.counter('sam_records'),
+                               join.counter('bytes_read'))
+    output = instrument.counting_writer(output, join.counter('bytes_written'))
+    ...
+        joined.add()
+
+Counters are written as JSON lines to a status file in the directory given
+by the TAILSEEKER_STATUS_DIR environment variable every few seconds and
+when the process exits, with the rates per second since the previous
+update. Without the variable, the stages, counters and timers are shared
+objects doing nothing, and `counted` and `counting_writer` return their
+arguments as they are.
+"""
+
+__all__ = ['stage', 'counted', 'counting_writer', 'flush', 'enabled']
+
+import os
+import sys
+import time
+import threading
+
+STATUS_DIR_ENVVAR = 'TAILSEEKER_STATUS_DIR'
+FLUSH_INTERVAL_ENVVAR = 'TAILSEEKER_STATUS_INTERVAL'
+DEFAULT_FLUSH_INTERVAL = 10
+
+
+class Counter(object):
+
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, amount=1):
+        self.value += amount
+
+
+class Timer(object):
+
+    __slots__ = ['seconds', 'started']
+
+    def __init__(self):
+        self.seconds = 0.
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.seconds += time.perf_counter() - self.started
+
+
+class Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = {}
+        self.timers = {}
+        self.started = time.time()
+        self.last_flush = (self.started, {})
+
+    def counter(self, name):
+        if name not in self.counters:
+            self.counters[name] = Counter()
+        return self.counters[name]
+
+    def timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = Timer()
+        return self.timers[name]
+
+    def status(self, now):
+        last_time, last_values = self.last_flush
+        values = {name: c.value for name, c in self.counters.items()}
+        interval = now - last_time
+        rates = {name: (v - last_values.get(name, 0)) / interval if interval > 0 else 0.
+                 for name, v in values.items()}
+        self.last_flush = (now, values)
+
+        return {
+            'stage': self.name, 'elapsed': round(now - self.started, 3),
+            'counters': values,
+            'rates': {name: round(r, 1) for name, r in rates.items()},
+            'timers': {name: round(t.seconds, 3) for name, t in self.timers.items()},
+        }
+
+
+class NullCounter(object):
+
+    __slots__ = []
+    value = 0
+
+    def add(self, amount=1):
+        pass
+
+
+class NullTimer(object):
+
+    __slots__ = []
+    seconds = 0.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class NullStage(object):
+
+    def counter(self, name):
+        return NULL_COUNTER
+
+    def timer(self, name):
+        return NULL_TIMER
+
+
+NULL_COUNTER = NullCounter()
+NULL_TIMER = NullTimer()
+NULL_STAGE = NullStage()
+
+
+class StatusWriter(object):
+
+    def __init__(self, status_dir, interval):
+        self.status_dir = status_dir
+        self.interval = interval
+        self.pid = os.getpid()
+        self.stages = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        script = os.path.basename(sys.argv[0] or 'python')
+        if script.endswith('.py'):
+            script = script[:-3]
+        self.script = script
+        self.filename = os.path.join(status_dir, '{}.{}.jsonl'.format(script, self.pid))
+
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add_stage(self, stage):
+        with self.lock:
+            self.stages.append(stage)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self, final=False):
+        import json
+
+        now = time.time()
+        with self.lock:
+            lines = [json.dumps(dict(stage.status(now), time=round(now, 3),
+                                     script=self.script, pid=self.pid,
+                                     final=final))
+                     for stage in self.stages]
+
+        if not lines:
+            return
+
+        try:
+            os.makedirs(self.status_dir, exist_ok=True)
+            with open(self.filename, 'a') as outf:
+                outf.write(''.join(line + '\n' for line in lines))
+        except OSError:
+            pass # the status is only informational
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.stopped.set()
+            self.flush(final=True)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def enabled():
+    return bool(os.environ.get(STATUS_DIR_ENVVAR))
+
+
+def _get_writer():
+    global _writer
+
+    with _writer_lock:
+        # Processes forked by multiprocessing start a writer of their own.
+        if _writer is None or _writer.pid != os.getpid():
+            import atexit
+
+            interval = float(os.environ.get(FLUSH_INTERVAL_ENVVAR, DEFAULT_FLUSH_INTERVAL))
+            _writer = StatusWriter(os.environ[STATUS_DIR_ENVVAR], interval)
+            atexit.register(_writer.close)
+
+        return _writer
+
+
+def stage(name):
+    """Create a stage, which is a named group of counters and timers."""
+    if not enabled():
+        return NULL_STAGE
+
+    newstage = Stage(name)
+    _get_writer().add_stage(newstage)
+    return newstage
+
+
+def flush():
+    """Write out the current status. Worker processes which exit without
+    running the exit handlers, such as those of multiprocessing, need to
+    call this at the end of each task."""
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+
+def counted(iterable, records, bytes_read=None):
+    """Count the items of an iterable, and the sizes of their `line`
+    attributes if `bytes_read` is given, as they pass by."""
+    if records is NULL_COUNTER:
+        return iterable
+
+    def count_records():
+        for item in iterable:
+            records.value += 1
+            yield item
+
+    def count_records_and_bytes():
+        for item in iterable:
+            records.value += 1
+            bytes_read.value += len(item.line)
+            yield item
+
+    if bytes_read is None or bytes_read is NULL_COUNTER:
+        return count_records()
+    else:
+        return count_records_and_bytes()
+
+
+class CountingWriter(object):
+
+    def __init__(self, fileobj, counter):
+        self.fileobj = fileobj
+        self.counter = counter
+
+    def write(self, data):
+        self.counter.value += len(data)
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def counting_writer(fileobj, counter):
+    """Count the size of data written to a file object."""
+    if counter is NULL_COUNTER:
+        return fileobj
+    return CountingWriter(fileobj, counter)
@@ -56,23 +56,35 @@ rule contaminant_alignment:
                 --outTmpDir {params.scratch}/tmp \
                 --outFileNamePrefix {params.scratch}/')
 
+        # The list is loaded in whole by the filters. It needs no sorting.
         shell('split -n r/1/4 {params.scratch}/Unmapped.out.mate1 | \
-               colrm 1 1 | cut -d/ -f1 | sort > {output}')
+               colrm 1 1 | cut -d/ -f1 > {output}')
         shutil.rmtree(params.scratch)
 
 
-if CONF['read_filtering']['contaminant_filtering']:
+KEEP_FILTERED_FASTQ = CONF['read_filtering']['keep_filtered_fastq']
+if CONF['read_filtering']['contaminant_filtering'] and KEEP_FILTERED_FASTQ:
     TARGETS.extend(expand('fastq-filtered/{sample}_{read}.fastq.gz',
                           sample=EXP_SAMPLES, read=['R5', 'R3']))
+    filtered_fastq = lambda filename: filename
+else:
+    filtered_fastq = temp
 
+# Both reads of a sample are filtered in the same pass as the mates are in
+# the same order.
 rule make_filtered_fastq:
     input:
-        fastq='fastq/{sample}_{read}.fastq.gz',
+        R5='fastq/{sample}_R5.fastq.gz',
+        R3='fastq/{sample}_R3.fastq.gz',
         survivorids='scratch/contaminants-unmapped/{sample}.txt'
-    output: 'fastq-filtered/{sample}_{read,[^_]+}.fastq.gz'
-    threads: 2
-    shell: '{SEQTK_CMD} subseq {input.fastq} {input.survivorids} | \
-            {BGZIP_CMD} -@ {threads} -c > {output}'
+    output:
+        R5=filtered_fastq('fastq-filtered/{sample}_R5.fastq.gz'),
+        R3=filtered_fastq('fastq-filtered/{sample}_R3.fastq.gz')
+    threads: 4
+    shell: '{PYTHON3_CMD} {SCRIPTSDIR}/filter-paired-fastq.py \
+                --read-ids {input.survivorids} \
+                --fastq5 {input.R5} --fastq3 {input.R3} \
+                --output5 {output.R5} --output3 {output.R3} --threads {threads}'
 
 # ---
 # Sequence alignment to the genome.
@@ -81,56 +93,123 @@ rule make_filtered_fastq:
 TARGETS.extend(expand('alignments/{sample}_{type}.bam{suffix}',
                       sample=EXP_SAMPLES, type=['single', 'paired'], suffix=['', '.bai']))
 
+# With performance.stream_intermediates, the contaminant filter and the merging
+# of alignments run in the same job as STAR, connected by pipes instead of
+# the files in between. Merging with GSNAP alignments needs the outputs of
+# other jobs, and is always done separately. The filter is streamed only
+# when the filtered FASTQ files are not kept, as they would be written
+# by a separate job anyway.
+STREAM_INTERMEDIATES = CONF['performance']['stream_intermediates']
+STREAM_MERGING = STREAM_INTERMEDIATES and not CONF['performance']['enable_gsnap']
+STREAM_FILTERING = (STREAM_INTERMEDIATES and not KEEP_FILTERED_FASTQ and
+                    CONF['read_filtering']['contaminant_filtering'])
+
+def taginfo_for_merging(sample):
+    return expand('scratch/taginfo-fl-r{round:02d}/{sample}_{tile}.txt.gz',
+                  sample=sample, tile=TILES,
+                  round=[CONF['polyA_ruler']['signal_resampling_rounds'] + 1])
+
 def inputs_for_STAR_alignment(wildcards):
     fastq_filename = 'fastq{filtered_suffix}/{sample}_{{read}}.fastq.gz'.format(
                             sample=wildcards.sample,
                             filtered_suffix='-filtered'
-                                            if CONF['read_filtering']['contaminant_filtering']
+                                            if (CONF['read_filtering']['contaminant_filtering']
+                                                and not STREAM_FILTERING)
                                             else '')
 
     inputs = [fastq_filename.format(read='R5')]
     if wildcards.type == 'paired':
         inputs.append(fastq_filename.format(read='R3'))
+    if STREAM_FILTERING:
+        inputs.append('scratch/contaminants-unmapped/{}.txt'.format(wildcards.sample))
+    if STREAM_MERGING:
+        inputs.extend(taginfo_for_merging(wildcards.sample))
     return inputs
 
 rule STAR_alignment:
     input: inputs_for_STAR_alignment
     output:
-        mapped=temp('scratch/alignments/{sample}_STAR_{type,[^_.]+}.bam'),
+        mapped=temp('scratch/merged-alignments/{sample}_{type,[^_.]+}.bam'
+                    if STREAM_MERGING else
+                    'scratch/alignments/{sample}_STAR_{type,[^_.]+}.bam'),
         unmapped5=temp('scratch/unmapped-reads/{sample}-{type}_R5.fastq.gz'),
         unmapped3=temp('scratch/unmapped-reads/{sample}-{type}_R3.fastq.gz'),
         transcriptome=temp('scratch/tr-alignments/{sample}_{type}.bam')
     threads: THREADS_MAXIMUM_CORE
-    params: scratch='scratch/STAR-{sample}-{type}'
+    params:
+        scratch='scratch/STAR-{sample}-{type}',
+        sorttmp='scratch/alignments/{sample}_merge_{type}'
     run:
         genomedir = os.path.join(TAILSEEKER_DIR, 'refdb', 'level2',
                         CONF['reference_set'][wildcards.sample], 'index.star')
+        taginfo = ' '.join(f for f in input if f.startswith('scratch/taginfo-fl-'))
         input = suffix_filter(input)
+        fastqs = [f for f in (input['R5.fastq.gz'], input['R3.fastq.gz']) if f]
+
+        if STREAM_MERGING:
+            mapped_output = ('| {samtools} sort -n -@ {threads} -T {sorttmp} {sortopt} -O sam - | '
+                             '{python} {scriptsdir}/add-sam-tags-primary.py {taginfo} | '
+                             '{samtools} view -@ {threads} -b {bamopt} -o {output} -').format(
+                                samtools=SAMTOOLS_CMD, python=PYTHON3_CMD,
+                                scriptsdir=SCRIPTSDIR, threads=threads,
+                                sorttmp=params.sorttmp, taginfo=taginfo,
+                                bamopt=INTERMEDIATE_BAM_VIEW_OPT,
+                                sortopt=INTERMEDIATE_BAM_SORT_OPT, output=output.mapped)
+        else:
+            mapped_output = '> ' + output.mapped
 
         if os.path.isdir(params.scratch):
             shutil.rmtree(params.scratch)
         os.makedirs(params.scratch)
 
+        # The filtered reads are fed through named pipes by background
+        # jobs, which are waited for after STAR to catch their failures.
+        # They are killed if STAR fails before opening the pipes. Each
+        # mate has its own filter, so that neither blocks on a pipe that
+        # STAR is not reading at the moment.
+        if STREAM_FILTERING:
+            fifos = [os.path.join(params.scratch, 'filtered_{}.fastq'.format(i + 1))
+                     for i in range(len(fastqs))]
+            for fifo in fifos:
+                os.mkfifo(fifo)
+            readfiles_opts = ' '.join(fifos)
+            filter_start = ('filterpids=""; '
+                            'trap \'kill $filterpids 2>/dev/null || true\' EXIT; ' +
+                            ''.join('{} {}/filter-paired-fastq.py --read-ids {} '
+                                    '--fastq5 {} --output5 {} --uncompressed & '
+                                    'filterpids="$filterpids $!"; '
+                                    .format(PYTHON3_CMD, SCRIPTSDIR, input['.txt'],
+                                            fastq, fifo)
+                                    for fastq, fifo in zip(fastqs, fifos)))
+            filter_finish = '; for pid in $filterpids; do wait $pid; done'
+        else:
+            readfiles_opts = ' '.join(fastqs) + ' --readFilesCommand zcat'
+            filter_start = filter_finish = ''
+
         if CONF['performance']['enable_gsnap']:
             unmapped_opts = '--outSAMunmapped None --outReadsUnmapped Fastx '
         else:
             unmapped_opts = '--outSAMunmapped Within KeepPairs --outReadsUnmapped None '
 
-        shell('{STAR_CMD} --runThreadN {threads} --genomeDir {genomedir} \
-                --readFilesIn {input[R5.fastq.gz]} {input[R3.fastq.gz]} \
-                --readFilesCommand zcat \
+        # Both BAM outputs of STAR are intermediate files.
+        compression_level = fileutils.intermediate_compression_level(INTERMEDIATE_CODEC)
+        compression_opts = ('--outBAMcompression {}'.format(compression_level)
+                            if compression_level is not None else '')
+
+        shell('{filter_start}{STAR_CMD} --runThreadN {threads} --genomeDir {genomedir} \
+                --readFilesIn {readfiles_opts} \
                 --outFilterType BySJout \
                 --alignSJoverhangMin 8 --alignSJDBoverhangMin 1 \
                 --outFilterMismatchNmax 999 \
                 --alignIntronMin 15 --alignIntronMax 1000000 \
                 --alignMatesGapMax 1000000 --runRNGseed 8809 \
-                --outSAMtype BAM Unsorted --sysShell {BASH_CMD} \
+                --outSAMtype BAM Unsorted {compression_opts} --sysShell {BASH_CMD} \
                 --quantMode TranscriptomeSAM \
                 --quantTranscriptomeBan Singleend \
                 --outTmpDir {params.scratch}/tmp --outStd BAM_Unsorted \
                 --outFileNamePrefix {params.scratch}/ \
                 {unmapped_opts} --outMultimapperOrder Random \
-                --outSAMmapqUnique 41 > {output.mapped}')
+                --outSAMmapqUnique 41 {mapped_output}{filter_finish}')
         shell('mv -f "{params.scratch}/Aligned.toTranscriptome.out.bam" \
                      {output.transcriptome}')
 
@@ -139,7 +218,8 @@ rule STAR_alignment:
             gzip.open(output.unmapped5, 'w')
             gzip.open(output.unmapped3, 'w')
         elif wildcards.type == 'single':
-            shell('{BGZIP_CMD} -@ {threads} -c {params.scratch}/Unmapped.out.mate1 \
+            shell('{BGZIP_CMD} {INTERMEDIATE_BGZIP_OPT} -@ {threads} \
+                    -c {params.scratch}/Unmapped.out.mate1 \
                     > {output.unmapped5} && rm -f {params.scratch}/Unmapped.out.mate1')
             gzip.open(output.unmapped3, 'w')
         else:
@@ -151,7 +231,8 @@ rule STAR_alignment:
                             sort -k1,1 -t'\b' | \
                             awk -F'\b' '{{ \
                                 printf("%s\\n%s\\n%s\\n%s\\n", $1, $2, $3, $4); }}' | \
-                            {BGZIP_CMD} -@ {threads} -c > {outputfile}''')
+                            {BGZIP_CMD} {INTERMEDIATE_BGZIP_OPT} -@ {threads} \
+                                -c > {outputfile}''')
 
                 shell('rm -f {params.scratch}/Unmapped.out.mate{mateno}')
 
@@ -177,7 +258,8 @@ rule GSNAP_alignment:
 
         shell('{GSNAP_CMD} -D {genomedir} -d genome -A sam -B 4 --gunzip -q {partno} \
                 -s {genomedir}/splicesites.iit -m 0.05 -t {threads} \
-                {input} | {SAMTOOLS_CMD} view -@ 3 -bS - > {output}')
+                {input} | {SAMTOOLS_CMD} view -@ 3 -bS {INTERMEDIATE_BAM_VIEW_OPT} - \
+                > {output}')
 
 if CONF['performance']['enable_gsnap']:
     if 'gsnap' not in CONF.paths:
@@ -199,10 +281,11 @@ if CONF['performance']['enable_gsnap']:
         # samtools 1.3 merge does not respect `-n' option for paired alignments.
         shell: '{SAMTOOLS_CMD} merge -n -u -h {input.star} -@ {threads} - \
                     {input.star} {input.gsnap} | \
-                {SAMTOOLS_CMD} sort -n -@ {threads} -T {params.sorttmp} -O sam - | \
+                {SAMTOOLS_CMD} sort -n -@ {threads} -T {params.sorttmp} \
+                    {INTERMEDIATE_BAM_SORT_OPT} -O sam - | \
                 {PYTHON3_CMD} {SCRIPTSDIR}/add-sam-tags-primary.py {input.taginfo} | \
-                {SAMTOOLS_CMD} view -@ {threads} -b -o {output} -'
-else:
+                {SAMTOOLS_CMD} view -@ {threads} -b {INTERMEDIATE_BAM_VIEW_OPT} -o {output} -'
+elif not STREAM_MERGING:
     rule merge_alignments:
         input:
             star='scratch/alignments/{sample}_STAR_{type}.bam',
@@ -212,9 +295,10 @@ else:
         output: temp('scratch/merged-alignments/{sample}_{type,[^_.]+}.bam')
         threads: THREADS_MAXIMUM_CORE
         params: sorttmp='scratch/alignments/{sample}_merge_{type}'
-        shell: '{SAMTOOLS_CMD} sort -n -@ {threads} -T {params.sorttmp} -O sam {input.star} | \
+        shell: '{SAMTOOLS_CMD} sort -n -@ {threads} -T {params.sorttmp} \
+                    {INTERMEDIATE_BAM_SORT_OPT} -O sam {input.star} | \
                 {PYTHON3_CMD} {SCRIPTSDIR}/add-sam-tags-primary.py {input.taginfo} | \
-                {SAMTOOLS_CMD} view -@ {threads} -b -o {output} -'
+                {SAMTOOLS_CMD} view -@ {threads} -b {INTERMEDIATE_BAM_VIEW_OPT} -o {output} -'
 
 
 # ---
@@ -235,6 +319,7 @@ rule reevaluate_tails:
         alignment='scratch/merged-alignments/{sample}_paired.bam'
     output: temp('refined-taginfo/{sample}.txt.pre.gz')
     threads: THREADS_MAXIMUM_CORE
+    params: checkpoints='scratch/refine-checkpoints/{sample}'
     run:
         genomedir = os.path.join(TAILSEEKER_DIR, 'refdb', 'level2',
                                  CONF['reference_set'][wildcards.sample])
@@ -250,8 +335,10 @@ rule reevaluate_tails:
         shell('{SCRIPTSDIR}/refine-modifications.py \
                 --parallel {threads} \
                 --taginfo {input.taginfo} --alignment {input.alignment} \
-                --reference-seq {genomedir}/genome.fa {analytic_options} | \
-                {BGZIP_CMD} -c > {output}')
+                --reference-seq {genomedir}/genome.fa {analytic_options} \
+                --checkpoint-dir {params.checkpoints} | \
+                {BGZIP_CMD} {INTERMEDIATE_BGZIP_OPT} -c > {output}')
+        shutil.rmtree(params.checkpoints)
 
 rule generate_short_polya_list:
     input: 'refined-taginfo/{sample}.txt.pre.gz'
@@ -379,18 +466,85 @@ rule sort_alignments:
     params: sorttmp='scratch/merged-alignments/{sample}_{type}'
     shell: '{SAMTOOLS_CMD} view -h {input.bam} | \
             {PYTHON3_CMD} {SCRIPTSDIR}/add-sam-tags-refined.py {input.taginfo} | \
-            {SAMTOOLS_CMD} sort -@ {threads} -T {params.sorttmp} -o {output} -'
+            {SAMTOOLS_CMD} sort -@ {threads} -T {params.sorttmp} \
+                {INTERMEDIATE_BAM_SORT_OPT} -o {output} -'
 
 rule index_sorted_alignments:
     input: 'scratch/sorted-alignments/{name}.bam'
     output: temp('scratch/sorted-alignments/{name}.bam.bai')
     shell: '{SAMTOOLS_CMD} index -b {input} {output}'
 
+# With performance.alignment_shards, the coordinate-sorted alignments are
+# split into groups of whole references to find and filter the duplicates
+# and to associate the tags to genes in parallel. Duplicates are always on
+# the same reference, and the results of the shards are merged in order.
+ALIGNMENT_SHARDS = CONF['performance']['alignment_shards']
+
+if not ALIGNMENT_SHARDS:
+    DEDUP_SOURCE = 'scratch/sorted-alignments/{sample}_{type}.bam'
+    DEDUP_SINGLE_SOURCE = 'scratch/sorted-alignments/{sample}_single.bam'
+    DEDUP_DUPLICATES = 'scratch/approx-duplicates/{sample}.txt'
+    DEDUP_OUTPUT = 'alignments/{sample}_{type,[^_.]+}.bam'
+else:
+    DEDUP_SOURCE = 'scratch/alignment-shards/{sample}_{type}-{shard}.bam'
+    DEDUP_SINGLE_SOURCE = 'scratch/alignment-shards/{sample}_single-{shard}.bam'
+    DEDUP_DUPLICATES = 'scratch/alignment-shards/{sample}-{shard,[0-9]+}.duplicates.txt'
+    DEDUP_OUTPUT = temp('scratch/alignment-shards/'
+                        '{sample}_{type,[^_.]+}-{shard,[0-9]+}.filtered.bam')
+
+    rule plan_alignment_shards:
+        input:
+            bam='scratch/sorted-alignments/{sample}_{type}.bam',
+            bamidx='scratch/sorted-alignments/{sample}_{type}.bam.bai'
+        output: temp('scratch/alignment-shards/{sample}_{type,[^_.]+}.regions')
+        run:
+            from tailseeker import sharding
+            stats = sharding.read_idxstats(input.bam, SAMTOOLS_CMD)
+            sharding.write_shard_plan(output[0],
+                sharding.partition_references(stats, ALIGNMENT_SHARDS))
+
+    rule extract_alignment_shard:
+        input:
+            bam='scratch/sorted-alignments/{sample}_{type}.bam',
+            bamidx='scratch/sorted-alignments/{sample}_{type}.bam.bai',
+            plan='scratch/alignment-shards/{sample}_{type}.regions'
+        output: temp('scratch/alignment-shards/{sample}_{type,[^_.]+}-{shard,[0-9]+}.bam')
+        run:
+            import shlex
+            from tailseeker import sharding
+            regions = sharding.load_shard_regions(input.plan, wildcards.shard)
+            if regions:
+                shell('{SAMTOOLS_CMD} view -b {INTERMEDIATE_BAM_VIEW_OPT} -o {output} \
+                        {input.bam} ' + ' '.join(map(shlex.quote, regions)))
+            else:
+                shell('{SAMTOOLS_CMD} view -H -b {INTERMEDIATE_BAM_VIEW_OPT} \
+                        -o {output} {input.bam}')
+
+    rule index_alignment_shard:
+        input: 'scratch/alignment-shards/{name}.bam'
+        output: temp('scratch/alignment-shards/{name}.bam.bai')
+        shell: '{SAMTOOLS_CMD} index -b {input} {output}'
+
+    rule merge_sharded_duplicates:
+        input:
+            expand('scratch/alignment-shards/{{sample}}-{shard}.duplicates.txt',
+                   shard=range(ALIGNMENT_SHARDS))
+        output: temp('scratch/approx-duplicates/{sample}.txt')
+        shell: 'sort -m -k4,4 {input} | uniq -f 3 > {output}'
+
+    # The BGZF blocks of the filtered shards are copied as they are.
+    rule concatenate_alignment_shards:
+        input:
+            expand('scratch/alignment-shards/{{sample}}_{{type}}-{shard}.filtered.bam',
+                   shard=range(ALIGNMENT_SHARDS))
+        output: 'alignments/{sample}_{type,[^_.]+}.bam'
+        shell: '{SAMTOOLS_CMD} cat -o {output} {input}'
+
 rule find_approximate_duplicates:
     input:
-        bam='scratch/sorted-alignments/{sample}_single.bam',
-        bamidx='scratch/sorted-alignments/{sample}_single.bam.bai',
-    output: temp('scratch/approx-duplicates/{sample}.txt')
+        bam=DEDUP_SINGLE_SOURCE,
+        bamidx=DEDUP_SINGLE_SOURCE + '.bai',
+    output: temp(DEDUP_DUPLICATES)
     threads: 6
     run:
         dedupopts = CONF['approximate_duplicate_elimination']
@@ -401,9 +555,9 @@ rule find_approximate_duplicates:
 
 rule filter_approximate_duplicates:
     input:
-        bam='scratch/sorted-alignments/{sample}_{type}.bam',
+        bam=DEDUP_SOURCE,
         dupinfo='scratch/approx-duplicates/{sample}.txt'
-    output: 'alignments/{sample}_{type,[^_.]+}.bam'
+    output: DEDUP_OUTPUT
     threads: 3
     shell: '{PYTHON3_CMD} {SCRIPTSDIR}/filter-approximate-duplicates.py \
                 --bam {input.bam} --duplicates {input.dupinfo} | \
@@ -486,9 +640,23 @@ rule plot_global_polya_length_histogram_level2:
 
 TARGETS.extend(expand('associations/{sample}.txt.gz', sample=EXP_SAMPLES))
 
+if not ALIGNMENT_SHARDS:
+    ASSOCIATION_SOURCE = 'alignments/{sample}_single.bam'
+    ASSOCIATION_OUTPUT = 'scratch/associations/{sample}.txt'
+else:
+    ASSOCIATION_SOURCE = 'scratch/alignment-shards/{sample}_single-{shard}.filtered.bam'
+    ASSOCIATION_OUTPUT = 'scratch/alignment-shards/{sample}-{shard,[0-9]+}.associations.txt'
+
+    rule merge_sharded_associations:
+        input:
+            expand('scratch/alignment-shards/{{sample}}-{shard}.associations.txt',
+                   shard=range(ALIGNMENT_SHARDS))
+        output: temp('scratch/associations/{sample}.txt')
+        shell: 'sort -m -k1,2 {input} | uniq > {output}'
+
 rule associate_tags_to_genes:
-    input: 'alignments/{sample}_single.bam'
-    output: temp('scratch/associations/{sample}.txt')
+    input: ASSOCIATION_SOURCE
+    output: temp(ASSOCIATION_OUTPUT)
     threads: 4
     run:
         genomedir = os.path.join(TAILSEEKER_DIR, 'refdb', 'level2',
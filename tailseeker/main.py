@@ -42,6 +42,20 @@ for badtile in CONF['input_filtering']['blacklisted_tiles']:
     if badtile in TILES:
         del TILES[badtile]
 
+# A preview runs the level-1 analysis on some of the tiles for a quick look.
+PREVIEW = CONF['preview']['enabled']
+if PREVIEW:
+    previewed_tiles = sequencers.select_preview_tiles(TILES, CONF['preview']['tiles'])
+    PREVIEW_LABEL = 'PREVIEW: {} of {} tiles'.format(len(previewed_tiles), len(TILES))
+    TILES = previewed_tiles
+    if CONF['preview']['clusters_per_tile'] > 0:
+        PREVIEW_LABEL += ', up to {} clusters each'.format(
+                            CONF['preview']['clusters_per_tile'])
+    ANALYSIS_LEVEL = 1
+else:
+    PREVIEW_LABEL = ''
+    ANALYSIS_LEVEL = CONF['analysis_level']
+
 EXP_SAMPLES = CONF.exp_samples
 SPIKEIN_SAMPLES = CONF.spikein_samples
 ALL_SAMPLES = sorted(EXP_SAMPLES + SPIKEIN_SAMPLES)
@@ -56,6 +70,13 @@ NUM_CYCLES = LAST_CYCLE - FIRST_CYCLE + 1
 
 THREADS_MAXIMUM_CORE = CONF['maximum_threads']
 
+# Larger tiles are started first, so that the smaller ones fill up the
+# remaining cores at the end.
+TILE_COSTS = sequencers.estimate_tile_costs(TILES, NUM_CYCLES,
+                ['scratch/taginfo/*_{tile}.txt.gz', 'scratch/signals/*_{tile}.sigpack'])
+if CONF['performance']['tile_cost_balancing']:
+    prioritize_wildcard_values('tile', sequencers.rank_tile_costs(TILE_COSTS))
+
 INTERMEDIATE_DIRS = [
     'dupfilter', 'polya', 'scores', 'scratch',
     'sequences', 'signalproc', 'learning',
@@ -222,20 +243,36 @@ rule calculate_optimal_parameters:
         external_script('{PYTHON3_CMD} {SCRIPTSDIR}/calculate-optimal-parameters.py')
 
 
+def inputs_from_previous_resampling_round(pattern, rounds_back, **kwds):
+    def resolve(wildcards):
+        if int(wildcards.round) < 2:
+            return []
+        return expand(pattern, round='{:02d}'.format(int(wildcards.round) - rounds_back),
+                      tile=wildcards.tile, **kwds)
+    return resolve
+
 # A single job of this task is generally very light (<~1s). The tasks are
 # processed as grouped within a same tile to save the overheads by
-# the pipeline itself.
+# the pipeline itself. From the second round on, the outputs of the previous
+# round are reused as they are when the score cutoffs have converged.
 rule measure_polya_lengths_from_fluorescence:
     input:
         signals=expand('scratch/signals/{sample}_{{tile}}.sigpack', sample=ALL_SAMPLES),
         taginfo=expand('scratch/taginfo/{sample}_{{tile}}.txt.gz', sample=ALL_SAMPLES),
         score_cutoffs=lambda wc: (
-            'scratch/sigdists-r{round:02d}/signal-cutoffs.txt'.format(round=int(wc.round)-1))
+            'scratch/sigdists-r{round:02d}/signal-cutoffs.txt'.format(round=int(wc.round)-1)),
+        prev_score_cutoffs=inputs_from_previous_resampling_round(
+            'scratch/sigdists-r{round}/signal-cutoffs.txt', 2),
+        prev_taginfo=inputs_from_previous_resampling_round(
+            'scratch/taginfo-fl-r{round}/{sample}_{tile}.txt.gz', 1, sample=ALL_SAMPLES),
+        prev_sigdists=inputs_from_previous_resampling_round(
+            'scratch/sigdists-r{round}/pos_{tile}.sigdists', 1)
     output:
         taginfo=map(temp, expand('scratch/taginfo-fl-r{{round,[^0].|.[^0]}}/'
                                  '{sample}_{{tile,[^_]+}}.txt.gz', sample=ALL_SAMPLES)),
         sigdists=temp('scratch/sigdists-r{round,[^0].|.[^0]}/pos_{tile}.sigdists')
     params: CONF=CONF.confdata, BINDIR=BINDIR, BGZIP_CMD=BGZIP_CMD
+    threads: min(THREADS_MAXIMUM_CORE, len(ALL_SAMPLES))
     run:
         external_script('{PYTHON3_CMD} {SCRIPTSDIR}/measure-polya-lengths.py')
 
@@ -265,23 +302,23 @@ rule merge_and_deduplicate_taginfo:
     output:
         taginfo='taginfo/{sample}.txt.gz',
         duptrace=temp('scratch/stats/perfdup-traces-{sample}.txt.gz')
-    threads: 12
+    params: memory_limit=CONF['performance']['maximum_buffer_size']
+    threads: 4
     run:
         sorted_input = sorted(input)
         if wildcards.sample in EXP_SAMPLES:
-            shell('zcat {sorted_input} | \
-                env BGZIP_OPT="-@ {threads}" sort -t "\t" -k6,6 -k1,1 -k2,2n \
-                    --compress-program={BINDIR}/bgzip-wrap --parallel={threads} | \
-                {BINDIR}/tailseq-dedup-perfect {output.duptrace} | \
-                env BGZIP_OPT="-@ {threads}" sort -t "\t" -k1,1 -k2,2n \
-                    --compress-program={BINDIR}/bgzip-wrap --parallel={threads} | \
+            # The tile files are read one at a time in their (tile, cluster)
+            # order while duplicates are collected by UMI. No global sorting
+            # is needed.
+            shell('{BINDIR}/tailseq-dedup-perfect -m {params.memory_limit} \
+                    -T {SCRATCHDIR} {output.duptrace} {sorted_input} | \
                 {BGZIP_CMD} -@ {threads} -c > {output.taginfo}')
         elif wildcards.sample in SPIKEIN_SAMPLES:
             shell('{SCRIPTSDIR}/bgzf-merge.py --output {output.taginfo} {sorted_input}')
             shell('echo -n "" | gzip -c - > {output.duptrace}')
 
 
-if CONF['analysis_level'] >= 2 and CONF['read_filtering']['contaminant_filtering']:
+if ANALYSIS_LEVEL >= 2 and CONF['read_filtering']['contaminant_filtering']:
     temp_primary_fastq = temp
     INTERMEDIATE_DIRS.append('fastq')
 else:
@@ -299,7 +336,7 @@ rule produce_fastq_outputs:
     threads: THREADS_MAXIMUM_CORE
     params: seqqual_filename='scratch/seqqual/{sample}_@tile@.txt.gz'
     run:
-        verbosity_opt = '--fastq-id-verbose ' if CONF['analysis_level'] <= 1 else ''
+        verbosity_opt = '--fastq-id-verbose ' if ANALYSIS_LEVEL <= 1 else ''
         shell('{BINDIR}/tailseq-writefastq \
                 --taginfo {input.taginfo} --seqqual \'{params.seqqual_filename}\' \
                 --fastq5 {output.R5} --fastq3 {output.R3} \
@@ -329,11 +366,12 @@ rule plot_global_polya_length_virtual_gel:
         minimum_polya_length=CONF['qcstats']['virtual_gel_minimum_polya']
     run:
         samples = '--samples ' + ','.join(EXP_SAMPLES) if EXP_SAMPLES else ''
+        label = "--label '{}'".format(PREVIEW_LABEL) if PREVIEW else ''
         shell('{PYTHON3_CMD} {SCRIPTSDIR}/plot-virtual-gel.py \
                     --tagcounts {input} --controls {params.controls} \
                     --minimum-polya-length {params.minimum_polya_length} \
                     --kde-bandwidth {params.kde_bandwidth} \
-                    {samples} --output-plot {output}')
+                    {samples} {label} --output-plot {output}')
 
 
 TARGETS.append('qcplots/global-polya-length-histogram-L1.pdf')
@@ -344,7 +382,8 @@ rule plot_global_polya_length_histogram:
         exclude=SPIKEIN_SAMPLES,
         kde_bandwidth=CONF['qcstats']['histogram_kde_bandwidth'],
         minimum_polya_length=CONF['qcstats']['histogram_minimum_polya'],
-        x_transform_factor=CONF['qcstats']['histogram_xscale_factor']
+        x_transform_factor=CONF['qcstats']['histogram_xscale_factor'],
+        label=PREVIEW_LABEL
     script: SCRIPTSDIR + '/plot-polya-len-histogram.py'
 
 
@@ -360,17 +399,78 @@ if 'spikein_lengths' in CONF and len(CONF['spikein_lengths']) > 0:
         run:
             controlsamples = ' '.join('{}:{}'.format(CONF['spikein_lengths'][s], s)
                                       for s in SPIKEIN_SAMPLES)
+            label = "--label '{}'".format(PREVIEW_LABEL) if PREVIEW else ''
 
             shell('{PYTHON3_CMD} {SCRIPTSDIR}/plot-polya-calls-accuracy.py \
                         --control {controlsamples} --output-plot {output.plotout} \
-                        --output-stats {output.statsout} \
+                        --output-stats {output.statsout} {label} \
                         --input {input}')
 
 
-if CONF['analysis_level'] >= 2:
+if PREVIEW:
+    TARGETS.append('PREVIEW.txt')
+    localrules: write_preview_note
+
+    rule write_preview_note:
+        output: 'PREVIEW.txt'
+        run:
+            with open(output[0], 'w') as outf:
+                print(PREVIEW_LABEL, file=outf)
+                print('The outputs are from these tiles only:', file=outf)
+                for tileid in sorted(TILES):
+                    print(tileid, file=outf)
+
+
+if ANALYSIS_LEVEL >= 2:
     include: os.path.join(TAILSEEKER_DIR, 'tailseeker', 'level2_analysis.py')
 
-if CONF['analysis_level'] >= 3:
+if ANALYSIS_LEVEL >= 3:
     include: os.path.join(TAILSEEKER_DIR, 'tailseeker', 'level3_analysis.py')
 
+
+# The scratch space of a job is predicted in proportion to the size of the
+# raw data of its tile, or of the whole run shared evenly by the samples and
+# the shards of their alignments. It is zero when the raw data are not found.
+if SCRATCH_ACCOUNTING:
+    RAW_DATA_SIZES = sequencers.estimate_raw_data_sizes(TILES, NUM_CYCLES)
+
+    def scratch_unit_bytes(wildcards):
+        """Raw data size for the job with `wildcards`. A tile of None stands
+        for the largest one."""
+        total = sum(RAW_DATA_SIZES.values())
+        if 'tile' in wildcards:
+            if wildcards['tile'] is None:
+                return max(list(RAW_DATA_SIZES.values()) or [0])
+            return RAW_DATA_SIZES.get(wildcards['tile'], 0)
+        elif 'shard' in wildcards:
+            return total // len(ALL_SAMPLES) // ALIGNMENT_SHARDS
+        elif 'sample' in wildcards:
+            return total // len(ALL_SAMPLES)
+        else:
+            return total
+
+    def record_scratch_outputs(job):
+        wildcards = job.wildcards_dict or {}
+        scratchspace.record_job_outputs(SCRATCH_RECORDS, SCRATCHDIR, job.rule.name,
+                                        wildcards, job.expanded_output,
+                                        scratch_unit_bytes(wildcards))
+
+    on_job_finished(record_scratch_outputs)
+
+    # Snakemake takes only integer resources, so every job of a rule claims
+    # the space predicted for its largest one.
+    if SCRATCH_QUOTA_MB > 0:
+        SCRATCH_ESTIMATOR = scratchspace.ScratchEstimator(SCRATCH_RECORDS)
+        for rule_ in workflow.rules:
+            if not any(scratchspace.in_directory(f, SCRATCHDIR) for f in rule_.output):
+                continue
+
+            claim = SCRATCH_ESTIMATOR.estimate_mb(rule_.name,
+                        scratch_unit_bytes(dict.fromkeys(rule_.wildcard_names)))
+            if claim is not None:
+                rule_.resources['scratch_mb'] = claim
+            else:
+                logger.warning('Scratch space for {} is not limited without its raw '
+                               'data or a record of a previous run.'.format(rule_.name))
+
 # ex: syntax=snakemake
@@ -29,14 +29,16 @@ __all__ = [
     'colormap_lch',
     'estimate_2d_density',
     'apply_dropped_spine',
+    'add_figure_label',
 ]
 
 import numpy as np
 from itertools import cycle
-from colormath.color_objects import LCHabColor, sRGBColor
-from colormath.color_conversions import convert_color
 
 def colormap_lch(n, lum=(35, 65), chroma=75, start=0, end=300):
+    from colormath.color_objects import LCHabColor, sRGBColor
+    from colormath.color_conversions import convert_color
+
     if isinstance(lum, list) or isinstance(lum, tuple):
         lum = cycle(lum)
     else:
@@ -111,3 +113,8 @@ def apply_dropped_spine(ax, spines=('left', 'bottom'), xgrid=False, smart_bounds
         plt.setp(ltext, fontsize='12')
         plt.setp(llines, linewidth=1.5)
 
+def add_figure_label(fig, label):
+    # Marks a plot as made from partial data, such as in a preview run.
+    if label:
+        fig.text(0.01, 0.99, label, ha='left', va='top', fontsize=8,
+                 color='#c0392b')
@@ -26,28 +26,38 @@
 
 __all__ = ['init_powersnake', 'external_script', 'init_powersnake',
            'load_snakemake_params', 'is_snakemake_child', 'suffix_filter',
-           'tmpfile', 'notify']
+           'tmpfile', 'notify', 'use_script_server', 'enable_job_labels',
+           'prioritize_wildcard_values', 'limit_resource', 'on_job_finished']
 
-from snakemake.shell import shell
+import threading
+import sys
 import os
 import tempfile
 
 PARAMETER_PASSING_ENVVAR = 'SNAKEMAKE_PARAMS'
 PUSHBULLET_ENVVAR = 'SNAKEMAKE_PUSHBULLET_APIKEY'
+PYTHON_COMMAND_PLACEHOLDER = '{PYTHON3_CMD} '
 
+script_server_python = None
+script_server_lock = threading.Lock()
+job_labels_enabled = False
 
-def is_snakemake_running():
-    import inspect
 
-    for outerframe in inspect.getouterframes(inspect.currentframe()):
-        if outerframe[1].endswith('snakemake/__init__.py'):
+def is_snakemake_running():
+    # Only the code objects are checked. inspect.getouterframes reads the
+    # source lines of every frame.
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename.endswith('snakemake/__init__.py'):
             return True
-    else:
-        return False
+        frame = frame.f_back
+    return False
 
 is_snakemake_child = lambda: False
 
 def init_powersnake():
+    from snakemake.shell import shell
+
     # pipefail is supported by bash only.
     shell.executable(os.popen('which bash').read().strip())
     shell.prefix('set -e; set -o pipefail; ')
@@ -79,14 +89,173 @@ def load_snakemake_params():
             value = nl
         setattr(builtins, varname, value)
 
+    from tailseeker import profiler
+    profiler.start_profiler()
+
+
+def use_script_server(python_cmd):
+    """Run the Python scripts of external_script in processes forked from
+    a server with the common modules already imported."""
+    global script_server_python
+    script_server_python = python_cmd
+
+
+def route_to_script_server(command):
+    global script_server_python
+    from tailseeker import scriptserver
+
+    if script_server_python is None or not command.startswith(PYTHON_COMMAND_PLACEHOLDER):
+        return command
+
+    # The scripts run directly by the interpreter if the server fails to
+    # start. It is not tried again for the later jobs.
+    with script_server_lock:
+        if script_server_python is None:
+            return command
+        try:
+            address = scriptserver.start_server(script_server_python)
+        except (RuntimeError, OSError) as exc:
+            print('WARNING: Running the scripts without the script server: {}'.format(exc),
+                  file=sys.stderr)
+            script_server_python = None
+            return command
+    os.environ[scriptserver.SERVER_ADDRESS_ENVVAR] = address
+
+    return (PYTHON_COMMAND_PLACEHOLDER + '-m tailseeker.scriptserver run ' +
+            command[len(PYTHON_COMMAND_PLACEHOLDER):])
+
+
+def find_job_context(frame):
+    # The function generated for a rule has both of these in its locals.
+    while frame is not None:
+        if 'rule' in frame.f_locals and 'wildcards' in frame.f_locals:
+            return frame.f_locals['rule'], frame.f_locals['wildcards']
+        frame = frame.f_back
+    return None, None
+
+
+def label_job_command(command, frame):
+    from tailseeker import accounting
+
+    rule, wildcards = find_job_context(frame)
+    if rule is None:
+        return command
+
+    return accounting.label_command(command, rule, list(wildcards.items()))
+
+
+def enable_job_labels(namespace):
+    """Replace `shell` in the namespace of a Snakefile with a subclass that
+    labels every command with the rule and wildcards of the calling job, so
+    that `tailseeker.accounting` and `tailseeker.profiler` can attribute
+    their measurements to the job."""
+    global job_labels_enabled
+
+    from snakemake.shell import shell
+    from snakemake.utils import format
+
+    class labelled_shell(shell):
+        def __new__(cls, cmd, *args, **kwargs):
+            # Substitute the variables in the frame of the caller here, as
+            # shell would look them up in this frame.
+            cmd = format(cmd, *args, stepout=2, **kwargs)
+            cmd = label_job_command(cmd, sys._getframe(1))
+            cmd = cmd.replace('{', '{{').replace('}', '}}')
+            return shell.__new__(cls, cmd, **kwargs)
+
+    namespace['shell'] = labelled_shell
+    job_labels_enabled = True
+
+    # Commands of the script: directives are run from this module.
+    try:
+        import snakemake.script
+        snakemake.script.shell = labelled_shell
+    except (ImportError, AttributeError):
+        pass
+
+
+# Releases of Snakemake whose DAG internals are known to work with
+# prioritize_wildcard_values.
+WILDCARD_PRIORITY_SNAKEMAKE_VERSIONS = (3, 7)
+
+
+def prioritize_wildcard_values(wildcard, priorities):
+    """Add `priorities[value]` to the priorities of the jobs having `value`
+    for `wildcard`. Snakemake only takes priorities for whole rules; the
+    values here are meant to be fractions ordering the jobs of a rule
+    without overriding the order between rules. This replaces a private
+    method of the DAG, so it is left out with a warning on the other
+    releases of Snakemake."""
+    import snakemake
+    from snakemake.dag import DAG
+    from snakemake.jobs import Job
+
+    try:
+        major = int(snakemake.__version__.split('.')[0])
+    except (AttributeError, ValueError):
+        major = None
+    first, last = WILDCARD_PRIORITY_SNAKEMAKE_VERSIONS
+    if (major is None or not first <= major <= last or
+            not hasattr(DAG, 'update_priority') or
+            not hasattr(Job, 'HIGHEST_PRIORITY')):
+        print('WARNING: Jobs are not ordered by {} on Snakemake {}.'.format(
+              wildcard, getattr(snakemake, '__version__', '(unknown)')), file=sys.stderr)
+        return
+
+    update_priority = DAG.update_priority
+
+    def update_priority_by_wildcard(self):
+        update_priority(self)
+        for job in self.needrun_jobs:
+            value = (job.wildcards_dict or {}).get(wildcard)
+            if value in priorities and self._priority[job] != Job.HIGHEST_PRIORITY:
+                self._priority[job] += priorities[value]
+
+    DAG.update_priority = update_priority_by_wildcard
+
+
+def limit_resource(name, value):
+    """Provide `value` of the resource `name` to the run unless it is given
+    with --resources in the command line."""
+    from snakemake.workflow import Workflow
+
+    execute = Workflow.execute
+
+    def execute_with_resource(self, *args, **kwds):
+        resources = dict(kwds.get('resources') or {})
+        resources.setdefault(name, value)
+        kwds['resources'] = resources
+        return execute(self, *args, **kwds)
+
+    Workflow.execute = execute_with_resource
+
+
+def on_job_finished(callback):
+    """Call `callback` with every job finished successfully, except in dry
+    runs. It runs in the scheduler of Snakemake holding its lock."""
+    from snakemake.dag import DAG
+
+    finish = DAG.finish
+
+    def finish_with_callback(self, job, *args, **kwds):
+        finish(self, job, *args, **kwds)
+        if not self.dryrun:
+            callback(job)
+
+    DAG.finish = finish_with_callback
+
 
 def external_script(_command):
     import inspect, json, tempfile
+    from snakemake.shell import shell
 
     VARS_TO_PASS = 'input output threads wildcards params'.split()
 
     callerlocal = inspect.currentframe().f_back.f_locals
     callerglobal = inspect.currentframe().f_back.f_globals
+    _command = route_to_script_server(_command)
+    if job_labels_enabled:
+        _command = label_job_command(_command, inspect.currentframe().f_back)
     packed = {}
     for var in VARS_TO_PASS:
         if isinstance(callerlocal[var], int):
@@ -145,45 +314,41 @@ def tmpfile(*args, **kwds):
     return finalize_temporary_file
 
 
-try:
-    import pushbullet
+class PushBulletNotifier:
+    """Sends notifications through PushBullet when the module and an API key
+    are available. Both are looked up only when the first message is sent."""
 
-    PUSHBULLET_ENVVAR = 'SNAKEMAKE_PUSHBULLET_APIKEY'
-    if PUSHBULLET_ENVVAR not in os.environ:
-        raise ValueError("PushBullet API key is not defined in {}.".format(PUSHBULLET_ENVVAR))
+    def __init__(self, log_tail_length=30):
+        self.log_tail_length = log_tail_length
+        self.pb = None
+        self.enabled = None
 
-    class PushBulletNotifier:
+    def check_connection(self):
+        if self.enabled is None:
+            try:
+                import pushbullet
+            except ImportError:
+                self.enabled = False
+            else:
+                self.enabled = PUSHBULLET_ENVVAR in os.environ
+                if self.enabled:
+                    self.pb = pushbullet.PushBullet(os.environ[PUSHBULLET_ENVVAR])
 
-        def __init__(self, apikey, log_tail_length=30):
-            self.apikey = apikey
-            self.log_tail_length = log_tail_length
-            self.pb = None
+        return self.enabled
 
-        def check_connection(self):
-            if self.pb is None:
-                self.pb = pushbullet.PushBullet(self.apikey)
+    def message(self, title, msg, logfile=None):
+        if not self.check_connection():
+            return
 
-        def message(self, title, msg, logfile=None):
-            self.check_connection()
+        self.pb.push_note(title, msg)
+        if logfile is not None:
+            logtail = open(logfile).readlines()[-self.log_tail_length:]
+            self.pb.push_file(''.join(logtail), 'log.txt', file_type='text/plain')
 
-            self.pb.push_note(title, msg)
-            if logfile is not None:
-                logtail = open(logfile).readlines()[-self.log_tail_length:]
-                self.pb.push_file(''.join(logtail), 'log.txt', file_type='text/plain')
-
-    notify = PushBulletNotifier(os.environ[PUSHBULLET_ENVVAR])
-
-except (ImportError, ValueError):
-    class DummyNotifier:
-        def __init__(self):
-            pass
-        def message(self, title, msg, logfile=None):
-            pass
-    notify = DummyNotifier()
+notify = PushBulletNotifier()
 
 # Call initializing functions
 if is_snakemake_running():
     init_powersnake()
 else:
     load_snakemake_params()
-
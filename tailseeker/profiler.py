@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+"""
+A statistical profiler for the scripts of the workflow.
+
+`start_profiler` does nothing unless the TAILSEEKER_PROFILE_DIR environment
+variable is set. Otherwise, the stacks of all threads are sampled on every
+SIGPROF of an interval timer counting the CPU time of the process, and
+written out at exit in the collapsed format of FlameGraph
+(`frame;frame;frame count` on each line) to a file named after the job
+(rule and wildcards) running the script. Processes forked by the script do
+not inherit the timer and are not sampled.
+"""
+
+__all__ = ['start_profiler', 'PROFILE_DIR_ENVVAR']
+
+import os
+import sys
+
+PROFILE_DIR_ENVVAR = 'TAILSEEKER_PROFILE_DIR'
+PROFILE_INTERVAL_ENVVAR = 'TAILSEEKER_PROFILE_INTERVAL'
+DEFAULT_INTERVAL = 0.005 # seconds of CPU time
+
+_profiler = None
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, output, interval):
+        self.output = output
+        self.interval = interval
+        self.pid = os.getpid()
+        self.samples = {}
+        self.thread_names = {}
+
+    def start(self):
+        import signal, atexit, threading
+
+        self.thread_names[threading.main_thread().ident] = 'MainThread'
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        atexit.register(self.stop)
+
+    def sample(self, signum, frame):
+        # Thread names are not looked up here, as the handler may interrupt
+        # the main thread holding the locks of the threading module.
+        names = self.thread_names
+        samples = self.samples
+        for ident, top in sys._current_frames().items():
+            # The handler itself runs on top of the main thread.
+            if top is sys._getframe():
+                top = frame
+
+            if ident not in names:
+                names[ident] = 'Thread-{}'.format(len(names))
+
+            stack = [names[ident]]
+            while top is not None:
+                stack.append(top.f_code)
+                top = top.f_back
+
+            key = tuple(stack)
+            samples[key] = samples.get(key, 0) + 1
+
+    def stop(self):
+        import signal
+
+        if self.pid != os.getpid():
+            return
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+        collapsed = {}
+        for stack, count in self.samples.items():
+            frames = [stack[0]] + [format_code(code) for code in reversed(stack[1:])]
+            line = ';'.join(frames)
+            collapsed[line] = collapsed.get(line, 0) + count
+
+        try:
+            os.makedirs(os.path.dirname(self.output), exist_ok=True)
+            with open(self.output, 'w') as outf:
+                for line, count in sorted(collapsed.items()):
+                    print(line, count, file=outf)
+        except OSError as exc:
+            print('WARNING: Failed to write the profile to {}: {}'.format(
+                  self.output, exc), file=sys.stderr)
+
+
+def format_code(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                               code.co_firstlineno).replace(';', ':')
+
+
+def profile_filename(profile_dir):
+    from tailseeker.accounting import current_job_label
+
+    label = current_job_label()
+    script = os.path.basename(sys.argv[0] or 'python')
+    if script.endswith('.py'):
+        script = script[:-3]
+
+    if label:
+        name = ','.join([label.pop('rule', '')] +
+                        ['{}={}'.format(k, v) for k, v in sorted(label.items())])
+        name = ''.join(c if c.isalnum() or c in ',=-_' else '_' for c in name)
+    else:
+        name = 'unlabelled'
+
+    return os.path.join(profile_dir, '{}.{}.{}.collapsed'.format(name, script, os.getpid()))
+
+
+def start_profiler():
+    """Start sampling this process if profiling is requested by the
+    environment. Calling this again in the same process does nothing."""
+    global _profiler
+
+    profile_dir = os.environ.get(PROFILE_DIR_ENVVAR)
+    if not profile_dir or (_profiler is not None and _profiler.pid == os.getpid()):
+        return
+
+    interval = float(os.environ.get(PROFILE_INTERVAL_ENVVAR, DEFAULT_INTERVAL))
+    _profiler = SamplingProfiler(profile_filename(profile_dir), interval)
+    _profiler.start()
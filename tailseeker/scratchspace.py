@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+"""
+Accounting of the space taken by the intermediate files in scratch.
+
+`ScratchUsageMonitor` samples the size of the scratch directory in a thread
+of the Snakemake process and keeps the peak. After each job, the size of
+its outputs in the scratch directory is appended to a record file together
+with the size of the data that the job works on, such as the raw data of a
+tile. `ScratchEstimator` predicts the space for the jobs of a rule from the
+records of the previous runs, to be claimed as the `scratch_mb` resource.
+"""
+
+__all__ = [
+    'directory_size', 'in_directory', 'ScratchUsageMonitor', 'ScratchEstimator',
+    'record_job_outputs', 'write_scratch_report', 'RECORD_FIELDS', 'RECORDS_FILE',
+]
+
+import os
+import sys
+import time
+import threading
+
+RECORDS_FILE = '.tailseeker-scratch.tsv'
+RECORD_FIELDS = ['rule', 'wildcards', 'unit_bytes', 'scratch_bytes', 'finish_time']
+RUN_FIELDS = [
+    'start_time', 'end_time', 'success', 'initial_mb', 'peak_mb', 'peak_time',
+    'final_mb', 'quota_mb',
+]
+SUMMARY_FIELDS = ['rule', 'jobs', 'scratch_mb', 'max_job_scratch_mb', 'ratio']
+
+# Scratch bytes per unit byte for the rules without records. It is set high
+# as an overestimate only throttles the jobs more than needed.
+DEFAULT_RATIO = 0.2
+MEGABYTE = 1048576
+
+
+def disk_usage(path):
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+def directory_size(path):
+    """Disk space taken by the files under `path` in bytes. Symbolic links
+    are not followed."""
+    total = 0
+    pending = [path]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    else:
+                        total += entry.stat(follow_symlinks=False).st_blocks * 512
+                except OSError:
+                    pass # removed while walking
+
+    return total
+
+
+def in_directory(path, directory):
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+class ScratchUsageMonitor(object):
+
+    def __init__(self, path, interval=30):
+        self.path = path
+        self.interval = interval
+        self.start_time = time.time()
+        self.initial = self.peak = self.last = directory_size(path)
+        self.peak_time = self.start_time
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        self.last = directory_size(self.path)
+        if self.last > self.peak:
+            self.peak, self.peak_time = self.last, time.time()
+        return self.last
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.run, name='scratch-monitor',
+                                       daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sample()
+
+
+def record_job_outputs(records_file, scratchdir, rule, wildcards, outputs, unit_bytes):
+    """Append the space taken by the outputs of a finished job in the
+    scratch directory to the records. Jobs without any output there are
+    not recorded."""
+    outputs = [f for f in outputs if in_directory(f, scratchdir)]
+    if not outputs:
+        return
+
+    scratch_bytes = sum(directory_size(f) if os.path.isdir(f) else disk_usage(f)
+                        for f in outputs)
+    values = [
+        rule, ','.join('{}={}'.format(k, v) for k, v in sorted(wildcards.items())),
+        str(int(unit_bytes)), str(scratch_bytes), '{:.3f}'.format(time.time()),
+    ]
+
+    try:
+        with open(records_file, 'a') as outf:
+            print('\t'.join(v.replace('\t', ' ') for v in values), file=outf)
+    except OSError as exc:
+        print('WARNING: Failed to write the scratch usage to {}: {}'.format(
+              records_file, exc), file=sys.stderr)
+
+
+def load_records(records_file):
+    records = []
+    if os.path.exists(records_file):
+        for line in open(records_file):
+            row = line.rstrip('\n').split('\t')
+            if len(row) != len(RECORD_FIELDS):
+                continue # truncated by an interrupted run
+            records.append(dict(zip(RECORD_FIELDS, row)))
+    return records
+
+
+class ScratchEstimator(object):
+    """Predicts the scratch space for the jobs of a rule as the size of the
+    raw data they work on times the largest ratio of the two recorded for
+    the rule. Without the raw data, the largest space taken by a recorded
+    job of the rule is used instead."""
+
+    def __init__(self, records_file, default_ratio=DEFAULT_RATIO):
+        self.default_ratio = default_ratio
+        self.ratios = {}
+        self.largest = {}
+
+        for rec in load_records(records_file):
+            rule, scratch_bytes = rec['rule'], int(rec['scratch_bytes'])
+            self.largest[rule] = max(scratch_bytes, self.largest.get(rule, 0))
+
+            unit_bytes = int(rec['unit_bytes'])
+            if unit_bytes > 0:
+                ratio = scratch_bytes / unit_bytes
+                self.ratios[rule] = max(ratio, self.ratios.get(rule, 0.))
+
+    def estimate_mb(self, rule, unit_bytes):
+        """Scratch space in megabytes for a job of `rule` working on
+        `unit_bytes` of raw data, or None if it cannot be predicted."""
+        if unit_bytes > 0:
+            scratch_bytes = self.ratios.get(rule, self.default_ratio) * unit_bytes
+        elif rule in self.largest:
+            scratch_bytes = self.largest[rule]
+        else:
+            return None
+        return int(scratch_bytes / MEGABYTE) + 1
+
+
+def write_scratch_report(monitor, records_file, summary_output, runs_output,
+                         quota_mb=0, success=True):
+    """Write the scratch space taken by the jobs of this run per rule, and
+    append the peak usage of the scratch directory to the table of runs."""
+    import csv
+    from collections import OrderedDict
+
+    monitor.stop()
+
+    rules = OrderedDict()
+    for rec in load_records(records_file):
+        if float(rec['finish_time']) < monitor.start_time - 1:
+            continue # from the previous runs
+
+        scratch_bytes, unit_bytes = int(rec['scratch_bytes']), int(rec['unit_bytes'])
+        summary = rules.setdefault(rec['rule'], [0, 0, 0, 0])
+        summary[0] += 1
+        summary[1] += scratch_bytes
+        summary[2] = max(summary[2], scratch_bytes)
+        summary[3] += unit_bytes
+
+    outdir = os.path.dirname(summary_output)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    with open(summary_output, 'w') as outf:
+        writer = csv.writer(outf)
+        writer.writerow(SUMMARY_FIELDS)
+        for rule, (jobs, total, largest, units) in sorted(rules.items(),
+                                                         key=lambda r: -r[1][1]):
+            writer.writerow([rule, jobs, '{:.1f}'.format(total / MEGABYTE),
+                             '{:.1f}'.format(largest / MEGABYTE),
+                             '{:.4f}'.format(total / units if units > 0 else 0.)])
+
+    newfile = not os.path.exists(runs_output)
+    timefmt = lambda t: time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t))
+    with open(runs_output, 'a') as outf:
+        writer = csv.writer(outf)
+        if newfile:
+            writer.writerow(RUN_FIELDS)
+        writer.writerow([
+            timefmt(monitor.start_time), timefmt(time.time()), int(success),
+            '{:.1f}'.format(monitor.initial / MEGABYTE),
+            '{:.1f}'.format(monitor.peak / MEGABYTE), timefmt(monitor.peak_time),
+            '{:.1f}'.format(monitor.last / MEGABYTE), quota_mb])
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+"""
+A local server that runs Python scripts in processes forked from an
+interpreter which already has the heavy modules imported.
+
+The server keeps a few forked processes waiting on a Unix socket. The
+client, `python -m tailseeker.scriptserver run script.py ...`, is started
+by the shell in place of `python script.py ...`. It hands its standard
+streams, working directory, environment and arguments over to a waiting
+process and exits with the status of the script. Each forked process runs
+only one script, so scripts never share any state. The client runs the
+script by itself when no server is reachable, and the workflow runs the
+scripts directly if the server fails to start.
+"""
+
+__all__ = ['start_server', 'stop_server', 'SERVER_ADDRESS_ENVVAR']
+
+import os
+import sys
+import json
+import socket
+import struct
+
+SERVER_ADDRESS_ENVVAR = 'TAILSEEKER_SCRIPT_SERVER'
+
+PRELOAD_MODULES = [
+    'numpy', 'scipy', 'scipy.stats', 'scipy.spatial.distance', 'pandas',
+    'snakemake.io', 'snakemake.shell', 'snakemake.utils',
+    'tailseeker.powersnake', 'tailseeker.fileutils', 'tailseeker.stats',
+    'tailseeker.signals',
+]
+SPARE_WORKERS = 4
+PARENT_CHECK_INTERVAL = 5
+LENGTH_HEADER = struct.Struct('<I')
+# exit status, user and system CPU time, peak RSS, blocks read and written
+EXIT_STATUS = struct.Struct('<iddqqq')
+WORKER_FAILURE_STATUS = 1
+ACCOUNTING_USAGE_ENVVAR = 'TAILSEEKER_EXTERNAL_USAGE'
+
+_server = None
+
+
+def start_server(python_cmd, spare_workers=SPARE_WORKERS):
+    """Start a server for the current process and return its address. The
+    server terminates when this process exits."""
+    global _server
+
+    if _server is not None:
+        return _server[1]
+
+    import subprocess, tempfile, shutil, atexit, signal
+
+    sockdir = tempfile.mkdtemp(prefix='tailseq-scripts-')
+    address = os.path.join(sockdir, 'server.sock')
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    proc = subprocess.Popen([python_cmd, '-m', 'tailseeker.scriptserver', 'serve',
+                             address, str(os.getpid()), str(spare_workers)],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            env=env, start_new_session=True)
+    if proc.stdout.readline().strip() != b'ready':
+        proc.wait()
+        shutil.rmtree(sockdir, ignore_errors=True)
+        raise RuntimeError('Failed to start the script server.')
+    proc.stdout.close()
+
+    def cleanup():
+        # The idle workers stay in the process group of the server.
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        proc.wait()
+        shutil.rmtree(sockdir, ignore_errors=True)
+
+    atexit.register(cleanup)
+    _server = (proc, address, cleanup)
+
+    return address
+
+
+def stop_server():
+    global _server
+
+    if _server is not None:
+        import atexit
+
+        _server[2]()
+        atexit.unregister(_server[2])
+        _server = None
+
+
+# Standard streams are handed over as SCM_RIGHTS messages. socket.send_fds
+# and socket.recv_fds do the same but are only in Python 3.9 and later.
+
+def send_fds(sock, buffers, fds):
+    import array
+    return sock.sendmsg(buffers, [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                   array.array('i', fds))])
+
+
+def recv_fds(sock, bufsize, maxfds):
+    import array
+
+    fds = array.array('i')
+    msg, ancdata, flags, addr = sock.recvmsg(
+                bufsize, socket.CMSG_LEN(maxfds * fds.itemsize))
+    for level, type_, data in ancdata:
+        if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    return msg, list(fds), flags, addr
+
+
+# Server side
+
+def preload_modules():
+    import importlib
+
+    for modname in PRELOAD_MODULES:
+        try:
+            importlib.import_module(modname)
+        except ImportError:
+            pass
+
+
+def recv_exactly(conn, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = conn.recv(size - len(buf))
+        if not chunk:
+            raise EOFError
+        buf += chunk
+    return buf
+
+
+def receive_request(conn):
+    msg, fds, _, _ = recv_fds(conn, LENGTH_HEADER.size, 3)
+    if len(msg) < LENGTH_HEADER.size:
+        msg += recv_exactly(conn, LENGTH_HEADER.size - len(msg))
+    length, = LENGTH_HEADER.unpack(msg)
+    return json.loads(recv_exactly(conn, length).decode()), fds
+
+
+def watch_client(conn):
+    # The client closes the connection only when it has been terminated.
+    # Take the script down with it, as it would be if run directly.
+    import threading, signal
+
+    def watch():
+        try:
+            conn.recv(1)
+        except OSError:
+            pass
+        try:
+            os.killpg(0, signal.SIGTERM)
+        finally:
+            os._exit(WORKER_FAILURE_STATUS)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def run_script(request, fds):
+    import runpy, traceback, random, atexit
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+
+    argv = request['argv']
+    sys.argv = list(argv)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(argv[0])))
+    for path in reversed(os.environ.get('PYTHONPATH', '').split(os.pathsep)):
+        if path and path not in sys.path:
+            sys.path.insert(1, path)
+
+    # Forked processes share the random states of the server.
+    random.seed()
+    if 'numpy' in sys.modules:
+        sys.modules['numpy'].random.seed()
+
+    # Pass the rule variables as powersnake does for new interpreters.
+    powersnake = sys.modules.get('tailseeker.powersnake')
+    if powersnake is not None:
+        powersnake.load_snakemake_params()
+
+    try:
+        runpy.run_path(argv[0], run_name='__main__')
+        status = 0
+    except SystemExit as exc:
+        if exc.code is None:
+            status = 0
+        elif isinstance(exc.code, int):
+            status = exc.code
+        else:
+            print(exc.code, file=sys.stderr)
+            status = 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+
+    # The worker leaves with os._exit, which skips the exit handlers that
+    # the script has registered.
+    atexit._run_exitfuncs()
+
+    return status
+
+
+def worker_main(listener, notify_fd):
+    conn, _ = listener.accept()
+    listener.close()
+    os.setpgid(0, 0) # leave the pool of idle workers
+    os.write(notify_fd, b'.')
+    os.close(notify_fd)
+
+    status = WORKER_FAILURE_STATUS
+    try:
+        request, fds = receive_request(conn)
+        watch_client(conn)
+        status = run_script(request, fds)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+        try:
+            conn.sendall(EXIT_STATUS.pack(status, *resource_usage()))
+        finally:
+            os._exit(status & 0xff)
+
+
+def resource_usage():
+    # Both counters start from zero in a forked process.
+    import resource
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime,
+            max(own.ru_maxrss, children.ru_maxrss),
+            own.ru_inblock + children.ru_inblock,
+            own.ru_oublock + children.ru_oublock)
+
+
+def serve(address, parent_pid, spare_workers):
+    import signal, select
+
+    preload_modules()
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(address)
+    listener.listen(64)
+
+    notify_r, notify_w = os.pipe()
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # reap workers automatically
+
+    print('ready', flush=True)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+    def fork_worker():
+        sys.stderr.flush()
+        if os.fork() == 0:
+            os.close(notify_r)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            worker_main(listener, notify_w)
+
+    for i in range(spare_workers):
+        fork_worker()
+
+    # Replace every worker that has taken a request, until the workflow
+    # process goes away.
+    while os.getppid() == parent_pid:
+        readable, _, _ = select.select([notify_r], [], [], PARENT_CHECK_INTERVAL)
+        if readable:
+            for i in range(len(os.read(notify_r, 256))):
+                fork_worker()
+
+    listener.close()
+    os.killpg(0, signal.SIGTERM)
+
+
+# Client side
+
+def run_client(address, argv):
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(address)
+    except OSError:
+        run_directly(argv)
+
+    request = json.dumps({
+        'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ),
+    }).encode()
+
+    send_fds(conn, [LENGTH_HEADER.pack(len(request))], [0, 1, 2])
+    conn.sendall(request)
+
+    try:
+        status, *usage = EXIT_STATUS.unpack(recv_exactly(conn, EXIT_STATUS.size))
+        report_usage(usage)
+    except EOFError:
+        print('ERROR: The script server terminated unexpectedly while running '
+              '{}.'.format(argv[0]), file=sys.stderr)
+        status = WORKER_FAILURE_STATUS
+
+    sys.exit(status)
+
+
+def report_usage(usage):
+    # The script ran outside of the process tree of the job, which is
+    # measured by the accounting wrapper.
+    if ACCOUNTING_USAGE_ENVVAR in os.environ:
+        from tailseeker import accounting
+        accounting.report_external_usage(usage)
+
+
+def run_directly(argv):
+    os.execv(sys.executable, [sys.executable] + argv)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'run':
+        address = os.environ.get(SERVER_ADDRESS_ENVVAR)
+        if address:
+            run_client(address, sys.argv[2:])
+        else:
+            run_directly(sys.argv[2:])
+    elif len(sys.argv) == 5 and sys.argv[1] == 'serve':
+        serve(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        print('Usage: {} run script.py [args ...]'.format(sys.argv[0]),
+              file=sys.stderr)
+        sys.exit(2)
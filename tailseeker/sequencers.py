@@ -22,6 +22,7 @@
 #
 
 import os
+import glob
 
 
 TILE_LIST = {
@@ -77,3 +78,92 @@ def get_tiles(conf):
 
     return tilemaps
 
+
+def select_preview_tiles(tiles, selection):
+    """Subset of `tiles` for a preview run. `selection` is either a list of
+    tile numbers, chosen in all the sources, or the number of tiles to pick
+    at even intervals within each surface and swath of every source."""
+    if isinstance(selection, (list, tuple)):
+        wanted = set(str(tile) for tile in selection)
+        chosen = [tileid for tileid, info in tiles.items() if info['tile'] in wanted]
+        if not chosen:
+            raise ValueError("None of the preview tiles {} is in the run.".format(
+                             ', '.join(sorted(wanted))))
+        return {tileid: tiles[tileid] for tileid in chosen}
+
+    count = int(selection)
+    if count <= 0:
+        raise ValueError("The number of preview tiles must be positive.")
+    if count >= len(tiles):
+        return dict(tiles)
+
+    groups = {}
+    for tileid, info in sorted(tiles.items()):
+        groups.setdefault((info['source'], info['tile'][:2]), []).append(tileid)
+
+    # Tiles are distributed over the groups as evenly as possible, and
+    # taken from the middle of equal intervals along each swath.
+    chosen = []
+    groupnames = sorted(groups)
+    for i, name in enumerate(groupnames):
+        members = groups[name]
+        share = min(len(members), count // len(groupnames) +
+                                  (i < count % len(groupnames)))
+        chosen.extend(members[int((j + 0.5) * len(members) / share)]
+                      for j in range(share))
+
+    return {tileid: tiles[tileid] for tileid in chosen}
+
+
+def tile_input_files(tileinfo, cycle):
+    lane = int(tileinfo['lane'])
+    cycledir = 'L{:03d}/C{}.1/s_{}_{}'.format(lane, cycle, lane, tileinfo['tile'])
+    intensitiesdir = tileinfo['intensitiesdir']
+    return [os.path.join(intensitiesdir, cycledir + '.cif'),
+            os.path.join(intensitiesdir, 'BaseCalls', cycledir + '.bcl'),
+            os.path.join(intensitiesdir, 'BaseCalls', cycledir + '.bcl.gz')]
+
+
+def total_file_size(filenames):
+    return sum(os.path.getsize(f) for f in filenames if os.path.isfile(f))
+
+
+def estimate_raw_data_sizes(tiles, num_cycles, sampled_cycles=3):
+    """Estimate the size of the intensity and base call files of each tile
+    for all cycles from those in a few cycles. Tiles without any of the
+    files are left out."""
+    cycles = sorted(set(1 + i * (num_cycles - 1) // max(1, sampled_cycles - 1)
+                        for i in range(sampled_cycles)))
+
+    sizes = {}
+    for tileid, tileinfo in tiles.items():
+        size = total_file_size(f for cycle in cycles
+                               for f in tile_input_files(tileinfo, cycle))
+        if size > 0:
+            sizes[tileid] = size * num_cycles // len(cycles)
+    return sizes
+
+
+def estimate_tile_costs(tiles, num_cycles, fallback_patterns=(), sampled_cycles=3):
+    """Estimate the relative amount of work for each tile from the sizes of
+    its intensity and base call files in a few cycles, or from the files
+    matching `fallback_patterns` (formatted with `tile`) if the raw data are
+    not found. Tiles without any of the files get the median of the
+    others, or 1 if no file is found at all."""
+    costs = estimate_raw_data_sizes(tiles, num_cycles, sampled_cycles)
+    for tileid in tiles:
+        if tileid not in costs:
+            cost = total_file_size(f for pattern in fallback_patterns
+                                   for f in glob.glob(pattern.format(tile=tileid)))
+            if cost > 0:
+                costs[tileid] = cost
+
+    known = sorted(costs.values())
+    default = known[len(known) // 2] if known else 1
+    return {tileid: costs.get(tileid, default) for tileid in tiles}
+
+
+def rank_tile_costs(costs):
+    """Priorities in [0, 1) that order the tiles from the largest."""
+    ranked = sorted(costs, key=lambda tileid: (costs[tileid], tileid))
+    return {tileid: rank / len(ranked) for rank, tileid in enumerate(ranked)}
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+"""
+Splitting of coordinate-sorted BAM files into shards of whole reference
+sequences for processing in parallel.
+
+The references are grouped in the order of the header, so that the shards
+concatenated in order keep the alignments sorted. The groups are balanced
+by the numbers of reads in the index. Unplaced unmapped reads go to the
+last shard.
+"""
+
+__all__ = ['read_idxstats', 'partition_references', 'write_shard_plan',
+           'load_shard_regions', 'UNMAPPED_REGION']
+
+import subprocess as sp
+import os
+
+UNMAPPED_REGION = '*'
+
+
+def read_idxstats(bamfile, samtools_cmd=None):
+    """Reference names and read counts from the index of `bamfile` in the
+    order of the header."""
+    samtools_cmd = samtools_cmd or os.environ.get('SAMTOOLS_CMD', 'samtools')
+    output = sp.check_output([samtools_cmd, 'idxstats', bamfile]).decode()
+
+    stats = []
+    for line in output.splitlines():
+        name, length, mapped, unmapped = line.split('\t')
+        stats.append((name, int(mapped) + int(unmapped)))
+    return stats
+
+
+def partition_references(stats, nshards):
+    """Group the references into `nshards` runs of consecutive ones with
+    similar numbers of reads. References without any read are left out.
+    Some of the groups are empty if the reads are on too few references."""
+    if nshards < 1:
+        raise ValueError('The number of shards must be positive.')
+
+    placed = [(name, count) for name, count in stats
+              if name != UNMAPPED_REGION and count > 0]
+    unplaced = sum(count for name, count in stats if name == UNMAPPED_REGION)
+    total = sum(count for name, count in placed) + unplaced
+
+    shards = [[] for i in range(nshards)]
+    shardno = cumulative = 0
+    for name, count in placed:
+        # Move on to the next shard when this reference ends closer to the
+        # next boundary than to the current one.
+        boundary = total * (shardno + 1) / nshards
+        if (shards[shardno] and shardno < nshards - 1 and
+                cumulative + count / 2 > boundary):
+            shardno += 1
+        shards[shardno].append(name)
+        cumulative += count
+
+    if unplaced > 0:
+        shards[-1].append(UNMAPPED_REGION)
+
+    return shards
+
+
+def write_shard_plan(output, shards):
+    with open(output, 'w') as outf:
+        for regions in shards:
+            print('\t'.join(regions), file=outf)
+
+
+def load_shard_regions(planfile, shard):
+    """Regions of a shard in a file from `write_shard_plan`. An empty list
+    means that the shard has no reads."""
+    with open(planfile) as plan:
+        lines = plan.read().split('\n')
+    return [name for name in lines[int(shard)].split('\t') if name]
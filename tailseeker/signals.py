@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+#
+# Copyright (c) 2016 Institute for Basic Science
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# - Hyeshik Chang <hyeshik@snu.ac.kr>
+#
+
+__all__ = [
+    'SIGDISTS_FORMAT_VERSION', 'load_sigdists', 'write_sigdists',
+    'SignalPack', 'SIGNALPACKET_SCORE_MAX',
+]
+
+import numpy as np
+import tempfile
+import shutil
+import struct
+import gzip
+import os
+
+# Keep these in sync with struct SigDistsHeader in src/signal-packs.h.
+SIGDISTS_MAGIC = b'TSSIGDST'
+SIGDISTS_FORMAT_VERSION = 1
+SIGDISTS_HEADER = struct.Struct('<8sIIII')
+SIGDISTS_DTYPE = np.dtype('<u4')
+
+LEGACY_SIGDISTS_HEADER = struct.Struct('<III')
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Keep these in sync with src/signal-packs.h.
+SIGPACK_HEADER = struct.Struct('<III')
+SIGNALPACKET_SIZE = 4
+SIGNALPACKET_SCORE_BITWIDTH = 24
+SIGNALPACKET_SCORE_MAX = (1 << SIGNALPACKET_SCORE_BITWIDTH) - 1
+
+
+def load_sigdists(filename, mmap=True):
+    """Load a signal distribution matrix shaped as (cycles, bins).
+
+    Files in the current format are memory-mapped read-only unless `mmap`
+    is false. Gzip- or BGZF-compressed files from older versions are
+    decompressed into memory."""
+    with open(filename, 'rb') as inpf:
+        header = inpf.read(SIGDISTS_HEADER.size)
+
+    if header[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return _load_legacy_sigdists(filename)
+
+    if len(header) < SIGDISTS_HEADER.size or not header.startswith(SIGDISTS_MAGIC):
+        raise ValueError('{} is not a signal distribution file.'.format(filename))
+
+    _, version, elemsize, cycles, bins = SIGDISTS_HEADER.unpack(header)
+    if version != SIGDISTS_FORMAT_VERSION:
+        raise ValueError('Unsupported sigdists format version {} in {}.'.format(
+                         version, filename))
+    if elemsize != SIGDISTS_DTYPE.itemsize:
+        raise ValueError('Unexpected element size {} in {}.'.format(elemsize, filename))
+
+    if mmap:
+        return np.memmap(filename, dtype=SIGDISTS_DTYPE, mode='r',
+                         offset=SIGDISTS_HEADER.size, shape=(cycles, bins))
+    else:
+        counts = np.fromfile(filename, dtype=SIGDISTS_DTYPE,
+                             offset=SIGDISTS_HEADER.size, count=cycles * bins)
+        return counts.reshape((cycles, bins))
+
+
+def _load_legacy_sigdists(filename):
+    with gzip.open(filename, 'rb') as inpf:
+        elemsize, cycles, bins = LEGACY_SIGDISTS_HEADER.unpack(
+            inpf.read(LEGACY_SIGDISTS_HEADER.size))
+        if elemsize != SIGDISTS_DTYPE.itemsize:
+            raise ValueError('Unexpected element size {} in {}.'.format(elemsize, filename))
+
+        counts = np.frombuffer(inpf.read(), dtype=SIGDISTS_DTYPE)
+
+    return counts.reshape((cycles, bins))
+
+
+def write_sigdists(counts, filename):
+    counts = np.asarray(counts)
+    if counts.ndim != 2:
+        raise ValueError('Signal distributions must be a two-dimensional array.')
+    if counts.size > 0 and counts.max() > np.iinfo(SIGDISTS_DTYPE).max:
+        raise ValueError('Cluster counts overflow the sigdists element type.')
+
+    with open(filename, 'wb') as outf:
+        outf.write(SIGDISTS_HEADER.pack(SIGDISTS_MAGIC, SIGDISTS_FORMAT_VERSION,
+                                        SIGDISTS_DTYPE.itemsize, *counts.shape))
+        outf.write(np.ascontiguousarray(counts, dtype=SIGDISTS_DTYPE).tobytes())
+
+
+class SignalPack(object):
+    """Random access to the poly(A) signal scores in a .sigpack file.
+
+    A sigpack is a header followed by one record per cluster: the cluster
+    number, the first cycle of the scored region, the number of valid
+    cycles and `max_cycles` packed scores. Records are padded to the same
+    size, so they are addressed directly in the memory-mapped file. The
+    compressed sigpacks written by the importer are decompressed once into
+    a temporary file in `scratch_dir` (the TAILSEQ_SCRATCH_DIR environment
+    variable by default) before mapping.
+
+    Scores are integers ranging from 1 to SIGNALPACKET_SCORE_MAX, and 0
+    stands for a cycle without a valid signal."""
+
+    def __init__(self, filename, scratch_dir=None):
+        self.filename = filename
+        self.tmpfile = None
+
+        with open(filename, 'rb') as inpf:
+            compressed = inpf.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+        if compressed:
+            if scratch_dir is None:
+                scratch_dir = os.environ.get('TAILSEQ_SCRATCH_DIR', '.')
+            self.tmpfile = tempfile.TemporaryFile(dir=scratch_dir)
+            with gzip.open(filename, 'rb') as inpf:
+                shutil.copyfileobj(inpf, self.tmpfile)
+            self.tmpfile.flush()
+            source = self.tmpfile
+        else:
+            source = filename
+
+        header = np.memmap(source, dtype=np.uint8, mode='r',
+                           shape=(SIGPACK_HEADER.size,))
+        elemsize, self.total_clusters, self.max_cycles = \
+            SIGPACK_HEADER.unpack(header.tobytes())
+        del header
+
+        if elemsize != SIGNALPACKET_SIZE:
+            raise ValueError('{} was written in a machine with different '
+                             'architecture.'.format(filename))
+
+        self.record_dtype = np.dtype([
+            ('clusterno', '<u4'), ('first_cycle', '<i2'),
+            ('valid_cycle_count', '<i2'),
+            ('packets', '<u4', (self.max_cycles,))])
+
+        datasize = self._file_size(source) - SIGPACK_HEADER.size
+        if datasize % self.record_dtype.itemsize != 0:
+            raise ValueError('Unexpected end of file in {}.'.format(filename))
+
+        nrecords = datasize // self.record_dtype.itemsize
+        if nrecords > 0:
+            self.records = np.memmap(source, dtype=self.record_dtype, mode='r',
+                                     offset=SIGPACK_HEADER.size, shape=(nrecords,))
+        else:
+            self.records = np.zeros(0, dtype=self.record_dtype)
+
+        self._cluster_index = None
+
+    @staticmethod
+    def _file_size(source):
+        if isinstance(source, str):
+            return os.path.getsize(source)
+        source.seek(0, os.SEEK_END)
+        return source.tell()
+
+    def close(self):
+        self.records = None
+        if self.tmpfile is not None:
+            self.tmpfile.close()
+            self.tmpfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def clusterno(self):
+        return self.records['clusterno']
+
+    @property
+    def first_cycle(self):
+        return self.records['first_cycle']
+
+    @property
+    def valid_cycle_count(self):
+        return self.records['valid_cycle_count']
+
+    @property
+    def cluster_index(self):
+        """Record number for every cluster number in the tile, or -1 for
+        clusters without a record."""
+        if self._cluster_index is None:
+            index = np.full(max(self.total_clusters, 0), -1, dtype=np.int64)
+            index[self.clusterno] = np.arange(len(self.records))
+            self._cluster_index = index
+        return self._cluster_index
+
+    def find_records(self, clusternos):
+        return self.cluster_index[np.asarray(clusternos)]
+
+    def _select(self, records):
+        if records is None:
+            return self.records
+        return self.records[records]
+
+    def packed_scores(self, records=None):
+        """Raw score packets of the records, relative to their first cycle."""
+        recs = self._select(records)
+        packets = np.asarray(recs['packets'])
+        valid = (np.arange(self.max_cycles) <
+                 np.asarray(recs['valid_cycle_count'])[..., np.newaxis])
+        return np.where(valid, packets, 0).astype(np.uint32)
+
+    def scores(self, records=None):
+        """Integer scores of the records, relative to their first cycle."""
+        return (self.packed_scores(records) >> 1) & SIGNALPACKET_SCORE_MAX
+
+    def downhill(self, records=None):
+        return (self.packed_scores(records) & 1).astype(bool)
+
+    def scores_by_cycle(self, start, stop, records=None, downhill=False):
+        """Integer scores (or downhill flags) of the records, aligned to the
+        physical cycles from `start` to `stop`. Cycles outside the scored
+        region of a record are filled with 0."""
+        recs = self._select(records)
+        packed = self.packed_scores(records)
+        if packed.ndim == 1:
+            packed = packed[np.newaxis]
+
+        cycles = np.arange(start, stop)
+        offsets = cycles - np.asarray(recs['first_cycle'],
+                                      dtype=np.int64).reshape(-1, 1)
+        inside = (offsets >= 0) & (offsets < self.max_cycles)
+        rows = np.arange(len(packed))[:, np.newaxis]
+        aligned = np.where(inside, packed[rows, np.clip(offsets, 0,
+                                                        self.max_cycles - 1)], 0)
+
+        if downhill:
+            result = (aligned & 1).astype(bool)
+        else:
+            result = (aligned >> 1) & SIGNALPACKET_SCORE_MAX
+
+        return result if np.ndim(recs['first_cycle']) > 0 else result[0]
+
+    @staticmethod
+    def normalize_scores(scores):
+        """Convert integer scores to the [0, 1] scale, with NaN for cycles
+        without a valid signal."""
+        scores = np.asarray(scores)
+        return np.where(scores > 0, (scores - 1.) / (SIGNALPACKET_SCORE_MAX - 1),
+                        np.nan)
@@ -61,7 +61,9 @@ from tailseeker.powersnake import *
 SETTINGS_FILE = os.path.abspath('tailseeker.yaml')
 
 from tailseeker import configurations
-CONF = configurations.Configurations(TAILSEEKER_DIR, open(SETTINGS_FILE))
+CONF = configurations.Configurations(TAILSEEKER_DIR, open(SETTINGS_FILE),
+            cache_file=os.path.join(os.path.dirname(SETTINGS_FILE),
+                                    configurations.CONFIG_CACHE_FILE))
 
 # Set default null parameters
 TABIX_CMD = ''
@@ -92,6 +94,88 @@ if not CONF['clean_intermediate_files']:
 inf = float('inf')
 nan = float('nan')
 
+# Compression of the intermediate files in scratch/, given to the programs
+# writing them as options. The final outputs are always written in the
+# standard formats.
+from tailseeker import fileutils
+INTERMEDIATE_CODEC = fileutils.get_intermediate_codec(
+                        CONF['performance']['intermediate_compression'])
+INTERMEDIATE_BGZIP_OPT = fileutils.intermediate_bgzip_options(INTERMEDIATE_CODEC)
+INTERMEDIATE_BAM_VIEW_OPT, INTERMEDIATE_BAM_SORT_OPT = \
+    fileutils.intermediate_bam_options(INTERMEDIATE_CODEC)
+
+# Let the scripts write their throughput counters to scratch/status/.
+SHELL_ENV_INSTRUMENTATION = ''
+if CONF['performance']['throughput_status']:
+    from tailseeker import instrument
+    SHELL_ENV_INSTRUMENTATION = '{}="{}" '.format(instrument.STATUS_DIR_ENVVAR,
+                                         os.path.join(SCRATCHDIR, 'status'))
+
+# Profile the Python scripts of the jobs when TAILSEEKER_PROFILE is set in
+# the environment, writing the stacks to scratch/profiles/.
+if os.environ.get('TAILSEEKER_PROFILE'):
+    from tailseeker import profiler
+    SHELL_ENV_INSTRUMENTATION += '{}="{}" '.format(profiler.PROFILE_DIR_ENVVAR,
+                                          os.path.join(SCRATCHDIR, 'profiles'))
+
+# Functions writing reports in stats/ at the end of a run. They are called
+# with whether the run succeeded.
+RUN_REPORTS = []
+
+# Record the resource usage of every shell command with the rule and
+# wildcards of its job, and summarize them in stats/ at the end of the run.
+SHELL_PREFIX_ACCOUNTING = ''
+if CONF['performance']['resource_accounting']:
+    from tailseeker import accounting
+
+    ACCOUNTING_RECORDS = os.path.join(SCRATCHDIR, 'accounting', 'jobs.tsv')
+    SHELL_PREFIX_ACCOUNTING = accounting.shell_prefix(PYTHON3_CMD, ACCOUNTING_RECORDS)
+
+    def write_resource_usage_report(success):
+        if os.path.exists(ACCOUNTING_RECORDS):
+            if not os.path.isdir('stats'):
+                os.makedirs('stats')
+            accounting.summarize_usage(ACCOUNTING_RECORDS, 'stats/resource-usage.csv',
+                                       'stats/resource-usage-jobs.csv')
+
+    RUN_REPORTS.append(write_resource_usage_report)
+
+# Watch the space taken in the scratch directory. With a quota, the jobs
+# writing there claim their predicted space as the `scratch_mb` resource,
+# which is assigned to the rules by main.py after all of them are defined.
+SCRATCH_QUOTA_MB = CONF['performance']['scratch_quota_mb']
+SCRATCH_ACCOUNTING = CONF['performance']['scratch_accounting'] or SCRATCH_QUOTA_MB > 0
+if SCRATCH_ACCOUNTING:
+    from tailseeker import scratchspace
+
+    SCRATCH_RECORDS = os.path.join(WRKDIR, scratchspace.RECORDS_FILE)
+    SCRATCH_MONITOR = scratchspace.ScratchUsageMonitor(SCRATCHDIR)
+
+    # The files left from the previous runs take a part of the quota.
+    if SCRATCH_QUOTA_MB > 0:
+        limit_resource('scratch_mb', max(1, SCRATCH_QUOTA_MB -
+                                            SCRATCH_MONITOR.initial // scratchspace.MEGABYTE))
+
+    def write_scratch_usage_report(success):
+        scratchspace.write_scratch_report(SCRATCH_MONITOR, SCRATCH_RECORDS,
+                                          'stats/scratch-usage.csv',
+                                          'stats/scratch-usage-runs.csv',
+                                          SCRATCH_QUOTA_MB, success)
+
+    RUN_REPORTS.append(write_scratch_usage_report)
+
+    onstart:
+        SCRATCH_MONITOR.start()
+
+if RUN_REPORTS:
+    onsuccess:
+        for report in RUN_REPORTS:
+            report(True)
+
+    onerror:
+        for report in RUN_REPORTS:
+            report(False)
+
 # Commands needs to be run with bash with these options to terminate on errors correctly.
 shell.executable(BASH_CMD) # pipefail is supported by bash only.
 shell.prefix(('set -e; set -o pipefail; '
@@ -99,7 +183,18 @@ shell.prefix(('set -e; set -o pipefail; '
                      'BGZIP_CMD="{BGZIP_CMD}" TABIX_CMD="{TABIX_CMD}" '
                      'TAILSEQ_SCRATCH_DIR="{SCRATCHDIR}" '
                      'PATH="{PATH}" LD_LIBRARY_PATH="{LD_LIBRARY_PATH}" '
-                     + CONF.get('envvars', '') + '; ').format(
+                     + SHELL_ENV_INSTRUMENTATION + CONF.get('envvars', '') + '; ').format(
                 PYTHONPATH=TAILSEEKER_DIR, SCRATCHDIR=SCRATCHDIR, BGZIP_CMD=BGZIP_CMD,
-                TABIX_CMD=TABIX_CMD, PATH=PATH, LD_LIBRARY_PATH=LD_LIBRARY_PATH))
+                TABIX_CMD=TABIX_CMD, PATH=PATH, LD_LIBRARY_PATH=LD_LIBRARY_PATH)
+             + SHELL_PREFIX_ACCOUNTING)
+
+# Label the commands after the shell is set up, as the settings above are
+# stored in the class of the shell.
+if SHELL_PREFIX_ACCOUNTING or os.environ.get('TAILSEEKER_PROFILE'):
+    enable_job_labels(globals())
+
 
+# Run the Python scripts of the rules in processes forked from a warmed-up
+# interpreter instead of starting a new interpreter for every job.
+if CONF['performance']['script_server']:
+    use_script_server(PYTHON3_CMD)
